@@ -19,11 +19,14 @@ import logging
 # there is something wrong using h26x_extractor installed package
 # so including h26x source code directly
 #from h26x_extractor import h26x_parser
+import nalu_index
+import nalutypes
 import h26x_parser
 
 from bitstring import BitStream, BitArray
 from NaluParser import *
 import prediction
+import yuv
 
 sps_parser = SpsParser()
 pps_parser = PpsParser()
@@ -31,34 +34,48 @@ nal_parser = NalParser()
 
 index = 0
 
+# output stage of the decoded pictures, a yuv.YuvWriter; the pictures are shown when None
+output = None
+
 def get_sps(bytes):
     # do something with the NALU bytes
     logging.debug("get sps")
     logging.debug(bytes)
-    sps_parser.parse( BitStream(bytes) )
+    sps_parser.parse(bytes)
 
 def get_pps(bytes):
     # do something with the NALU bytes
     logging.debug("get pps")
     logging.debug(bytes)
-    pps_parser.parse( BitStream(bytes) )
+    pps_parser.parse(bytes)
 
 def get_aud(bytes):
     # do something with the NALU bytes
     logging.debug("aud")
     return bytes
 
-def get_slice(bytes):
-    # do something with the NALU bytes
+def get_slice(bytes, skip_first=False):
+    """
+    Decode a slice and show or output the picture
+    Args:
+        bytes: the RBSP of the slice
+        skip_first: drop the first slice since the last reset of index when the pictures are shown,
+            the output stage always gets every picture
+    """
     logging.debug("----------- slice ---------------")
 
     global index
-    if index==0:
-        index = index + 1
+    index = index + 1
+    if skip_first and index == 1 and output is None:
         return
 
-    image = nal_parser.parse(BitStream(bytes), sps_parser, pps_parser)
+    image = nal_parser.parse(bytes, sps_parser, pps_parser)
 
+    if output is not None:
+        output.write(image)
+        return
+
+    import matplotlib.pyplot as plt
     plt.figure()
     plt.imshow(image, cmap='gray')
     plt.title("Inverse image")
@@ -71,11 +88,63 @@ def get_nalu(bytes):
     #logging.debug(bytes)
     logging.debug("nalu bytes")
 
-def main(h264file):
+def open_output(yuvfile, y4m=None):
+    """
+    Send the decoded pictures to a file instead of showing them
+    Args:
+        yuvfile: .yuv or .y4m file name, or binary file-like object, None shows the pictures
+        y4m: write YUV4MPEG2, by default when the file name ends with .y4m
+    """
+    global output
+    close_output()
+    if yuvfile is not None:
+        output = yuv.YuvWriter(yuvfile, y4m=y4m)
+
+def close_output():
+    """
+    Flush and close the output stage
+    """
+    global output
+    if output is not None:
+        output.close()
+        logging.info("wrote %d pictures to the output", output.frames)
+        output = None
+
+def decode_from_frame(h264file, frame, yuvfile=None):
+    """
+    Decode from the IDR picture before frame, using the NALU index sidecar
+    Args:
+        h264file: h264file name, should be using suffix .264 o .h264
+        frame: number of the picture in decoding order
+        yuvfile: .yuv or .y4m file for the decoded pictures, None shows them
+    """
+    global index
+    index = 0
+    open_output(yuvfile)
+    idx = nalu_index.open_index(h264file)
+    for nal_unit_type, nal_ref_idc, rbsp in nalu_index.iter_from_frame(h264file, idx, frame):
+        if nal_unit_type == nalutypes.NAL_UNIT_TYPE_SPS:
+            get_sps(rbsp)
+        elif nal_unit_type == nalutypes.NAL_UNIT_TYPE_PPS:
+            get_pps(rbsp)
+        elif nal_unit_type == nalutypes.NAL_UNIT_TYPE_AUD:
+            get_aud(rbsp)
+        elif (nal_unit_type == nalutypes.NAL_UNIT_TYPE_CODED_SLICE_NON_IDR or
+              nal_unit_type == nalutypes.NAL_UNIT_TYPE_CODED_SLICE_IDR):
+            get_slice(rbsp)
+    close_output()
+
+def main(h264file, yuvfile=None, skip_first=False):
     """
     Args:
         h264file: h264file name, should be using suffix .264 o .h264
+        yuvfile: .yuv or .y4m file for the decoded pictures, None shows them
+        skip_first: do not show the first slice, ignored when writing yuvfile
     """
+    global index
+    index = 0
+    open_output(yuvfile)
+
     # Test Case 1: use test data with one macroblock directly, hard code binary data
     # sps = BitStream('0x42c01edb02004190')
     # pps = BitStream('0xca83cb20')
@@ -85,14 +154,17 @@ def main(h264file):
 
     # Option1: use H264Parser to read file directly
     # TODO: something wrong with h264parser, need to fix later
-    h264parser = h26x_parser.H26xParser(h264file)
+    # NALUs reach the callbacks as memoryviews of the mapped file
+    h264parser = h26x_parser.H26xParser(h264file, use_mmap=True)
     #h264parser.set_callback("nalu", do_something)
     h264parser.set_callback("sps", get_sps)
     h264parser.set_callback("pps", get_pps)
     h264parser.set_callback("aud", get_aud)
-    h264parser.set_callback("slice", get_slice)
+    h264parser.set_callback("slice", lambda bytes: get_slice(bytes, skip_first))
     h264parser.set_callback("nalu", get_nalu)
     h264parser.parse()
+    h264parser.close()
+    close_output()
 
 if __name__ == '__main__':
     logging.basicConfig(
@@ -111,5 +183,7 @@ if __name__ == '__main__':
     temp = BitStream('0b01')
     temp2 = pow(2, leadingZeroBits) - 1 + temp.int
 
-    main("../test/BasketballPass_720p_P_16x16_without_Intra_4x4.264")
+    # the IDR picture of BasketballPass is not decoded, the P slices refer to keyframe-*.npy
+    main("../test/BasketballPass_720p_P_16x16_without_Intra_4x4.264", skip_first=True)
+    #main("../test/lena_x264_baseline_I_16x16.264", "lena.y4m")
     #main("E:/liumangxuxu/code/PyCodec/test/lena_x264_baseline_I_16x16.264")
\ No newline at end of file
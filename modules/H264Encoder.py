@@ -16,77 +16,58 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import prediction
-import matplotlib.pyplot as plt
 import numpy as np
 from numpy import r_
 import transform as tf
-import coding as cd
-from bitstring import BitStream, BitArray
+import cavlc
 import NaluStreamer as ns
+from bitwriter import BitWriter
 from h26x_extractor import nalutypes
 import logging
+import sys
 import yuv
+import tracing
 
 def encoding16x16UV(QP):
     """
-    Encode a 8x8 U、V block
+    Transform a 8x8 U、V block
     Args:
         QP: the QP value of quantization
     
     Returns:
-        encoding of current U、V macroblock
+        2x2 chroma DC levels of current U、V macroblock
     """
     block = np.full((8, 8), 0)   # set all UV to zero，TODO：pass in real UV value
 
     step = 4
-    result = BitStream()
-    size = block.shape
-
-    # step1: Get the DC element of each 4x4 block
-    DC_block = np.full((step, step), 0)
-    for i in r_[:size[0]:step]:
-        for j in r_[:size[1]:step]:
-            x = int(i/step)
-            y = int(j/step)
-            DC_block[x][y] = block[i, j]
-
-    # DC transorm coding
-    logging.debug("8x8 UV block's DC transorm coding")
-    dc_trans = tf.forwardHadamardAndScaling4x4(DC_block, QP)
-    dc_code = cd.CAVLC(dc_trans)
-    result.append(dc_code)
-
-    # step2: 4x4 transform, quantization and coding
-    current = np.full((step, step), 0)
-    for i in r_[:size[0]:step]:
-        for j in r_[:size[1]:step]:
 
-            current = block[i:(i+step), j:(j+step)]
-            logging.debug("4x4 UV block row %d column %d, pixel value:", i, j)
-            logging.debug(current)
+    # Get the DC element of each 4x4 block
+    DC_block = block[::step, ::step]
 
-            temp = tf.forwardTransformAndScaling4x4(current, QP)
-            logging.debug("coefficients:")
-            logging.debug(temp)
-            ac_code = cd.CAVLC(temp)
-            result.append(ac_code)
+    # DC transorm, with QPc as chroma_qp_index_offset of the PPS is 0
+    dc_trans = tf.forwardHadamardAndScaling2x2(DC_block, tf.getChromaQP(QP)).astype(int)
+    if tracing.ENCODER:
+        logging.debug("8x8 UV block's DC levels: %s", dc_trans)
 
-    return result
+    return dc_trans
 
-def encoding16x16(block, QP):
+def encoding16x16(block, QP, stream=None, grid=None, mb_row=0, mb_col=0):
     """
     Encode a 16x16 macroblock
     Args:
         block: 16x16 matrix block
         QP: the QP value of quantization
+        stream: BitWriter the residual is written to
+        grid: cavlc.TotalCoeffGrid of the picture, picks the coeff_token table of each block
+        mb_row, mb_col: the position of the macroblock in macroblocks
     
     Returns:
-        encoding of current macroblock
+        the BitWriter holding the residual of current macroblock, a new one when stream is None
     """
     size = block.shape
     step = 4
 
-    result = BitStream()
+    result = BitWriter() if stream is None else stream
 
     # step1: Get the DC element of each 4x4 block
     DC_block = np.full((step, step), 0)
@@ -96,37 +77,32 @@ def encoding16x16(block, QP):
             y = int(j/step)
             DC_block[x][y] = block[i, j]
 
-    # DC transorm coding
-    logging.debug("16x16 block's DC transorm coding")
-    dc_trans = tf.forwardHadamardAndScaling4x4(DC_block, QP)
-    dc_code = cd.CAVLC(dc_trans)
-    result.append(dc_code)
-
-    # step2: 4x4 transform, quantization and coding
-    current = np.full((step, step), 0)
-    for m in r_[:size[0]:8]:
-        for n in r_[:size[1]:8]:
-
-            for i in r_[:8:step]:
-                for j in r_[:8:step]:
-
-                    x = m + i
-                    y = n + j
-                    current = block[x:(x+step), y:(y+step)]
-                    logging.debug("4x4 block row %d column %d, pixel value:", x, y)
-                    logging.debug(current)
-
-                    temp = tf.forwardTransformAndScaling4x4(current, QP)
-                    logging.debug("coefficients:")
-                    logging.debug(temp)
-                    ac_code = cd.CAVLC(temp)
-                    result.append(ac_code)
-
-    # step3: UV coding
-    temp = encoding16x16UV(QP)  # U
-    result.append(temp)
-    temp = encoding16x16UV(QP)  # V
-    result.append(temp)
+    # DC transorm
+    if tracing.ENCODER:
+        logging.debug("16x16 block's DC transorm coding")
+    dc_trans = tf.forwardHadamardAndScaling4x4(DC_block, QP).astype(int)
+
+    # step2: 4x4 transform and quantization, [row, column] of the 4x4 blocks
+    ac_trans = np.zeros((step, step, step, step), int)
+    for x in r_[:size[0]:step]:
+        for y in r_[:size[1]:step]:
+            current = block[x:(x+step), y:(y+step)]
+            if tracing.ENCODER:
+                logging.debug("4x4 block row %d column %d, pixel value:", x, y)
+                logging.debug(current)
+
+            temp = tf.forwardTransformAndScaling4x4(current, QP)
+            if tracing.ENCODER:
+                logging.debug("coefficients:")
+                logging.debug(temp)
+            ac_trans[x//step, y//step] = temp
+
+    # step3: CAVLC of the luma DC and the AC blocks in luma4x4BlkIdx order
+    cavlc.encodeIntra16x16(result, dc_trans, ac_trans, grid=grid, mb_row=mb_row, mb_col=mb_col)
+
+    # step4: UV coding, chroma DC only as coded_block_pattern chroma is 1
+    chroma_dc = np.stack([encoding16x16UV(QP), encoding16x16UV(QP)])  # U, V
+    cavlc.encodeChroma(result, chroma_dc, grid=grid, mb_row=mb_row, mb_col=mb_col)
 
     return result
 
@@ -143,37 +119,44 @@ def encode(im, QP):
     predict, residual, mode_map = prediction.IntraPrediction(im, 16)  # 16x16 intra mode
 
     #according to page 133 Figure 8-6
-    totalMacro = BitStream()
+    totalMacro = BitWriter()
     step = 16
     imsize = residual.shape
+    grid = cavlc.TotalCoeffGrid(imsize[0], imsize[1])   # nA/nB of the coeff_token tables
     for i in r_[:imsize[0]:step]:
         for j in r_[:imsize[1]:step]:
 
-            logging.debug("16x16 block index row %d, column %d", i, j)
+            if tracing.ENCODER:
+                logging.debug("16x16 block index row %d, column %d", i, j)
 
             block16x16 = residual[i:(i+step), j:(j+step)]
-            macro = encoding16x16(block16x16, QP)
+            macro = encoding16x16(block16x16, QP, grid=grid, mb_row=i//step, mb_col=j//step)
 
             I_16x16_2_1_1 = 19   #temp code, TODO: should add some basic prediction type in nalutypes
             mb = ns.MacroblockLayer(I_16x16_2_1_1) #temp code, TODO: should use mode_map to reflect right predict mode
             mb.set__mb_pred(0) #temp code, should input right parameter of intra_chroma_pred_mode
             mb.set__residual(macro)
-            temp = mb.gen()
-
-            totalMacro.append(temp)
+            start = totalMacro.len
+            mb.gen(totalMacro)
 
-            logging.debug("16x16 block macroblock: %s", temp.bin)
-            logging.debug("-----------------------------------------")
+            if tracing.ENCODER:
+                logging.debug("16x16 block macroblock: %s", totalMacro.bin[start:])
+                logging.debug("-----------------------------------------")
 
     return totalMacro
 
-def main():
+def main(yuvfile=None, dims=(512, 512), numfrm=None):
     """
-    work on a keyframe, can just encode one keyframe right now
+    work on keyframes, every picture is coded as an IDR picture right now
+    Args:
+        yuvfile: raw YUV 4:2:0 input, each frame read by yuv.read_frames is encoded,
+            None encodes the lena2.tif picture
+        dims: (height, width) of the Y plane of yuvfile
+        numfrm: number of frames to encode, to the end of yuvfile by default
     """
     # step1, open the file
     f = "E:/temp/output/nalustreamer.264"
-    handler = ns.openNaluFile(f)
+    handler = ns.openNaluSink(f)   # NAL units are written by a background thread
 
     # step2, generate sps & pps
     sps = ns.SpsStreamer(nalutypes.NAL_UNIT_TYPE_SPS)
@@ -197,31 +180,36 @@ def main():
     pps.set__pic_init_qp_minus26(-3)
     pps.export(handler)
 
-    # step3, write a key frame
-    frame = ns.SliceHeader(nalutypes.NAL_UNIT_TYPE_CODED_SLICE_IDR, 7)  # TODO: slice type shoud be defined
-    temp = sps.get__log2_max_frame_num_minus4()
+    # step3, the pictures to encode
+    if yuvfile is None:
+        import matplotlib.pyplot as plt
+        pictures = [plt.imread("E:/liumangxuxu/code/PyCodec/modules/lena2.tif")]
+    else:
+        pictures = (Y for Y, U, V in yuv.read_frames(yuvfile, dims, numfrm=numfrm))
+
     slice_qp = 20
-    qp_base = pps.get__pic_init_qp_minus26()
-    qp_delta = slice_qp - 26 - qp_base
-    frame.set__slice_qp_delta(qp_delta)
-    frame.set__frame_num(temp, 0)
-    
-    frame.export(handler, pps)
-
-    # step4, write slice data
-    im = plt.imread("E:/liumangxuxu/code/PyCodec/modules/lena2.tif").astype(float)
-    # width = 512
-    # height = 512
-    # yuv_data = yuv.yuv_import('lena2.yuv', (height, width), 1, 0)
-    # im = yuv_data[0][0]
-    logging.debug(im)
-
-    residual = encode(im, slice_qp)   # currently we just support 16x16 prediction
-    coding = ns.SliceData()
-    coding.set__macroblock_layer(residual)
-    coding.export(handler)
-
-    # step5, close the file
+    for n, picture in enumerate(pictures):
+        im = picture.astype(float)
+        logging.debug(im)
+
+        # step4, write a key frame
+        frame = ns.SliceHeader(nalutypes.NAL_UNIT_TYPE_CODED_SLICE_IDR, 7)  # TODO: slice type shoud be defined
+        temp = sps.get__log2_max_frame_num_minus4()
+        qp_base = pps.get__pic_init_qp_minus26()
+        qp_delta = slice_qp - 26 - qp_base
+        frame.set__slice_qp_delta(qp_delta)
+        frame.set__frame_num(temp, 0)
+        frame.idr_pic_id = n % 2   # consecutive IDR pictures differ in idr_pic_id
+        frame.gen(pps)
+
+        # step5, write slice data
+        residual = encode(im, slice_qp)   # currently we just support 16x16 prediction
+        coding = ns.SliceData(frame)   # the slice header and data make one NAL unit
+        coding.set__macroblock_layer(residual)
+        coding.export(handler)
+        logging.info("encoded picture %d", n)
+
+    # step6, close the file
     ns.closeNaluFile(handler)
 
 if __name__ == '__main__':
@@ -234,5 +222,5 @@ if __name__ == '__main__':
         ]
     )
 
-    main()
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
     
\ No newline at end of file
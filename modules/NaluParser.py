@@ -26,10 +26,11 @@ import cavlc
 import numpy as np
 import copy
 import sys
-import matplotlib.pyplot as plt
 import transform
 import statistics
 import prediction
+import bitreader
+import tracing
 
 #class NaluResolver():
 #    def __init__(self):
@@ -42,28 +43,29 @@ class SpsParser():
         """
         Parse sps binary data, the input data should not include 0x00000001 start code
         Args:
-            spsNalu: BitStream data: 1. input sps data without 0x00000001 start code
+            spsNalu: BitStream, BitReader or bytes-like data:
+                                     1. input sps data without 0x00000001 start code
                                      2. the input data is rbsp_trailing_bits
         """
         logging.info("seq_parameter_set_rbsp()")
         logging.info("{")
         
-        stream = spsNalu
-        self.profile_idc = stream.read(8).uint # u(8)
-        self.constraint_set0_flag = stream.read(1).uint # u(1)
-        self.constraint_set1_flag = stream.read(1).uint # u(1)
-        self.constraint_set2_flag = stream.read(1).uint # u(1)
+        stream = bitreader.as_reader(spsNalu)
+        self.profile_idc = stream.u(8) # u(8)
+        self.constraint_set0_flag = stream.u(1) # u(1)
+        self.constraint_set1_flag = stream.u(1) # u(1)
+        self.constraint_set2_flag = stream.u(1) # u(1)
 
         logging.info("  profile_idc: %d", self.profile_idc)
         logging.info("  constraint_set0_flag: %s", "true" if self.constraint_set0_flag else "false")
         logging.info("  constraint_set1_flag: %s", "true" if self.constraint_set1_flag else "false")
         logging.info("  constraint_set2_flag: %s", "true" if self.constraint_set2_flag else "false")
 
-        self.reserved_zero_2bits = stream.read(5).bin    # u(5)
-        self.level_idc = stream.read(8).uint # u(8)
-        self.seq_parameter_set_id = stream.read('ue')  #ue(v)
-        self.log2_max_frame_num_minus4 = stream.read('ue') #ue(v)
-        self.pic_order_cnt_type = stream.read('ue') #ue(v)
+        self.reserved_zero_2bits = stream.u(5)    # u(5)
+        self.level_idc = stream.u(8) # u(8)
+        self.seq_parameter_set_id = stream.ue()  #ue(v)
+        self.log2_max_frame_num_minus4 = stream.ue() #ue(v)
+        self.pic_order_cnt_type = stream.ue() #ue(v)
 
         logging.info("  level_idc: %d", self.level_idc)
         logging.info("  seq_parameter_set_id: %d", self.seq_parameter_set_id)
@@ -71,13 +73,13 @@ class SpsParser():
         logging.info("  pic_order_cnt_type: %d", self.pic_order_cnt_type)
 
         if self.pic_order_cnt_type == 0:
-            self.log2_max_pic_order_cnt_lsb_minus4 = stream.read('ue')  #ue(v)
+            self.log2_max_pic_order_cnt_lsb_minus4 = stream.ue()  #ue(v)
             logging.info("  log2_max_pic_order_cnt_lsb_minus4: %d", self.log2_max_pic_order_cnt_lsb_minus4)
         elif self.pic_order_cnt_type == 1:
-            self.delta_pic_order_always_zero_flag = stream.read(1).uint # u(1)
-            self.offset_for_non_ref_pic = stream.read('se')
-            self.offset_for_top_to_bottom_field = stream.read('se')
-            self.num_ref_frames_in_pic_order_cnt_cycle = stream.read('ue')
+            self.delta_pic_order_always_zero_flag = stream.u(1) # u(1)
+            self.offset_for_non_ref_pic = stream.se()
+            self.offset_for_top_to_bottom_field = stream.se()
+            self.num_ref_frames_in_pic_order_cnt_cycle = stream.ue()
             logging.info("  delta_pic_order_always_zero_flag: %d", self.delta_pic_order_always_zero_flag)
             logging.info("  offset_for_non_ref_pic: %d", self.offset_for_non_ref_pic)
             logging.info("  offset_for_top_to_bottom_field: %d", self.offset_for_top_to_bottom_field)
@@ -85,14 +87,14 @@ class SpsParser():
 
             offset_for_ref_frame = []
             for i in range(self.num_ref_frames_in_pic_order_cnt_cycle):
-                offset_for_ref_frame[i] = stream.read('se')
+                offset_for_ref_frame[i] = stream.se()
                 self.offset_for_ref_frame = offset_for_ref_frame
 
-        self.num_ref_frames = stream.read('ue')
-        self.gaps_in_frame_num_value_allowed_flag = stream.read(1).uint
-        self.pic_width_in_mbs_minus1 = stream.read('ue')  #ue(v)
-        self.pic_height_in_map_units_minus1 = stream.read('ue')  #ue(v)
-        self.frame_mbs_only_flag = stream.read(1).uint
+        self.num_ref_frames = stream.ue()
+        self.gaps_in_frame_num_value_allowed_flag = stream.u(1)
+        self.pic_width_in_mbs_minus1 = stream.ue()  #ue(v)
+        self.pic_height_in_map_units_minus1 = stream.ue()  #ue(v)
+        self.frame_mbs_only_flag = stream.u(1)
         logging.info("  num_ref_frames: %d", self.num_ref_frames)
         logging.info("  gaps_in_frame_num_value_allowed_flag: %s", "true" if self.gaps_in_frame_num_value_allowed_flag else "false")
         logging.info("  pic_width_in_mbs_minus1: %d", self.pic_width_in_mbs_minus1)
@@ -104,22 +106,22 @@ class SpsParser():
         logging.info("  width: %d, height %d", self.PicWidthInSamples, self.PicHeightInSamples)
 
         if self.frame_mbs_only_flag == 0:
-            self.mb_adaptive_frame_field_flag = stream.read(1).uint
+            self.mb_adaptive_frame_field_flag = stream.u(1)
             logging.info("  mb_adaptive_frame_field_flag: %s", "true" if self.mb_adaptive_frame_field_flag else "false")
         else:
             self.mb_adaptive_frame_field_flag = 0
 
-        self.direct_8x8_inference_flag = stream.read(1).uint
-        self.frame_cropping_flag = stream.read(1).uint
+        self.direct_8x8_inference_flag = stream.u(1)
+        self.frame_cropping_flag = stream.u(1)
         logging.info("  direct_8x8_inference_flag: %s", "true" if self.direct_8x8_inference_flag else "false")
         logging.info("  frame_cropping_flag: %s", "true" if self.frame_cropping_flag else "false")
         if self.frame_cropping_flag:
-            self.frame_crop_left_offset = stream.read('ue')  #ue(v)
-            self.frame_crop_right_offset = stream.read('ue')  #ue(v)
-            self.frame_crop_top_offset = stream.read('ue')  #ue(v)
-            self.frame_crop_bottom_offset = stream.read('ue')  #ue(v)
+            self.frame_crop_left_offset = stream.ue()  #ue(v)
+            self.frame_crop_right_offset = stream.ue()  #ue(v)
+            self.frame_crop_top_offset = stream.ue()  #ue(v)
+            self.frame_crop_bottom_offset = stream.ue()  #ue(v)
 
-        self.vui_parameters_present_flag = stream.read(1).uint
+        self.vui_parameters_present_flag = stream.u(1)
         logging.info("  vui_parameters_present_flag: %s", "true" if self.vui_parameters_present_flag else "false")
         if self.vui_parameters_present_flag:
             self.vui_parameters()
@@ -143,58 +145,61 @@ class PpsParser():
         """
         Parse pps binary data, the input data should not include 0x00000001 start code
         Args:
-            ppsNalu: BitStream data: 1. input sps data without 0x00000001 start code
+            ppsNalu: BitStream, BitReader or bytes-like data:
+                                     1. input sps data without 0x00000001 start code
                                      2. the input data is rbsp_trailing_bits
         """
         logging.info("pic_parameter_set_rbsp()")
         logging.info("{")
         
-        stream = ppsNalu
+        stream = bitreader.as_reader(ppsNalu)
 
-        self.pic_parameter_set_id = stream.read('ue') #ue(v)
-        self.seq_parameter_set_id = stream.read('ue') #ue(v)
-        self.entropy_coding_mode_flag = stream.read(1).uint
-        self.pic_order_present_flag = stream.read(1).uint
+        self.pic_parameter_set_id = stream.ue() #ue(v)
+        self.seq_parameter_set_id = stream.ue() #ue(v)
+        self.entropy_coding_mode_flag = stream.u(1)
+        self.pic_order_present_flag = stream.u(1)
         logging.info("  pic_parameter_set_id: %d", self.pic_parameter_set_id)
         logging.info("  seq_parameter_set_id: %d", self.seq_parameter_set_id)
         logging.info("  entropy_coding_mode_flag: %s", "true" if self.entropy_coding_mode_flag else "false")
         logging.info("  pic_order_present_flag: %s", "true" if self.pic_order_present_flag else "false")
+        if self.entropy_coding_mode_flag:
+            raise ValueError("CABAC (entropy_coding_mode_flag=1) is not supported, only CAVLC streams can be decoded")
 
-        self.num_slice_groups_minus1 = stream.read('ue') #ue(v)
+        self.num_slice_groups_minus1 = stream.ue() #ue(v)
         logging.info("  num_slice_groups_minus1: %d", self.num_slice_groups_minus1)
 
         if self.num_slice_groups_minus1 > 0:
-            self.slice_group_map_type = stream.read('ue')
+            self.slice_group_map_type = stream.ue()
             # TODO: add more branch here
 
-        self.num_ref_idx_l0_active_minus1 = stream.read('ue') #ue(v)
+        self.num_ref_idx_l0_active_minus1 = stream.ue() #ue(v)
         logging.info("  num_ref_idx_l0_active_minus1: %d", self.num_ref_idx_l0_active_minus1)
 
-        self.num_ref_idx_l1_active_minus1 = stream.read('ue') #ue(v)
+        self.num_ref_idx_l1_active_minus1 = stream.ue() #ue(v)
         logging.info("  num_ref_idx_l1_active_minus1: %d", self.num_ref_idx_l1_active_minus1)
 
-        self.weighted_pred_flag = stream.read(1).uint
+        self.weighted_pred_flag = stream.u(1)
         logging.info("  weighted_pred_flag: %s", "true" if self.weighted_pred_flag else "false")
 
-        self.weighted_bipred_idc = stream.read(2).uint
+        self.weighted_bipred_idc = stream.u(2)
         logging.info("  weighted_bipred_idc: %d", self.weighted_bipred_idc)
 
-        self.pic_init_qp_minus26 = stream.read('se') #se(v)
+        self.pic_init_qp_minus26 = stream.se() #se(v)
         logging.info("  pic_init_qp_minus26: %d", self.pic_init_qp_minus26)
 
-        self.pic_init_qs_minus26  = stream.read('se') #se(v)
+        self.pic_init_qs_minus26  = stream.se() #se(v)
         logging.info("  pic_init_qs_minus26: %d", self.pic_init_qs_minus26)
 
-        self.chroma_qp_index_offset  = stream.read('se') #se(v)
+        self.chroma_qp_index_offset  = stream.se() #se(v)
         logging.info("  chroma_qp_index_offset: %d", self.chroma_qp_index_offset)
 
-        self.deblocking_filter_control_present_flag = stream.read(1).uint
+        self.deblocking_filter_control_present_flag = stream.u(1)
         logging.info("  deblocking_filter_control_present_flag: %s", "true" if self.deblocking_filter_control_present_flag else "false")
 
-        self.constrained_intra_pred_flag = stream.read(1).uint
+        self.constrained_intra_pred_flag = stream.u(1)
         logging.info("  constrained_intra_pred_flag: %s", "true" if self.constrained_intra_pred_flag else "false")
 
-        self.redundant_pic_cnt_present_flag = stream.read(1).uint
+        self.redundant_pic_cnt_present_flag = stream.u(1)
         logging.info("  redundant_pic_cnt_present_flag: %s", "true" if self.redundant_pic_cnt_present_flag else "false")
 
         logging.info("}")
@@ -208,7 +213,8 @@ class NalParser():
         """
         Parse nalu binary data, the input data should not include 0x00000001 start code
         Args:
-            NaluUnit: BitStream data: 1. input sps data without 0x00000001 start code
+            NaluUnit: BitStream, BitReader or bytes-like data:
+                                      1. input sps data without 0x00000001 start code
                                       2. the input data is rbsp_trailing_bits
             spsParser: the sps of current sequence, should be type of SpsParser
             ppsParser: the pps of curretn sequence, should be type of PpsParser
@@ -220,29 +226,29 @@ class NalParser():
         logging.info("slice_header()")
         logging.info("{")
         
-        self.stream = NaluUnit
+        self.stream = bitreader.as_reader(NaluUnit)
         self.sps = SPS
         self.pps = PPS
 
         #slice_header
-        self.first_mb_in_slice = self.stream.read('ue') #ue(v)
+        self.first_mb_in_slice = self.stream.ue() #ue(v)
         logging.info("  first_mb_in_slice: %d", self.first_mb_in_slice)
 
-        self.slice_type = self.stream.read('ue') #ue(v)
+        self.slice_type = self.stream.ue() #ue(v)
         logging.info("  slice_type: %s", H264Types.slice_type(self.slice_type))
 
-        self.pic_parameter_set_id = self.stream.read('ue') #ue(v)
+        self.pic_parameter_set_id = self.stream.ue() #ue(v)
         logging.info("  pic_parameter_set_id: %d", self.pic_parameter_set_id)
 
         length = SPS.log2_max_frame_num_minus4 + 4
-        self.frame_num = self.stream.read(length).uint
+        self.frame_num = self.stream.u(length)
         logging.info("  frame_num: %d", self.frame_num)
 
         if not SPS.frame_mbs_only_flag:
-            self.field_pic_flag = self.stream.read(1).uint
+            self.field_pic_flag = self.stream.u(1)
             logging.info("  field_pic_flag: %d", self.field_pic_flag)
             if self.field_pic_flag:
-                self.bottom_field_flag = self.stream.read(1).uint
+                self.bottom_field_flag = self.stream.u(1)
                 logging.info("  bottom_field_flag: %d", self.bottom_field_flag)
 
         #hard code for nal_unit_type, temp code
@@ -253,19 +259,19 @@ class NalParser():
             nal_unit_type = 1
 
         if nal_unit_type == 5:
-            self.idr_pic_id = self.stream.read('ue') #ue(v)
+            self.idr_pic_id = self.stream.ue() #ue(v)
             logging.info("  idr_pic_id: %d", self.idr_pic_id)
 
         if self.slice_type == H264Types.slice_type.p5.value:
-            self.num_ref_idx_active_override_flag = self.stream.read('uint:1')
+            self.num_ref_idx_active_override_flag = self.stream.u(1)
             logging.info("  num_ref_idx_active_override_flag: %d", self.num_ref_idx_active_override_flag)
             if self.num_ref_idx_active_override_flag:
-                self.num_ref_idx_l0_active_minus1 = self.stream.read('ue')
+                self.num_ref_idx_l0_active_minus1 = self.stream.ue()
                 logging.info("  num_ref_idx_l0_active_minus1: %d", self.num_ref_idx_l0_active_minus1)
 
         # ref_pic_list_reordering( )
         if self.slice_type != H264Types.slice_type.I7.value and self.slice_type != H264Types.slice_type.SI.value:
-            self.ref_pic_list_reordering_flag_l0 = self.stream.read('uint:1')
+            self.ref_pic_list_reordering_flag_l0 = self.stream.u(1)
             logging.info("  ref_pic_list_reordering_flag_l0: %d", self.ref_pic_list_reordering_flag_l0)
             if self.ref_pic_list_reordering_flag_l0:
                 logging.error("  This part is not supported yet!")
@@ -278,34 +284,34 @@ class NalParser():
             nal_ref_idc = 0
         if nal_ref_idc!=0:
             if nal_unit_type == 5:
-                self.no_output_of_prior_pics_flag = self.stream.read(1).uint
-                self.long_term_reference_flag = self.stream.read(1).uint
+                self.no_output_of_prior_pics_flag = self.stream.u(1)
+                self.long_term_reference_flag = self.stream.u(1)
                 logging.info("  no_output_of_prior_pics_flag: %s", "true" if self.no_output_of_prior_pics_flag else "false")
                 logging.info("  long_term_reference_flag: %s", "true" if self.long_term_reference_flag else "false")
             else:
-                self.adaptive_ref_pic_marking_mode_flag = self.stream.read(1).uint
+                self.adaptive_ref_pic_marking_mode_flag = self.stream.u(1)
                 if self.adaptive_ref_pic_marking_mode_flag:
                     logging.error("  adaptive_ref_pic_marking_mode_flag part is not support yet!")
 
         # if PPS.entropy_coding_mode_flag and (self.slice_type!=H264Types.slice_type('I') or self.slice_type!=H264Types.slice_type('I7'))
         #    and (self.slice_type!=H264Types.slice_type('SI') or self.slice_type!=H264Types.slice_type('SI9')):
         if PPS.entropy_coding_mode_flag:
-           self.cabac_init_idc = self.stream.read('ue') #ue(v)
+           self.cabac_init_idc = self.stream.ue() #ue(v)
            logging.info("  cabac_init_idc: %d", self.cabac_init_idc)
 
-        self.slice_qp_delta = self.stream.read('se') #se(v)
+        self.slice_qp_delta = self.stream.se() #se(v)
         logging.info("  slice_qp_delta: %d", self.slice_qp_delta)
         self.SliceQPy = 26 + self.pps.pic_init_qp_minus26 + self.slice_qp_delta
         logging.info("  Slice QP: %d", self.SliceQPy)
 
         if PPS.deblocking_filter_control_present_flag:
-            self.disable_deblocking_filter_idc = self.stream.read('ue') #ue(v)
+            self.disable_deblocking_filter_idc = self.stream.ue() #ue(v)
             logging.info("  disable_deblocking_filter_idc: %d", self.disable_deblocking_filter_idc)
             if self.disable_deblocking_filter_idc != 1:
-                self.slice_alpha_c0_offset_div2 = self.stream.read('se') #se(v)
+                self.slice_alpha_c0_offset_div2 = self.stream.se() #se(v)
                 logging.info("  slice_alpha_c0_offset_div2: %d", self.slice_alpha_c0_offset_div2)
 
-                self.slice_beta_offset_div2 = self.stream.read('se') #se(v)
+                self.slice_beta_offset_div2 = self.stream.se() #se(v)
                 logging.info("  slice_beta_offset_div2: %d", self.slice_beta_offset_div2)
         
         logging.info("}")
@@ -329,9 +335,10 @@ class NalParser():
         """
         do slice_data() part of H.264 standard
         """
-        logging.debug("slice data: %s", self.stream.peek(32))   # check the start data of slice_data
+        if tracing.NALU:
+            logging.debug("slice data: %s", self.stream.peek_bin(32))   # check the start data of slice_data
         if self.pps.entropy_coding_mode_flag:
-            self.cabac_alignment_one_bit = self.stream.read(1)   #TODO: not verify the validity
+            self.cabac_alignment_one_bit = self.stream.u(1)   #TODO: not verify the validity
 
         # based on page 62 of ITU-T Recommendation H.264 05/2003 edition
         MbaffFrameFlag = ( self.sps.mb_adaptive_frame_field_flag and (not self.field_pic_flag) )
@@ -341,14 +348,15 @@ class NalParser():
 
         width = int(self.sps.getWidth())
         height = int(self.sps.getHeight())
-        self.coefficients = np.zeros((height, width), int)
-        self.residual = np.zeros((height, width), int)
-        self.modemap = np.zeros((height, width), int)
-        self.nAnB = np.zeros((int(height/4), int(width/4)), int)
-        self.nAnB_UV = np.zeros((2, int(height/8), int(width/8)), int)
+        # frame state: per-pixel levels and residuals, per-macroblock and per-4x4 grids of side information
+        self.coefficients = np.zeros((height, width), np.int16)
+        self.residual = np.zeros((height, width), np.int16)
+        self.modemap = np.zeros((int(height/16), int(width/16)), np.int8)   # Intra16x16PredMode of each macroblock
+        self.nAnB = np.zeros((int(height/4), int(width/4)), np.int8)    # TotalCoeff of each 4x4 block
+        self.nAnB_UV = np.zeros((2, int(height/8), int(width/8)), np.int8)
 
-        self.mvd = np.zeros((int(height/16), int(width/16), 2), int)  # just support 16x16 macroblock
-        self.mv  = np.zeros((int(height/16), int(width/16), 2), int)  # just support 16x16 macroblock
+        self.mvd = np.zeros((int(height/16), int(width/16), 2), np.int16)  # just support 16x16 macroblock
+        self.mv  = np.zeros((int(height/16), int(width/16), 2), np.int16)  # just support 16x16 macroblock
 
         self.blk16x16Idx_x = 0   # x position of 16x16 block in this frame
         self.blk16x16Idx_y = 0   # y position of 16x16 block in this frame
@@ -361,13 +369,15 @@ class NalParser():
 
         while moreDataFlag:
 
-            logging.debug("----------------------------------------")
-            logging.debug("macroblockIdx: %d", macroblockIdx)
+            if tracing.NALU:
+                logging.debug("----------------------------------------")
+                logging.debug("macroblockIdx: %d", macroblockIdx)
 
             if self.slice_type != H264Types.slice_type.I7.value and self.slice_type != H264Types.slice_type.I.value:
                 if not self.pps.entropy_coding_mode_flag:
-                    mb_skip_run = self.stream.read('ue')
-                    logging.debug("mb_skip_run: %d", mb_skip_run)
+                    mb_skip_run = self.stream.ue()
+                    if tracing.NALU:
+                        logging.debug("mb_skip_run: %d", mb_skip_run)
                     prevMbSkipped = (mb_skip_run>0)
 
                     if mb_skip_run>0:
@@ -377,8 +387,9 @@ class NalParser():
                             self.__set_P_skip_macroblock()
 
                             macroblockIdx = macroblockIdx + 1
-                            logging.debug("----------------------------------------")
-                            logging.debug("macroblockIdx: %d", macroblockIdx)
+                            if tracing.NALU:
+                                logging.debug("----------------------------------------")
+                                logging.debug("macroblockIdx: %d", macroblockIdx)
 
                             self.blk16x16Idx_x = self.blk16x16Idx_x + 1
                             if self.blk16x16Idx_x >= row_block_num:
@@ -387,7 +398,7 @@ class NalParser():
 
             if moreDataFlag:
                 if( MbaffFrameFlag and ( CurrMbAddr%2==0 or (CurrMbAddr%2==1 and prevMbSkipped) ) ):
-                    self.mb_field_decoding_flag = self.stream.read('uint:1')
+                    self.mb_field_decoding_flag = self.stream.u(1)
                 else:
                     self.mb_field_decoding_flag = 0   # more complex situation
                 
@@ -419,7 +430,7 @@ class NalParser():
         """
         startPos = self.stream.pos
         self.__show_binary_fragment()
-        self.mb_type = self.stream.read('ue') #ue(v)
+        self.mb_type = self.stream.ue() #ue(v)
 
         self.MbPartPredMode = 'na'
         self.name_of_mb_type = 'na'
@@ -440,10 +451,11 @@ class NalParser():
                 self.MbPartPredMode = H264Types.I_slice_Macroblock_types[self.mb_type-5][1]
                 self.NumMbPart = 1 #TODO: temp value
 
-        logging.debug("macroblock_layer(){")
-        logging.debug("  mb_type: %d", self.mb_type)
-        logging.debug("  name of mb_type: %s", self.name_of_mb_type)
-        logging.debug("  MbPartPredMode: %s", self.MbPartPredMode)
+        if tracing.NALU:
+            logging.debug("macroblock_layer(){")
+            logging.debug("  mb_type: %d", self.mb_type)
+            logging.debug("  name of mb_type: %s", self.name_of_mb_type)
+            logging.debug("  MbPartPredMode: %s", self.MbPartPredMode)
 
         if self.name_of_mb_type == 'I_PCM':
             logging.error("Not support I_PCM mb_type yet!")
@@ -458,11 +470,9 @@ class NalParser():
             #self.stream.read('bits:26')
             #logging.debug("temp4 body: %s", self.stream.peek(64).bin)
             if self.MbPartPredMode != 'Intra_16x16' :
-                if self.pps.entropy_coding_mode_flag == 0:
-                    coded_block_pattern = self.__read_me()
-                else:
-                    coded_block_pattern = self.stream.read('ae')
-                logging.debug("  coded_block_pattern: %d", coded_block_pattern)
+                coded_block_pattern = self.__read_me()   # me(v), CABAC streams are rejected by PpsParser
+                if tracing.NALU:
+                    logging.debug("  coded_block_pattern: %d", coded_block_pattern)
                 self.CodedBlockPatternLuma = coded_block_pattern % 16
                 self.CodedBlockPatternChroma = coded_block_pattern // 16
             else:
@@ -470,25 +480,26 @@ class NalParser():
                 self.CodedBlockPatternChroma = H264Types.get_I_slice_CodedBlockPatternChroma(self.mb_type)
                 self.CodedBlockPatternLuma = H264Types.get_I_slice_CodedBlockPatternLuma(self.mb_type)
 
-        logging.debug("  CodedBlockPatternLuma: %d", self.CodedBlockPatternLuma)
-        logging.debug("  CodedBlockPatternChroma: %d", self.CodedBlockPatternChroma)
-
-        logging.debug("}")
+        if tracing.NALU:
+            logging.debug("  CodedBlockPatternLuma: %d", self.CodedBlockPatternLuma)
+            logging.debug("  CodedBlockPatternChroma: %d", self.CodedBlockPatternChroma)
+            logging.debug("}")
 
         if (self.CodedBlockPatternLuma>0 or self.CodedBlockPatternChroma>0 or 
             self.MbPartPredMode == 'Intra_16x16'):
-            self.mb_qp_delta = self.stream.read('se')
-            logging.debug("  mb_qp_delta: %d", self.mb_qp_delta)
+            self.mb_qp_delta = self.stream.se()
+            if tracing.NALU:
+                logging.debug("  mb_qp_delta: %d", self.mb_qp_delta)
             #TODO: seems has some bug in below QP calculating
             self.mb_current_qp = (self.SliceQPy + self.mb_qp_delta + 52) % 52 # the QP of current macroblock
-            logging.debug("  the value of QPY in the macroblock layer: %d", self.mb_current_qp)
+            if tracing.NALU:
+                logging.debug("  the value of QPY in the macroblock layer: %d", self.mb_current_qp)
 
-            residual_header = self.stream[startPos: self.stream.pos]
-            startPos = self.stream.pos
+            residualPos = self.stream.pos
             self.__residual()
-            logging.debug("residual header: %s", residual_header.bin) 
-            residual_body = self.stream[startPos: self.stream.pos]
-            logging.debug("residual body: %s", residual_body.bin)
+            if tracing.NALU:
+                logging.debug("residual header: %s", self.stream[startPos: residualPos].bin)
+                logging.debug("residual body: %s", self.stream[residualPos: self.stream.pos].bin)
 
     def __mb_pred(self):
         """
@@ -498,8 +509,9 @@ class NalParser():
             #TODO: add Intra_4x4 part
             if self.MbPartPredMode == 'Intra_4x4':
                 logging.error("Not support Intra_4x4 mb_pred subroutine yet!")
-            self.intra_chroma_pred_mode = self.stream.read('ue')
-            logging.debug("intra_chroma_pred_mode: %d", self.intra_chroma_pred_mode)
+            self.intra_chroma_pred_mode = self.stream.ue()
+            if tracing.NALU:
+                logging.debug("intra_chroma_pred_mode: %d", self.intra_chroma_pred_mode)
         elif self.MbPartPredMode != 'Direct':
             ref_idx_l0 = []
 
@@ -508,22 +520,25 @@ class NalParser():
                     self.MbPartPredMode != 'Pred_L1'):
                     temp = self.__read_te()
                     ref_idx_l0.append(temp)
-                    logging.debug("ref_idx_l0[%d]: %d", mbPartIdx, temp)
+                    if tracing.NALU:
+                        logging.debug("ref_idx_l0[%d]: %d", mbPartIdx, temp)
                 else:
                     ref_idx_l0.append(0)
-                    logging.debug("ref_idx_l0[0]: %d", ref_idx_l0[0])
+                    if tracing.NALU:
+                        logging.debug("ref_idx_l0[0]: %d", ref_idx_l0[0])
 
             self.__show_binary_fragment()
 
             mvd_l0 = [0, 0]   # hard code for 16x16 macroblock
             for compIdx in range(0, 2):
                 if self.pps.entropy_coding_mode_flag == 0:
-                    #mvd_l0[0][0][compIdx] = self.stream.read('se')
-                    mvd_l0[compIdx] = self.stream.read('se')
+                    #mvd_l0[0][0][compIdx] = self.stream.se()
+                    mvd_l0[compIdx] = self.stream.se()
                 else:
                     #mvd_l0[0][0][compIdx] = self.stream.read('ae')
                     mvd_l0[compIdx] = self.stream.peek(64)
-            logging.debug("mvd_l0: %s", mvd_l0)
+            if tracing.NALU:
+                logging.debug("mvd_l0: %s", mvd_l0)
             self.__set_motion_vector(mvd_l0)
 
     def __sub_mb_pred(self):
@@ -533,14 +548,15 @@ class NalParser():
         """
         sub_mb_type = []
         for mbPartIdx in range(0, 4):
-            temp = self.stream.read('ue') #ue(v)
+            temp = self.stream.ue() #ue(v)
             sub_mb_type.append(temp)
 
         ref_idx_l0 = []
         if self.MbPartPredMode == 'P_8x8ref0':
             for mbPartIdx in range(0, self.NumMbPart):
                 ref_idx_l0.append(0)
-                logging.debug("ref_idx_l0[%d]: %d", mbPartIdx, 0)
+                if tracing.NALU:
+                    logging.debug("ref_idx_l0[%d]: %d", mbPartIdx, 0)
 
     def __residual(self):
         """
@@ -552,19 +568,19 @@ class NalParser():
         # dump luma block to image
         if self.MbPartPredMode == 'Intra_16x16':
             coeffBlock_16x16, residual_16x16 = self.__residual_block_Intra16x16()
-            self.coefficients[row:(row+16), col:(col+16)] = copy.deepcopy(coeffBlock_16x16)
-            self.modemap[row:(row+16), col:(col+16)] = H264Types.get_I_slice_Intra16x16PredMode(self.mb_type)[0]
-            self.residual[row:(row+16), col:(col+16)] = copy.deepcopy(residual_16x16)
+            self.coefficients[row:(row+16), col:(col+16)] = coeffBlock_16x16
+            self.modemap[self.blk16x16Idx_y, self.blk16x16Idx_x] = H264Types.get_I_slice_Intra16x16PredMode(self.mb_type)[0]
+            self.residual[row:(row+16), col:(col+16)] = residual_16x16
         else:
             coeffBlock_16x16, residual_16x16 = self.__residual_block_LumaLevel()
-            self.coefficients[row:(row+16), col:(col+16)] = copy.deepcopy(coeffBlock_16x16)
-            self.residual[row:(row+16), col:(col+16)] = copy.deepcopy(residual_16x16)
+            self.coefficients[row:(row+16), col:(col+16)] = coeffBlock_16x16
+            self.residual[row:(row+16), col:(col+16)] = residual_16x16
 
-        logging.debug("Reconstructed 16x16 coefficients:")
-        logging.debug("\n%s", coeffBlock_16x16)
-
-        logging.debug("Reconstructed 16x16 residual:")
-        logging.debug("\n%s", residual_16x16)
+        if tracing.NALU:
+            logging.debug("Reconstructed 16x16 coefficients:")
+            logging.debug("\n%s", coeffBlock_16x16)
+            logging.debug("Reconstructed 16x16 residual:")
+            logging.debug("\n%s", residual_16x16)
 
         #logging.debug("Reconstructed image coefficients:")
         #logging.debug("\n%s", coefficients)
@@ -574,20 +590,20 @@ class NalParser():
         ChromaDCLevel = np.zeros((2, 2, 2), int)
 
         # chroma DC level, accroding to page 75 on [H.264 standard Book]
-        logging.debug("Decoding Chroma DC level")
+        if tracing.NALU:
+            logging.debug("Decoding Chroma DC level")
         self.__show_binary_fragment()
 
         for i in range(0, 2):
             if self.CodedBlockPatternChroma&3:
-                blocks = self.stream[self.stream.pos: self.stream.len]
-                ChromaDCLevel[i], position, temp = cavlc.decode(blocks, -1, 4)
-                temp = self.stream.read(position)   # drop the decoded data
-                logging.debug("processed data: %s", temp.bin)
-                logging.debug("ChromaDCLevel_%d:", i)
-                logging.debug("\n%s" % (ChromaDCLevel[i]))
+                ChromaDCLevel[i], position, temp = cavlc.decode(self.stream, -1, 4)
+                if tracing.NALU:
+                    logging.debug("ChromaDCLevel_%d:", i)
+                    logging.debug("\n%s" % (ChromaDCLevel[i]))
             else:
                 # two DC are zeros, already zeros, do nothing
-                logging.debug("Two Chroma DC are zeros")
+                if tracing.NALU:
+                    logging.debug("Two Chroma DC are zeros")
 
         if self.CodedBlockPatternChroma&2:
             for m in range(0, 2):   # cb & cr
@@ -596,21 +612,20 @@ class NalParser():
                 for i in range(0, 2):
                     for j in range(0, 2):
                         #different nC
-                        logging.debug("decoding blockInx: %d, nC: %d", chroma4x4BlkIdx, nC)
+                        if tracing.NALU:
+                            logging.debug("decoding blockInx: %d, nC: %d", chroma4x4BlkIdx, nC)
 
                         abs_row = self.blk16x16Idx_y*2 + i
                         abs_col = self.blk16x16Idx_x*2 + j
-                        logging.debug("row, col in nAnB_UV matrix: %d, %d", abs_row, abs_col)
+                        if tracing.NALU:
+                            logging.debug("row, col in nAnB_UV matrix: %d, %d", abs_row, abs_col)
                         nC = self.__get_nC_UV(m, abs_row, abs_col)
                         
                         self.__show_binary_fragment()
-                        blocks = self.stream[self.stream.pos: self.stream.len]
-                        Chroma4x4ACLevel, position, self.nAnB_UV[m][abs_row,abs_col] = cavlc.decode(blocks, nC, 15)
-
-                        temp = self.stream.read(position)   # drop the decoded data
-                        logging.debug("processed data: %s", temp.bin)
-                        logging.debug("Chroma4x4ACLevel_%d:", chroma4x4BlkIdx)
-                        logging.debug("\n%s" % (Chroma4x4ACLevel))
+                        Chroma4x4ACLevel, position, self.nAnB_UV[m][abs_row,abs_col] = cavlc.decode(self.stream, nC, 15)
+                        if tracing.NALU:
+                            logging.debug("Chroma4x4ACLevel_%d:", chroma4x4BlkIdx)
+                            logging.debug("\n%s" % (Chroma4x4ACLevel))
 
                         Chroma4x4ACLevel[0, 0] = ChromaDCLevel[m][i, j]
                         UV_plane_16x16[m][i*4:(i*4+4), j*4:(j*4+4)] = copy.deepcopy(Chroma4x4ACLevel)
@@ -618,18 +633,19 @@ class NalParser():
                         chroma4x4BlkIdx = chroma4x4BlkIdx + 1
         else:
             # two 8x8 AC are zeros
-            logging.debug("Two Chroma 8x8 AC are zeros")
+            if tracing.NALU:
+                logging.debug("Two Chroma 8x8 AC are zeros")
             # replace DC element
             for m in range(0, 2):   # cb & cr
                 for i in range(0, 2):
                     for j in range(0, 2):
                         UV_plane_16x16[m][i*4, j*4] = ChromaDCLevel[m][i, j]
 
-        logging.debug("Reconstructed 8x8 U plane coefficients:")
-        logging.debug("\n%s", UV_plane_16x16[0])
-
-        logging.debug("Reconstructed 8x8 V plane coefficients:")
-        logging.debug("\n%s", UV_plane_16x16[1])
+        if tracing.NALU:
+            logging.debug("Reconstructed 8x8 U plane coefficients:")
+            logging.debug("\n%s", UV_plane_16x16[0])
+            logging.debug("Reconstructed 8x8 V plane coefficients:")
+            logging.debug("\n%s", UV_plane_16x16[1])
 
     def __residual_block_Intra16x16(self):
         """
@@ -641,22 +657,23 @@ class NalParser():
         #logging.debug("\n%s" % (self.nAnB[0:4, 0:4]))
 
         nC = self.__get_nC(self.blk16x16Idx_y*4, self.blk16x16Idx_x*4)
-        logging.debug("  blk16x16Idx_x: %d, blk16x16Idx_y: %d, nC: %d", self.blk16x16Idx_x, self.blk16x16Idx_y, nC)
+        if tracing.NALU:
+            logging.debug("  blk16x16Idx_x: %d, blk16x16Idx_y: %d, nC: %d", self.blk16x16Idx_x, self.blk16x16Idx_y, nC)
         
-        blocks = self.stream[self.stream.pos: self.stream.len]
-        Intra16x16DCLevel, position, temp = cavlc.decode(blocks, nC, 16)
-        temp = self.stream.read(position)   # drop the decoded data
-        logging.debug("processed data: %s", temp.bin)
-        logging.debug("Intra16x16DCLevel: %s", Intra16x16DCLevel)
+        Intra16x16DCLevel, position, temp = cavlc.decode(self.stream, nC, 16)
+        if tracing.NALU:
+            logging.debug("Intra16x16DCLevel: %s", Intra16x16DCLevel)
         
         # do DC level transform
         residual_lumDC = transform.inverseIntra16x16LumaDCScalingAndTransform(Intra16x16DCLevel, self.mb_current_qp)
-        logging.debug("residual_lumDC: %s", residual_lumDC)
+        if tracing.NALU:
+            logging.debug("residual_lumDC: %s", residual_lumDC)
 
         coeffBlock_16x16 = np.zeros((16, 16), int)
         residual_16x16 = np.zeros((16, 16), int)
 
         if self.CodedBlockPatternLuma>0:
+            ACLevels = np.zeros((4, 4, 4, 4), int)  # [x, y] is the 4x4 block at row x, column y
             luma4x4BlkIdx = 0
             for m in range(0, 2):
                 for n in range(0, 2):
@@ -668,28 +685,26 @@ class NalParser():
                             abs_row = self.blk16x16Idx_y*4 + x
                             abs_col = self.blk16x16Idx_x*4 + y
                             nC = self.__get_nC(abs_row, abs_col)
-                            logging.debug("decoding blockInx: %d, nC: %d", luma4x4BlkIdx, nC)
-                            logging.debug("row, col in nAnB matrix: %d, %d", abs_row, abs_col)
+                            if tracing.NALU:
+                                logging.debug("decoding blockInx: %d, nC: %d", luma4x4BlkIdx, nC)
+                                logging.debug("row, col in nAnB matrix: %d, %d", abs_row, abs_col)
                             
                             self.__show_binary_fragment()
-                            blocks = self.stream[self.stream.pos: self.stream.len]
-                            Intra4x4ACLevel, position, self.nAnB[abs_row,abs_col] = cavlc.decode(blocks, nC, 15)
-
-                            temp = self.stream.read(position)   # drop the decoded data
-                            logging.debug("processed data: %s", temp.bin)
-                            logging.debug("Intra16x16ACLevel_%d:", luma4x4BlkIdx)
+                            Intra4x4ACLevel, position, self.nAnB[abs_row,abs_col] = cavlc.decode(self.stream, nC, 15)
+                            if tracing.NALU:
+                                logging.debug("Intra16x16ACLevel_%d:", luma4x4BlkIdx)
                             #logging.debug("\n%s" % (Intra4x4ACLevel))
 
-                            coeffBlock_16x16[x*4:(x*4+4), y*4:(y*4+4)] = copy.deepcopy(Intra4x4ACLevel)
-
-                            #do AC level transform
-                            temp4x4ACLevel = copy.deepcopy(Intra4x4ACLevel.astype(int))
-                            temp4x4ACLevel[0, 0] = residual_lumDC[x, y]
-                            residualAC = transform.inverseReidual4x4ScalingAndTransform(temp4x4ACLevel, self.mb_current_qp)
-                            residual_16x16[x*4:(x*4+4), y*4:(y*4+4)] = copy.deepcopy(residualAC)
+                            coeffBlock_16x16[x*4:(x*4+4), y*4:(y*4+4)] = Intra4x4ACLevel
+                            ACLevels[x, y] = Intra4x4ACLevel
 
                             luma4x4BlkIdx = luma4x4BlkIdx + 1
 
+            #do AC level transform of the 16 blocks at once
+            ACLevels[:, :, 0, 0] = residual_lumDC
+            residualAC = transform.inverseResidual4x4ScalingAndTransformBatch(ACLevels.reshape(16, 4, 4), self.mb_current_qp)
+            residual_16x16 = residualAC.reshape(4, 4, 4, 4).swapaxes(1, 2).reshape(16, 16)
+
         for i in range(0, 4):
             for j in range(0, 4):
                 coeffBlock_16x16[i*4, j*4] = Intra16x16DCLevel[i, j]
@@ -705,7 +720,8 @@ class NalParser():
         #logging.debug("\n%s" % (self.nAnB[0:4, 0:4]))
 
         nC = self.__get_nC(self.blk16x16Idx_y*4, self.blk16x16Idx_x*4)
-        logging.debug("  blk16x16Idx_x: %d, blk16x16Idx_y: %d, nC: %d", self.blk16x16Idx_x, self.blk16x16Idx_y, nC)
+        if tracing.NALU:
+            logging.debug("  blk16x16Idx_x: %d, blk16x16Idx_y: %d, nC: %d", self.blk16x16Idx_x, self.blk16x16Idx_y, nC)
         
         coeffBlock_16x16 = np.zeros((16, 16), int)
         residual_16x16 = np.zeros((16, 16), int)
@@ -727,16 +743,14 @@ class NalParser():
                             abs_row = self.blk16x16Idx_y*4 + x
                             abs_col = self.blk16x16Idx_x*4 + y
                             nC = self.__get_nC(abs_row, abs_col)
-                            logging.debug("decoding blockInx: %d, nC: %d", luma4x4BlkIdx, nC)
-                            logging.debug("row, col in nAnB matrix: %d, %d", abs_row, abs_col)
+                            if tracing.NALU:
+                                logging.debug("decoding blockInx: %d, nC: %d", luma4x4BlkIdx, nC)
+                                logging.debug("row, col in nAnB matrix: %d, %d", abs_row, abs_col)
                             
                             self.__show_binary_fragment()
-                            blocks = self.stream[self.stream.pos: self.stream.len]
-                            Intra4x4ACLevel, position, self.nAnB[abs_row,abs_col] = cavlc.decode(blocks, nC, 16)
-
-                            temp = self.stream.read(position)   # drop the decoded data
-                            logging.debug("processed data: %s", temp.bin)
-                            logging.debug("Inter16x16ACLevel_%d:", luma4x4BlkIdx)
+                            Intra4x4ACLevel, position, self.nAnB[abs_row,abs_col] = cavlc.decode(self.stream, nC, 16)
+                            if tracing.NALU:
+                                logging.debug("Inter16x16ACLevel_%d:", luma4x4BlkIdx)
                             #logging.debug("\n%s" % (Intra4x4ACLevel))
 
                             coeffBlock_16x16[x*4:(x*4+4), y*4:(y*4+4)] = copy.deepcopy(Intra4x4ACLevel)
@@ -761,44 +775,31 @@ class NalParser():
         """
         read te data from stream
         """
-        logging.debug("before read te(v) data: %s", self.stream.peek(32).bin)
-        
-        value = self.__get_codeNum()
-        result = 0
-        if value > 1:
-            temp = self.stream.read('ue')
-            result = temp
-        elif value==1:
-            result = 0
-        else: # value==0
-            result = 1   # temp code, should fix
-
-        logging.debug("after read te(v) data: %s", self.stream.peek(32).bin)
+        if tracing.NALU:
+            logging.debug("before read te(v) data: %s", self.stream.peek_bin(32))
+
+        # the range of ref_idx_l0 is 0 to num_ref_idx_l0_active_minus1, according to 7.4.5.1
+        result = self.stream.te(self.num_ref_idx_l0_active_minus1)
+
+        if tracing.NALU:
+            logging.debug("after read te(v) data: %s", self.stream.peek_bin(32))
         return result
 
     def __get_codeNum(self):
         """
         get codeNum from stream
         """
-        logging.debug("before read codeNum data:")
+        if tracing.NALU:
+            logging.debug("before read codeNum data:")
         self.__show_binary_fragment()
         
-        leadingZeroBits = -1
-        b = 0
-        while not b:
-            leadingZeroBits = leadingZeroBits + 1
-            b = self.stream.read('uint:1')
-
-        follow = 0
-        if leadingZeroBits>0:
-            temp = self.stream.read('bits:'+str(leadingZeroBits))
-            follow = temp.uint
+        codeNum = self.stream.ue()
 
-        codeNum = pow(2, leadingZeroBits) - 1 + follow
-
-        logging.debug("after read codeNum data:")
+        if tracing.NALU:
+            logging.debug("after read codeNum data:")
         self.__show_binary_fragment()
-        logging.debug("codeNum: %d", codeNum)
+        if tracing.NALU:
+            logging.debug("codeNum: %d", codeNum)
 
         # get coded_block_pattern by codeNum
         return codeNum
@@ -906,8 +907,10 @@ class NalParser():
         """
         show folloing binary code of decoding stream
         """
+        if not tracing.NALU:
+            return
         example_len = length if (self.stream.len-self.stream.pos)>length else (self.stream.len-self.stream.pos)
-        logging.debug("following data: %s", self.stream.peek(example_len).bin)
+        logging.debug("following data: %s", self.stream.peek_bin(example_len))
 
     def __set_motion_vector(self, mvd):
         """
@@ -953,8 +956,9 @@ class NalParser():
         self.mv[self.blk16x16Idx_y, self.blk16x16Idx_x][0] = mvd[0] + mvp[0]
         self.mv[self.blk16x16Idx_y, self.blk16x16Idx_x][1] = mvd[1] + mvp[1]
 
-        logging.debug("mvp: %s", mvp)
-        logging.debug("mv: %s", self.mv[self.blk16x16Idx_y, self.blk16x16Idx_x])
+        if tracing.NALU:
+            logging.debug("mvp: %s", mvp)
+            logging.debug("mv: %s", self.mv[self.blk16x16Idx_y, self.blk16x16Idx_x])
 
     def __get_P_prediction(self):
         """
@@ -962,8 +966,8 @@ class NalParser():
         """
         # the process here is different from __residual_block_Intra16x16
         mc_sample = np.zeros((16, 16), int)
-        ref_x = self.mv[self.blk16x16Idx_y, self.blk16x16Idx_x][0] + self.blk16x16Idx_x * 16 * 4
-        ref_y = self.mv[self.blk16x16Idx_y, self.blk16x16Idx_x][1] + self.blk16x16Idx_y * 16 * 4
+        ref_x = int(self.mv[self.blk16x16Idx_y, self.blk16x16Idx_x][0]) + self.blk16x16Idx_x * 16 * 4
+        ref_y = int(self.mv[self.blk16x16Idx_y, self.blk16x16Idx_x][1]) + self.blk16x16Idx_y * 16 * 4
         ref_x = int(ref_x/4) #TODO: should use interpolation here
         ref_y = int(ref_y/4) #TODO: should use interpolation here
 
@@ -993,13 +997,15 @@ class NalParser():
         mc_sample = self.__get_P_prediction()
         
         self.coefficients[row:(row+16), col:(col+16)] = 0
-        self.residual[row:(row+16), col:(col+16)] = copy.deepcopy(mc_sample)
+        self.residual[row:(row+16), col:(col+16)] = mc_sample
 
 def main(h264file):
     """
     Args:
         h264file: h264file name, should be using suffix .264 o .h264
     """
+    import matplotlib.pyplot as plt
+
     # Test Case 1: use test data with one macroblock directly, hard code binary data
     #sps = BitStream('0x42c01edb02004190')
     #pps = BitStream('0xca83cb20')
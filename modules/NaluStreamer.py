@@ -1,12 +1,19 @@
 # Based on the document of ITU-T Recommendation H.264 05/2003 edition
 # 
 
-from bitstring import BitStream, BitArray
+import os
+import queue
+import threading
 from h26x_extractor import nalutypes
-import matplotlib.pyplot as plt
+from bitwriter import BitWriter, rbsp_to_ebsp
 
-START_CODE_PREFIX = '0x00000001'
-START_CODE_PREFIX_SHORT = "0x000001"
+START_CODE_PREFIX = 0x00000001    # u(32)
+START_CODE_PREFIX_SHORT = 0x000001    # u(24)
+
+# NAL units waiting for the writer thread of NaluSink
+SINK_QUEUE_SIZE = 64
+# NAL units are coalesced into writes of up to this many bytes
+SINK_BATCH_SIZE = 1 << 20
 
 def openNaluFile(bitstream_outputfile):
     '''
@@ -14,9 +21,117 @@ def openNaluFile(bitstream_outputfile):
     '''
     return open(bitstream_outputfile, 'wb')
 
+def openNaluSink(bitstream_outputfile):
+    '''
+    Init Nalu File written by a background thread, see NaluSink
+    '''
+    return NaluSink(bitstream_outputfile)
+
 def closeNaluFile(bitstream_outputfile_handler):
     bitstream_outputfile_handler.close()
 
+class NaluSink():
+    """
+    Output of the export() functions, written asynchronously
+    export() hands the finished NAL units to a bounded queue and returns, a writer thread
+    coalesces the queued units into large writes, so entropy coding overlaps with the I/O.
+    A full queue blocks export() until the writer catches up.
+    """
+    def __init__(self, output, queue_size=SINK_QUEUE_SIZE, batch_size=SINK_BATCH_SIZE):
+        """
+        Args:
+            output: file name, or binary file-like object such as a pipe (sys.stdout.buffer) or io.BytesIO
+            queue_size: NAL units waiting for the writer thread
+            batch_size: bytes coalesced into one write
+        """
+        self.opened = isinstance(output, (str, bytes, os.PathLike))
+        self.f = open(output, 'wb') if self.opened else output
+        self.batch_size = batch_size
+        self.queue = queue.Queue(queue_size)
+        self.error = None
+        self.closed = False
+        self.bytes = 0
+
+        self.writer = threading.Thread(target=self.__write_batches, name="nalu-sink", daemon=True)
+        self.writer.start()
+
+    def __write_batches(self):
+        """
+        Body of the writer thread, None in the queue stops it
+        """
+        done = False
+        while not done:
+            batch = [self.queue.get()]
+            size = len(batch[0]) if batch[0] is not None else 0
+            while size < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+                if batch[-1] is not None:
+                    size += len(batch[-1])
+            if batch[-1] is None:
+                done = True
+                batch.pop()
+
+            if batch and self.error is None:
+                try:
+                    self.f.write(batch[0] if len(batch) == 1 else b''.join(batch))
+                    self.bytes += size
+                except Exception as e:
+                    self.error = e   # raised again by write(), flush() or close()
+            for x in range(len(batch) + done):
+                self.queue.task_done()
+
+    def __check(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, data):
+        """
+        Queue bytes for the output, like file.write()
+        Args:
+            data: bytes-like object, it is not copied and must not be changed afterwards
+        """
+        if self.closed:
+            raise ValueError("write to a closed NaluSink")
+        self.__check()
+        if len(data):
+            self.queue.put(data)
+        return len(data)
+
+    def flush(self):
+        """
+        Wait until everything queued is written, then flush the output
+        """
+        self.queue.join()
+        self.__check()
+        if hasattr(self.f, 'flush'):
+            self.f.flush()
+
+    def close(self):
+        """
+        Write everything queued and stop the writer thread, file-like objects passed in stay open
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.writer.join()
+        try:
+            self.__check()
+            if hasattr(self.f, 'flush'):
+                self.f.flush()
+        finally:
+            if self.opened:
+                self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
 class NaluStreamer():
 
     def __init__(self, nalu_type):
@@ -26,39 +141,35 @@ class NaluStreamer():
         '''
         if (nalu_type != nalutypes.NAL_UNIT_TYPE_UNSPECIFIED):
             # for specific nalutypes
-            self.forbidden_zero_bit = '0b0'
-            self.nal_ref_idc = '0b11'
-            self.nal_unit_type = "0b" + "{0:05b}".format(nalu_type)
-
-            self.stream = BitStream(START_CODE_PREFIX)
-            self.stream.append(self.forbidden_zero_bit)
-            self.stream.append(self.nal_ref_idc)
-            self.stream.append(self.nal_unit_type)
+            self.forbidden_zero_bit = 0 # f(1)
+            self.nal_ref_idc = 3 # u(2)
+            self.nal_unit_type = nalu_type # u(5)
+
+            self.stream = BitWriter()
+            self.stream.put_bits(START_CODE_PREFIX, 32)
+            self.stream.put_bits(self.forbidden_zero_bit, 1)
+            self.stream.put_bits(self.nal_ref_idc, 2)
+            self.stream.put_bits(self.nal_unit_type, 5)
+            self.header_size = 5   # bytes of start code and NAL header, not escaped
         else:
             # for slice_data
-            self.stream = BitStream()
+            self.stream = BitWriter()
+            self.header_size = 0
 
     def rbsp_trailing_bits(self):
         '''
         according to RBSP trainling bits syntax on page 35, and according to explanation page 49
         '''
-        rbsp_stop_one_bit = '0b1'
-        rbsp_alignment_zero_bit = '0b0'
-        self.stream.append(rbsp_stop_one_bit)
-
-        plus = 8 - (self.stream.length % 8)
-
-        for x in range(0, plus):
-            self.stream.append(rbsp_alignment_zero_bit)
-
-        #print("length after plus:")
-        #print(self.stream.length)
+        self.stream.rbsp_trailing_bits()
 
     def export(self, bitstream_output_handler):
         """
         output the binary data into file
+        The emulation prevention bytes are inserted into the payload on the way, according to 7.4.1
         """
-        self.stream.tofile(bitstream_output_handler)
+        data = memoryview(self.stream.tobytes())
+        bitstream_output_handler.write(data[:self.header_size])
+        bitstream_output_handler.write(rbsp_to_ebsp(data[self.header_size:]))
 
 class SpsStreamer(NaluStreamer):
     """
@@ -72,14 +183,14 @@ class SpsStreamer(NaluStreamer):
         super().__init__(nalu_type)
 
         # use some default value
-        self.profile_idc = '0x64'   # u(8)
-        self.constraint_set0_flag = '0b0' # u(1)
-        self.constraint_set1_flag = '0b0' # u(1)
-        self.constraint_set2_flag = '0b0' # u(1)
+        self.profile_idc = 100   # u(8)
+        self.constraint_set0_flag = 0 # u(1)
+        self.constraint_set1_flag = 0 # u(1)
+        self.constraint_set2_flag = 0 # u(1)
 
-        self.reserved_zero_2bits = '0b00000' # u(5)
-        self.level_idc = '0b00000001' # u(8)
-        self.seq_parameter_set_id = '0b0' #ue(v)
+        self.reserved_zero_2bits = 0 # u(5)
+        self.level_idc = 1 # u(8)
+        self.seq_parameter_set_id = 0 #ue(v)
 
         # if ((self.profile_idc == 100) or (self.profile_idc == 110) or (self.profile_idc == 122) or (self.profile_idc == 144)):
         #     self.chroma_format_idc = self.s.read('ue')
@@ -95,78 +206,73 @@ class SpsStreamer(NaluStreamer):
         #         # TODO: have to implement this, otherwise it will fail
         #         raise NotImplementedError("Scaling matrix decoding is not implemented.")
 
-        self.log2_max_frame_num_minus4 = '0b0' #ue(v)
-        self.pic_order_cnt_type = '0b1' #ue(v)
+        self.log2_max_frame_num_minus4 = 0 #ue(v)
+        self.pic_order_cnt_type = 0 #ue(v)
+        self.log2_max_pic_order_cnt_lsb_minus4 = 0 #ue(v)
 
-        self.num_ref_frames = '0b1' #ue(v)
-        self.gaps_in_frame_num_value_allowed_flag = '0b0' #u(1)
-        self.pic_width_in_mbs_minus_1 = '0b0' #u(ue)
-        self.pic_height_in_map_units_minus_1 = '0b0' #u(ue)
-        self.frame_mbs_only_flag = '0b1' #u(1)
+        self.num_ref_frames = 0 #ue(v)
+        self.gaps_in_frame_num_value_allowed_flag = 0 #u(1)
+        self.pic_width_in_mbs_minus_1 = 0 #u(ue)
+        self.pic_height_in_map_units_minus_1 = 0 #u(ue)
+        self.frame_mbs_only_flag = 1 #u(1)
         # if not self.frame_mbs_only_flag:
         #     self.mb_adapative_frame_field_flag = self.s.read('uint:1')
-        self.direct_8x8_inference_flag = '0b0' #u(1)
-        self.frame_cropping_flag = '0b0' #u(1)
+        self.direct_8x8_inference_flag = 0 #u(1)
+        self.frame_cropping_flag = 0 #u(1)
         # if self.frame_cropping_flag:
         #     self.frame_crop_left_offst = self.s.read('ue')
         #     self.frame_crop_right_offset = self.s.read('ue')
         #     self.frame_crop_top_offset = self.s.read('ue')
         #     self.frame_crop_bottom_offset = self.s.read('ue')
-        self.vui_parameters_present_flag = '0b0' #u(1)
+        self.vui_parameters_present_flag = 0 #u(1)
 
     def set__profile_idc(self, profile_idc):
         '''
         set level_idc in SPS, foramt: u(8)
         : param set_id: int number of set id, according to Table A-1 Level limits on page 207
         '''
-        self.profile_idc = "0b" + "{0:08b}".format(profile_idc)
+        self.profile_idc = profile_idc
 
     def set__level_idc(self, level_number):
         '''
         set level_idc in SPS, foramt: u(8)
         : param set_id: int number of set id, according to Table A-1 Level limits on page 207
         '''
-        self.level_idc = "0b" + "{0:08b}".format(level_number*10)
+        self.level_idc = level_number*10
 
     def set__seq_parameter_set_id(self, set_id):
         '''
         set seq_parameter_set_id in SPS, foramt: ue(v)
         : param set_id: int number of set id
         '''
-        s = BitArray(ue=set_id)
-        self.seq_parameter_set_id = s
+        self.seq_parameter_set_id = set_id
 
     def set__log2_max_frame_num_minus4(self, value):
         '''
         set log2_max_frame_num_minus4 in SPS, foramt: ue(v)
         : param value: described on page 54
         '''
-        s = BitArray(ue=value)
-        self.log2_max_frame_num_minus4 = s
+        self.log2_max_frame_num_minus4 = value
 
     def get__log2_max_frame_num_minus4(self):
         """
         Get and decode log2_max_frame_num_minus4 from sps
         """
-        temp = self.log2_max_frame_num_minus4.ue
-        return temp
+        return self.log2_max_frame_num_minus4
 
     def set__pic_order_cnt_type(self, value):
         '''
         set pic_order_cnt_type in SPS, foramt: ue(v)
         : param value: described on page 54
         '''
-        s = BitArray(ue=value)
-        self.pic_order_cnt_type = s
+        self.pic_order_cnt_type = value
 
         if (value == 0):
-            # log2_max_pic_order_cnt_lsb_minus4
-            log2_max_pic_order_cnt_lsb_minus4 = 0   # todo, need to add specific data
-            temp = BitArray(ue=log2_max_pic_order_cnt_lsb_minus4)
-            self.pic_order_cnt_type.append(temp)
+            # log2_max_pic_order_cnt_lsb_minus4, written by export()
+            self.log2_max_pic_order_cnt_lsb_minus4 = 0   # todo, need to add specific data
         elif (value == 1):
             print("TODO: ADD MORE SPECIFIC ITEM")
-        #     self.delta_pic_order_always_zero_flag = '0b1' # u(1)
+        #     self.delta_pic_order_always_zero_flag = 1 # u(1)
         #     self.offset_for_non_ref_pic = self.s.read('se')
         #     self.offset_for_top_to_bottom_filed = self.s.read('se')
         #     self.num_ref_frames_in_pic_order_cnt_cycle = self.s.read('ue')
@@ -178,8 +284,7 @@ class SpsStreamer(NaluStreamer):
         set num_ref_frames in SPS, foramt: ue(v)
         : param value: described on page 55
         '''
-        s = BitArray(ue=value)
-        self.num_ref_frames = s
+        self.num_ref_frames = value
 
     def set__gaps_in_frame_num_value_allowed_flag(self, bool_value):
         '''
@@ -187,9 +292,9 @@ class SpsStreamer(NaluStreamer):
         : param value: described on page 55
         '''
         if (bool_value):
-            self.gaps_in_frame_num_value_allowed_flag = '0b1'
+            self.gaps_in_frame_num_value_allowed_flag = 1
         else:
-            self.gaps_in_frame_num_value_allowed_flag = '0b0'
+            self.gaps_in_frame_num_value_allowed_flag = 0
 
     def set__pic_width_in_mbs_minus_1(self, width):
         '''
@@ -198,8 +303,7 @@ class SpsStreamer(NaluStreamer):
         '''
         MB_width = 16
         pic_width_in_mbs_minus_1 = int( width/MB_width - 1 )
-        s = BitArray(ue=pic_width_in_mbs_minus_1)
-        self.pic_width_in_mbs_minus_1 = s
+        self.pic_width_in_mbs_minus_1 = pic_width_in_mbs_minus_1
 
     def set__pic_height_in_map_units_minus1(self, height):
         '''
@@ -208,8 +312,7 @@ class SpsStreamer(NaluStreamer):
         '''
         MB_height = 16
         pic_height_in_map_units_minus_1 = int( height/MB_height - 1 )
-        s = BitArray(ue=pic_height_in_map_units_minus_1)
-        self.pic_height_in_map_units_minus_1 = s
+        self.pic_height_in_map_units_minus_1 = pic_height_in_map_units_minus_1
 
     def set__frame_mbs_only_flag(self, bool_value):
         '''
@@ -217,11 +320,11 @@ class SpsStreamer(NaluStreamer):
         : param bool_value: have or not have field slices or field MBs, according to page 55
         '''
         if (bool_value):
-            self.frame_mbs_only_flag = '0b1'
+            self.frame_mbs_only_flag = 1
         else:
-            self.frame_mbs_only_flag = '0b0'
+            self.frame_mbs_only_flag = 0
             # todo: add mb_adaptive_frame_field_flag
-            #mb_adaptive_frame_field_flag = '0b0' #u(1) TODO
+            #mb_adaptive_frame_field_flag = 0 #u(1) TODO
             # self.frame_mbs_only_flag.append(mb_adaptive_frame_field_flag) #TODO
 
     def set__direct_8x8_inference_flag(self, bool_value):
@@ -230,9 +333,9 @@ class SpsStreamer(NaluStreamer):
         : param bool_value: Specifies how certain B macroblock motion vectors are derived on page 55
         '''
         if (bool_value):
-            self.direct_8x8_inference_flag = '0b1'
+            self.direct_8x8_inference_flag = 1
         else:
-            self.direct_8x8_inference_flag = '0b0'
+            self.direct_8x8_inference_flag = 0
 
     def set__frame_cropping_flag(self, bool_value):
         '''
@@ -240,14 +343,14 @@ class SpsStreamer(NaluStreamer):
         : param bool_value: Specifies how certain B macroblock motion vectors are derived on page 55
         '''
         if (bool_value):
-            self.frame_cropping_flag = '0b1'
+            self.frame_cropping_flag = 1
             # TODO add more flags
             # frame_crop_left_offset
             # frame_crop_left_offset
             # frame_crop_left_offset
             # frame_crop_bottom_offset
         else:
-            self.frame_cropping_flag = '0b0'
+            self.frame_cropping_flag = 0
 
     def set__vui_parameters_present_flag(self, bool_value):
         '''
@@ -255,34 +358,36 @@ class SpsStreamer(NaluStreamer):
         : param bool_value: Specifies how certain B macroblock motion vectors are derived on page 55
         '''
         if (bool_value):
-            self.vui_parameters_present_flag = '0b1'
+            self.vui_parameters_present_flag = 1
             # TODO add more flags
             # vui_parameters_present_flag
         else:
-            self.vui_parameters_present_flag = '0b0'
+            self.vui_parameters_present_flag = 0
 
     def export(self, bitstream_output_handler):
         """
         output the binary data into file
         The sequence here is very important, should be exact the same as SPECIFIC of H.264
         """
-        self.stream.append(self.profile_idc)
-        self.stream.append(self.constraint_set0_flag)
-        self.stream.append(self.constraint_set1_flag)
-        self.stream.append(self.constraint_set2_flag)
-        self.stream.append(self.reserved_zero_2bits)
-        self.stream.append(self.level_idc)
-        self.stream.append(self.seq_parameter_set_id)
-        self.stream.append(self.log2_max_frame_num_minus4)
-        self.stream.append(self.pic_order_cnt_type)
-        self.stream.append(self.num_ref_frames)
-        self.stream.append(self.gaps_in_frame_num_value_allowed_flag)
-        self.stream.append(self.pic_width_in_mbs_minus_1)
-        self.stream.append(self.pic_height_in_map_units_minus_1)
-        self.stream.append(self.frame_mbs_only_flag)
-        self.stream.append(self.direct_8x8_inference_flag)
-        self.stream.append(self.frame_cropping_flag)
-        self.stream.append(self.vui_parameters_present_flag)
+        self.stream.put_bits(self.profile_idc, 8)
+        self.stream.put_bits(self.constraint_set0_flag, 1)
+        self.stream.put_bits(self.constraint_set1_flag, 1)
+        self.stream.put_bits(self.constraint_set2_flag, 1)
+        self.stream.put_bits(self.reserved_zero_2bits, 5)
+        self.stream.put_bits(self.level_idc, 8)
+        self.stream.put_ue(self.seq_parameter_set_id)
+        self.stream.put_ue(self.log2_max_frame_num_minus4)
+        self.stream.put_ue(self.pic_order_cnt_type)
+        if (self.pic_order_cnt_type == 0):
+            self.stream.put_ue(self.log2_max_pic_order_cnt_lsb_minus4)
+        self.stream.put_ue(self.num_ref_frames)
+        self.stream.put_bits(self.gaps_in_frame_num_value_allowed_flag, 1)
+        self.stream.put_ue(self.pic_width_in_mbs_minus_1)
+        self.stream.put_ue(self.pic_height_in_map_units_minus_1)
+        self.stream.put_bits(self.frame_mbs_only_flag, 1)
+        self.stream.put_bits(self.direct_8x8_inference_flag, 1)
+        self.stream.put_bits(self.frame_cropping_flag, 1)
+        self.stream.put_bits(self.vui_parameters_present_flag, 1)
         super().rbsp_trailing_bits()
 
         super().export(bitstream_output_handler)
@@ -298,45 +403,40 @@ class PpsStreamer(NaluStreamer):
         super().__init__(nalu_type)
 
         # use some default value
-        s = BitArray(ue=0)
-        self.pic_parameter_set_id = s   # ue(v)
-        self.seq_parameter_set_id = s # ue(v)
-        self.entropy_coding_mode_flag = '0b0' # u(1)
-        self.pic_order_present_flag = '0b0' # u(1)
+        self.pic_parameter_set_id = 0   # ue(v)
+        self.seq_parameter_set_id = 0 # ue(v)
+        self.entropy_coding_mode_flag = 0 # u(1)
+        self.pic_order_present_flag = 0 # u(1)
 
-        self.num_slice_groups_minus1 = s #ue(v)
+        self.num_slice_groups_minus1 = 0 #ue(v)
         # TODO: subclause of num_slice_groups_minus1
         # if (num_slice_groups_minus1>0)
 
-        s = BitArray(ue=9)
-        self.num_ref_idx_l0_active_minus1 = s # ue(v)
-        self.num_ref_idx_l1_active_minus1 = s # ue(v)
+        self.num_ref_idx_l0_active_minus1 = 9 # ue(v)
+        self.num_ref_idx_l1_active_minus1 = 9 # ue(v)
 
-        self.weighted_pred_flag = '0b0' # u(1)
-        self.weighted_bipred_idc = '0b00' # u(2)
+        self.weighted_pred_flag = 0 # u(1)
+        self.weighted_bipred_idc = 0 # u(2)
 
-        s = BitArray(se=0)
-        self.pic_init_qp_minus26 = s   # se(v)
-        self.pic_init_qs_minus26 = s   # se(v)
-        self.chroma_qp_index_offset = s   # se(v)
+        self.pic_init_qp_minus26 = 0   # se(v)
+        self.pic_init_qs_minus26 = 0   # se(v)
+        self.chroma_qp_index_offset = 0   # se(v)
 
-        self.deblocking_filter_control_present_flag = '0b0' # u(1)
-        self.constrained_intra_pred_flag = '0b0' # u(1)
-        self.redundant_pic_cnt_present_flag = '0b0' # u(1)
+        self.deblocking_filter_control_present_flag = 0 # u(1)
+        self.constrained_intra_pred_flag = 0 # u(1)
+        self.redundant_pic_cnt_present_flag = 0 # u(1)
 
     def set__pic_init_qp_minus26(self, qp_minus26):
-        s = BitArray(se=qp_minus26)
-        self.pic_init_qp_minus26 = s   # se(v)
+        self.pic_init_qp_minus26 = qp_minus26   # se(v)
 
     def get__pic_init_qp_minus26(self):
-        temp = self.pic_init_qp_minus26.se
-        return temp
+        return self.pic_init_qp_minus26
 
     def set__deblocking_filter_control_present_flag(self, bool_value):
         if bool_value:
-            self.deblocking_filter_control_present_flag = '0b1'
+            self.deblocking_filter_control_present_flag = 1
         else:
-            self.deblocking_filter_control_present_flag = '0b0'
+            self.deblocking_filter_control_present_flag = 0
 
 
     def export(self, bitstream_output_handler):
@@ -344,21 +444,21 @@ class PpsStreamer(NaluStreamer):
         output the binary data into file
         The sequence here is very important, should be exact the same as SPECIFIC of H.264
         """
-        self.stream.append(self.pic_parameter_set_id)
-        self.stream.append(self.seq_parameter_set_id)
-        self.stream.append(self.entropy_coding_mode_flag)
-        self.stream.append(self.pic_order_present_flag)
-        self.stream.append(self.num_slice_groups_minus1)
-        self.stream.append(self.num_ref_idx_l0_active_minus1)
-        self.stream.append(self.num_ref_idx_l1_active_minus1)
-        self.stream.append(self.weighted_pred_flag)
-        self.stream.append(self.weighted_bipred_idc)
-        self.stream.append(self.pic_init_qp_minus26)
-        self.stream.append(self.pic_init_qs_minus26)
-        self.stream.append(self.chroma_qp_index_offset)
-        self.stream.append(self.deblocking_filter_control_present_flag)
-        self.stream.append(self.constrained_intra_pred_flag)
-        self.stream.append(self.redundant_pic_cnt_present_flag)
+        self.stream.put_ue(self.pic_parameter_set_id)
+        self.stream.put_ue(self.seq_parameter_set_id)
+        self.stream.put_bits(self.entropy_coding_mode_flag, 1)
+        self.stream.put_bits(self.pic_order_present_flag, 1)
+        self.stream.put_ue(self.num_slice_groups_minus1)
+        self.stream.put_ue(self.num_ref_idx_l0_active_minus1)
+        self.stream.put_ue(self.num_ref_idx_l1_active_minus1)
+        self.stream.put_bits(self.weighted_pred_flag, 1)
+        self.stream.put_bits(self.weighted_bipred_idc, 2)
+        self.stream.put_se(self.pic_init_qp_minus26)
+        self.stream.put_se(self.pic_init_qs_minus26)
+        self.stream.put_se(self.chroma_qp_index_offset)
+        self.stream.put_bits(self.deblocking_filter_control_present_flag, 1)
+        self.stream.put_bits(self.constrained_intra_pred_flag, 1)
+        self.stream.put_bits(self.redundant_pic_cnt_present_flag, 1)
 
         super().rbsp_trailing_bits()
 
@@ -376,31 +476,24 @@ class SliceHeader(NaluStreamer):
         super().__init__(nalu_type)
 
         # use some default value
-        s = BitArray(ue=0)
-        self.first_mb_in_slice = s   # ue(v)
+        self.first_mb_in_slice = 0   # ue(v)
+        self.slice_type = slice_type # ue(v)
+        self.pic_parameter_set_id = 0 # ue(v)
 
-        s = BitArray(ue=slice_type)
-        self.slice_type = s # ue(v)
+        self.frame_num = 0 # u(v)
+        self.frame_num_bits = 1 # log2_max_frame_num_minus4 + 4 after set__frame_num()
+        self.idr_pic_id = 0 # ue(v)
 
-        s = BitArray(ue=0)
-        self.pic_parameter_set_id = s # ue(v)
+        self.pic_order_cnt_lsb = 0 # u(1)
+        self.no_output_of_prior_pics_flag = 0 # u(1)
+        self.long_term_reference_flag = 0 # u(1)
 
-        self.frame_num = '0b0' # u(v)
-        self.idr_pic_id = s # ue(v)
+        self.slice_qp_delta = -3  #se(v)
 
-        self.pic_order_cnt_lsb = '0b0' # u(1)
-        self.no_output_of_prior_pics_flag = '0b0' # u(1)
-        self.long_term_reference_flag = '0b0' # u(1)
+        self.disable_deblocking_filter_idc = 0 #ue(v)
 
-        s = BitArray(se=-3)
-        self.slice_qp_delta = s  #se(v)
-
-        s = BitArray(ue=0)
-        self.disable_deblocking_filter_idc = s #ue(v)
-        
-        s = BitArray(se=0)
-        self.slice_alpha_c0_offset_div2 = s
-        self.slice_beta_offset_div2 = s
+        self.slice_alpha_c0_offset_div2 = 0 #se(v)
+        self.slice_beta_offset_div2 = 0 #se(v)
     
     def set__frame_num(self, sps_log2_minus4, frameNum):
         """
@@ -410,12 +503,8 @@ class SliceHeader(NaluStreamer):
             sps_log2_minus4: the value of sps log2_max_frame_num_minus4
             frameNum: the frame num of current slice
         """
-        bit_length = sps_log2_minus4 + 4
-        
-        temp = bin(frameNum).replace('0b','')
-        while len(temp) < bit_length:
-            temp = '0' + temp
-        self.frame_num = '0b' + temp
+        self.frame_num_bits = sps_log2_minus4 + 4
+        self.frame_num = frameNum
 
     def set__slice_qp_delta(self, qp_delta):
         """
@@ -423,39 +512,45 @@ class SliceHeader(NaluStreamer):
         Args:
             qp_delta: the int value of field slice_qp_delta
         """
-        s = BitArray(se=qp_delta)
-        self.slice_qp_delta = s  #se(v) 
+        self.slice_qp_delta = qp_delta  #se(v)
 
-    def export(self, bitstream_output_handler, PPS):
+    def gen(self, PPS):
         """
-        output the binary data into file
+        generate the binary data of the slice header, SliceData(self) continues the NAL unit
         The sequence here is very important, should be exact the same as SPECIFIC of H.264
         Args:
-            bitstream_output_handler: output binary file handler
             PPS: the sequence PPS set
         """
-        self.stream.append(self.first_mb_in_slice)
-        self.stream.append(self.slice_type)
-        self.stream.append(self.pic_parameter_set_id)
-        self.stream.append(self.frame_num)
+        self.stream.put_ue(self.first_mb_in_slice)
+        self.stream.put_ue(self.slice_type)
+        self.stream.put_ue(self.pic_parameter_set_id)
+        self.stream.put_bits(self.frame_num, self.frame_num_bits)
 
         #TODO: add frame_mbs_only_flag judgement
 
         #if (self.nalu_type==nalutypes.NAL_UNIT_TYPE_CODED_SLICE_IDR):
-        self.stream.append(self.idr_pic_id)
+        self.stream.put_ue(self.idr_pic_id)
 
-        #self.stream.append(self.pic_order_cnt_lsb)   # TODO: should adjust this value according to SPS
-        self.stream.append(self.no_output_of_prior_pics_flag)
-        self.stream.append(self.long_term_reference_flag)
-        self.stream.append(self.slice_qp_delta)
+        #self.stream.put_bits(self.pic_order_cnt_lsb, 1)   # TODO: should adjust this value according to SPS
+        self.stream.put_bits(self.no_output_of_prior_pics_flag, 1)
+        self.stream.put_bits(self.long_term_reference_flag, 1)
+        self.stream.put_se(self.slice_qp_delta)
 
         # should be some judgement here
         if (PPS.deblocking_filter_control_present_flag):
-            self.stream.append(self.disable_deblocking_filter_idc)
+            self.stream.put_ue(self.disable_deblocking_filter_idc)
             if self.disable_deblocking_filter_idc != 1 :
-                self.stream.append(self.slice_alpha_c0_offset_div2)
-                self.stream.append(self.slice_beta_offset_div2)
+                self.stream.put_se(self.slice_alpha_c0_offset_div2)
+                self.stream.put_se(self.slice_beta_offset_div2)
 
+    def export(self, bitstream_output_handler, PPS):
+        """
+        output the slice header alone into file
+        Args:
+            bitstream_output_handler: output binary file handler
+            PPS: the sequence PPS set
+        """
+        self.gen(PPS)
         super().export(bitstream_output_handler)
 
 class SliceData(NaluStreamer):
@@ -465,9 +560,13 @@ class SliceData(NaluStreamer):
     @notice currently just support ONE SLICE frame
     The sequence of set__ function is not important.
     the function export() will take care of the sequence of the SODB.
+    : param slice_header: SliceHeader after gen(), the slice data is written into its NAL unit
     """
-    def __init__(self):
+    def __init__(self, slice_header=None):
         super().__init__(nalutypes.NAL_UNIT_TYPE_UNSPECIFIED)
+        if slice_header is not None:
+            self.stream = slice_header.stream
+            self.header_size = slice_header.header_size
 
         # use some default value
         # TODO: add cabac_aligned_one_bit part
@@ -500,36 +599,40 @@ class MacroblockLayer():
     """
     def __init__(self, mb_type):
         # use some default value
-        s = BitArray(ue=mb_type)
-        self.mb_type = s   # ue(v)
-   
-        self.mb_pred = ''
+        self.mb_type = mb_type   # ue(v)
 
-        s = BitArray(se=0)
-        self.mb_qp_delta = s   # se(v)
+        self.mb_pred = None   # intra_chroma_pred_mode, ue(v)
 
-        self.residual = ''
+        self.mb_qp_delta = 0   # se(v)
+
+        self.residual = None
 
     def set__mb_pred(self, intra_chroma_pred_mode):
         #TODO: should use a independent function to generate mb_pred
-        s = BitArray(ue=intra_chroma_pred_mode)
-        self.mb_pred = s
+        self.mb_pred = intra_chroma_pred_mode
 
     def set__residual(self, residual):
         self.residual = residual
 
-    def gen(self):
+    def gen(self, stream=None):
         """
         generate the binary data of this macroblock
         The sequence here is very important, should be exact the same as SPECIFIC of H.264
+        Args:
+            stream: BitWriter of the slice data, the macroblock is written at its end
+        Returns:
+            the BitWriter holding the macroblock, a new one when stream is None
         """
-        stream = BitStream()
+        if stream is None:
+            stream = BitWriter()
 
-        stream.append(self.mb_type)
+        stream.put_ue(self.mb_type)
         #current we just handle 16x16 mode
-        stream.append(self.mb_pred)
-        stream.append(self.mb_qp_delta)
-        stream.append(self.residual)
+        if self.mb_pred is not None:
+            stream.put_ue(self.mb_pred)
+        stream.put_se(self.mb_qp_delta)
+        if self.residual is not None:
+            stream.append(self.residual)
 
         return stream
 
@@ -2,73 +2,95 @@ import numpy as np
 import zlib
 import sys
 
-class ZigzagMatrix:
-    # @param: a matrix of integers
-    # @return: a list of integers
-    def matrix2zig(self, matrix):
-        i = 0
-        j = 0
-        m = len(matrix)
-        n = len(matrix[0])
-        ret = np.zeros(m*n)
-
-        up = True
-        for index in range(m*n):
-            #ret.append(matrix[i][j])
-            ret[index] = matrix[i][j]
-            if up:
-                if i-1<0 or j+1>=n:
-                    up = False
-                    if j+1>=n:  # go down
-                        i += 1
-                    else:  # go right
-                        j += 1
-                else:
-                    i -= 1
+# flat index permutations of the zigzag scan, cached by (m, n)
+_scan_indices = {}
+
+def _zigzag_walk(m, n):
+    """
+    Walk an m x n matrix in zigzag order
+    Returns:
+        the flat (row-major) index of each scan position
+    """
+    i = 0
+    j = 0
+    order = np.zeros(m*n, np.intp)
+
+    up = True
+    for index in range(m*n):
+        order[index] = i*n + j
+        if up:
+            if i-1<0 or j+1>=n:
+                up = False
+                if j+1>=n:  # go down
+                    i += 1
+                else:  # go right
                     j += 1
             else:
-                if i+1>=m or j-1<0:
-                    up = True
-                    if i+1>=m:
-                        j += 1  # go right
-                    else:
-                        i += 1  # go up
+                i -= 1
+                j += 1
+        else:
+            if i+1>=m or j-1<0:
+                up = True
+                if i+1>=m:
+                    j += 1  # go right
                 else:
-                    i += 1
-                    j -= 1
+                    i += 1  # go up
+            else:
+                i += 1
+                j -= 1
+
+    return order
+
+def scan_indices(m, n):
+    """
+    Get the zigzag scan of an m x n matrix as flat indices, computed once per shape
+    Args:
+        m, n: the shape of the matrix
+    Returns:
+        read-only array, scan position k reads flat element scan_indices(m, n)[k]
+    """
+    order = _scan_indices.get((m, n))
+    if order is None:
+        order = _zigzag_walk(m, n)
+        order.flags.writeable = False
+        _scan_indices[(m, n)] = order
+    return order
+
+def scan(blocks):
+    """
+    Zigzag scan of one matrix or a batch of matrices with one gather
+    Args:
+        blocks: array of shape (..., m, n), e.g. (N, 4, 4) for all the blocks of a slice
+    Returns:
+        array of shape (..., m*n) with the dtype of blocks
+    """
+    blocks = np.asarray(blocks)
+    m, n = blocks.shape[-2:]
+    return blocks.reshape(blocks.shape[:-2] + (m*n,))[..., scan_indices(m, n)]
+
+def unscan(zigs, m, n):
+    """
+    Inverse zigzag scan of one array or a batch of arrays with one scatter
+    Args:
+        zigs: array of shape (..., m*n)
+        m, n: the shape of the matrix
+    Returns:
+        array of shape (..., m, n) with the dtype of zigs
+    """
+    zigs = np.asarray(zigs)
+    blocks = np.empty(zigs.shape, zigs.dtype)
+    blocks[..., scan_indices(m, n)] = zigs
+    return blocks.reshape(zigs.shape[:-1] + (m, n))
 
-        return ret
+class ZigzagMatrix:
+    # @param: a matrix of integers
+    # @return: a list of integers
+    def matrix2zig(self, matrix):
+        matrix = np.asarray(matrix)
+        return scan(matrix).astype(float)
 
     def zig2matrix(self, zig, m, n):
-        i = 0
-        j = 0
-        matrix = np.zeros((m,n))
-
-        up = True
-        for index in range(m*n):
-            matrix[i][j] = zig[index]
-            if up:
-                if i-1<0 or j+1>=n:
-                    up = False
-                    if j+1>=n:  # go down
-                        i += 1
-                    else:  # go right
-                        j += 1
-                else:
-                    i -= 1
-                    j += 1
-            else:
-                if i+1>=m or j-1<0:
-                    up = True
-                    if i+1>=m:
-                        j += 1  # go right
-                    else:
-                        i += 1  # go up
-                else:
-                    i += 1
-                    j -= 1
-
-        return matrix
+        return unscan(np.asarray(zig)[:m*n], m, n).astype(float)
 
 def Compress(matrix, QPstep):
     '''
@@ -0,0 +1,113 @@
+# Import time benchmark of the codec modules
+#
+# Copyright (C) <2020>  <cookwhy@qq.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Every module is imported in a fresh interpreter, like a short-lived decode worker.
+# The run fails when a module can not be imported, pulls in plotting or scipy
+# at import time, or when its import takes longer than the budget:
+#
+#     python benchmark_import.py
+#     python benchmark_import.py --budget 0.5 --repeat 5 NaluParser H264Decoder
+
+import argparse
+import ast
+import logging
+import os
+import subprocess
+import sys
+
+# the modules a decode or encode worker imports
+MODULES = ['h26x_parser', 'nalu_index', 'bitreader', 'bitwriter', 'cavlc', 'transform', 'prediction',
+           'NaluParser', 'H264Decoder', 'dct_formula_2D', 'yuv', 'NaluStreamer', 'H264Encoder']
+
+# packages which only visualization and DCT analysis functions may load
+HEAVY_MODULES = ('matplotlib', 'scipy')
+
+# default import time budget of one module, in seconds
+DEFAULT_BUDGET = 0.25
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print(repr((time.perf_counter() - start, [m for m in {heavy!r} if m in sys.modules])))
+"""
+
+def measureImport(module, repeat=3):
+    """
+    Import a module in fresh interpreters
+    Args:
+        module: the module name, imported from the directory of this file
+        repeat: number of interpreters, the fastest import is kept
+    Returns:
+        (seconds, heavy modules loaded by the import), or None if the module can not be imported
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for x in range(repeat):
+        result = subprocess.run([sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                                cwd=here, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if result.returncode != 0:
+            logging.warning("can not import %s: %s", module, result.stderr.strip().splitlines()[-1])
+            return None
+        seconds, heavy = ast.literal_eval(result.stdout.strip().splitlines()[-1])
+        if best is None or seconds < best[0]:
+            best = (seconds, heavy)
+    return best
+
+def benchmarkImports(modules=MODULES, budget=DEFAULT_BUDGET, repeat=3):
+    """
+    Print the import time of each module and check it against the budget
+    Returns:
+        list of the modules which failed the check
+    """
+    failed = []
+    for module in modules:
+        result = measureImport(module, repeat)
+        if result is None:
+            failed.append(module)
+            print("%-16s          FAIL: can not be imported" % module)
+            continue
+
+        seconds, heavy = result
+        status = 'ok'
+        if heavy:
+            status = 'FAIL: loads %s' % ', '.join(heavy)
+        elif seconds > budget:
+            status = 'FAIL: over the %.3f s budget' % budget
+        if status != 'ok':
+            failed.append(module)
+        print("%-16s %8.1f ms  %s" % (module, seconds * 1e3, status))
+
+    return failed
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[
+            logging.StreamHandler(),
+        ]
+    )
+
+    parser = argparse.ArgumentParser(description="import time benchmark of the codec modules")
+    parser.add_argument('modules', nargs='*', default=MODULES, help="modules to import, default to all")
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET, help="import time budget of one module in seconds")
+    parser.add_argument('--repeat', type=int, default=3, help="fresh interpreters per module")
+    args = parser.parse_args()
+
+    failed = benchmarkImports(args.modules, args.budget, args.repeat)
+    sys.exit(1 if failed else 0)
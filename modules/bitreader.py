@@ -0,0 +1,348 @@
+# Fast bit reader for the H.264 decoding process
+#
+# Copyright (C) <2020>  <cookwhy@qq.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Descriptors u(n), ue(v), se(v), te(v) are according to 7.2 on page 31
+# and 9.1 on page 150 of [H.264 standard Book]
+
+import logging
+import timeit
+from bitstring import Bits, BitStream
+
+# parsers get a BitReader for BitStream input when True, a BitStreamReader otherwise
+USE_NATIVE_READER = True
+
+CACHE_BITS = 64
+CACHE_BYTES = CACHE_BITS // 8
+
+class BitReaderError(IndexError):
+    """
+    Raised when reading beyond the end of the data
+    """
+    pass
+
+class BitReader():
+    """
+    Read syntax elements from a bytes-like buffer through a 64-bit cache word.
+    pos and len are bit positions relative to the start of the reader, as in BitStream.
+    """
+    def __init__(self, data, offset=0, length=None):
+        """
+        Args:
+            data: bytes-like object, it is not copied
+            offset: bit offset of the first bit in data
+            length: number of bits, default to the end of data
+        """
+        if not isinstance(data, (bytes, memoryview)):
+            data = memoryview(data).cast('B')
+        self._data = data
+        self._offset = offset
+        if length is None:
+            length = len(data) * 8 - offset
+        self.len = length
+        self.pos = 0
+
+        self._cache = 0
+        self._cache_pos = -CACHE_BITS   # absolute bit position of the cache's MSB
+
+    def __len__(self):
+        return self.len
+
+    def __getitem__(self, key):
+        """
+        Slice the reader by bit positions, without copying the data
+        """
+        if not isinstance(key, slice):
+            raise TypeError("BitReader only supports slicing")
+        start, stop, step = key.indices(self.len)
+        if step != 1:
+            raise ValueError("BitReader slices must have step 1")
+        return BitReader(self._data, self._offset + start, max(stop - start, 0))
+
+    def _refill(self, bitpos):
+        """
+        Load the 64 bits beginning with the byte that holds bitpos
+        """
+        byte = bitpos >> 3
+        chunk = self._data[byte: byte + CACHE_BYTES]
+        self._cache = int.from_bytes(chunk, 'big') << ((CACHE_BYTES - len(chunk)) << 3)
+        self._cache_pos = byte << 3
+
+    def peek(self, n):
+        """
+        Return the next n bits as unsigned int without moving pos
+        Bits beyond the end read as zeros.
+        """
+        if n > CACHE_BITS - 7:
+            high = self.peek(n - 32)
+            self.pos += n - 32
+            low = self.peek(32)
+            self.pos -= n - 32
+            return (high << 32) | low
+
+        bitpos = self._offset + self.pos
+        shift = bitpos - self._cache_pos
+        if shift < 0 or shift + n > CACHE_BITS:
+            self._refill(bitpos)
+            shift = bitpos - self._cache_pos
+        value = (self._cache >> (CACHE_BITS - shift - n)) & ((1 << n) - 1)
+
+        over = self.pos + n - self.len
+        if over > 0:
+            value = (value >> over) << over if over < n else 0
+        return value
+
+    def peek_bin(self, n):
+        """
+        Return the next n bits as '0'/'1' string without moving pos
+        """
+        if self.pos + n > self.len:
+            raise BitReaderError("peek %d bits at %d, only %d bits in stream" % (n, self.pos, self.len))
+        if n == 0:
+            return ''
+        return format(self.peek(n), '0%db' % n)
+
+    @property
+    def bin(self):
+        """
+        All the bits of the reader as '0'/'1' string, like BitStream.bin
+        """
+        pos = self.pos
+        self.pos = 0
+        result = self.peek_bin(self.len)
+        self.pos = pos
+        return result
+
+    def skip(self, n):
+        """
+        Move pos forward by n bits
+        """
+        if self.pos + n > self.len:
+            raise BitReaderError("skip %d bits at %d, only %d bits in stream" % (n, self.pos, self.len))
+        self.pos += n
+
+    def u(self, n):
+        """
+        u(n): unsigned integer using n bits
+        """
+        if n == 0:
+            return 0
+        if self.pos + n > self.len:
+            raise BitReaderError("read %d bits at %d, only %d bits in stream" % (n, self.pos, self.len))
+        value = self.peek(n)
+        self.pos += n
+        return value
+
+    def ue(self):
+        """
+        ue(v): unsigned integer Exp-Golomb-coded, according to 9.1
+        """
+        word = self.peek(32)
+        if word:
+            leadingZeroBits = 32 - word.bit_length()
+            size = 2 * leadingZeroBits + 1
+            if size <= 32 and self.pos + size <= self.len:
+                self.pos += size
+                return (word >> (32 - size)) - 1
+
+        leadingZeroBits = 0
+        while not self.u(1):
+            leadingZeroBits += 1
+        return (1 << leadingZeroBits) - 1 + self.u(leadingZeroBits)
+
+    def se(self):
+        """
+        se(v): signed integer Exp-Golomb-coded, according to Table 9-3
+        """
+        codeNum = self.ue()
+        if codeNum & 1:
+            return (codeNum + 1) >> 1
+        return -(codeNum >> 1)
+
+    def te(self, cMax):
+        """
+        te(v): truncated Exp-Golomb-coded, according to 9.1
+        Args:
+            cMax: the range of the syntax element
+        """
+        if cMax > 1:
+            return self.ue()
+        return 1 - self.u(1)
+
+    def byte_aligned(self):
+        """
+        True if pos is on a byte boundary
+        """
+        return self.pos % 8 == 0
+
+class BitStreamReader():
+    """
+    The BitReader interface on top of bitstring.BitStream, the original reading path.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    @property
+    def pos(self):
+        return self.stream.pos
+
+    @pos.setter
+    def pos(self, value):
+        self.stream.pos = value
+
+    @property
+    def len(self):
+        return self.stream.len
+
+    @property
+    def bin(self):
+        return self.stream.bin
+
+    def __len__(self):
+        return self.stream.len
+
+    def __getitem__(self, key):
+        return BitStreamReader(BitStream(self.stream[key]))
+
+    def peek(self, n):
+        left = self.stream.len - self.stream.pos
+        if n <= left:
+            return self.stream.peek(n).uint
+        if left <= 0:
+            return 0
+        return self.stream.peek(left).uint << (n - left)
+
+    def peek_bin(self, n):
+        if self.stream.pos + n > self.stream.len:
+            raise BitReaderError("peek %d bits at %d, only %d bits in stream" % (n, self.stream.pos, self.stream.len))
+        return self.stream.peek(n).bin
+
+    def skip(self, n):
+        if self.stream.pos + n > self.stream.len:
+            raise BitReaderError("skip %d bits at %d, only %d bits in stream" % (n, self.stream.pos, self.stream.len))
+        self.stream.pos += n
+
+    def u(self, n):
+        if n == 0:
+            return 0
+        return self.stream.read(n).uint
+
+    def ue(self):
+        return self.stream.read('ue')
+
+    def se(self):
+        return self.stream.read('se')
+
+    def te(self, cMax):
+        if cMax > 1:
+            return self.stream.read('ue')
+        return 1 - self.stream.read(1).uint
+
+    def byte_aligned(self):
+        return self.stream.pos % 8 == 0
+
+def as_reader(stream):
+    """
+    Get a reader for the parsers
+    Args:
+        stream: BitReader or BitStreamReader (returned as is), BitStream, or bytes-like RBSP.
+                A BitStream is read from bit 0 whatever its pos, the h26x_parser callbacks
+                hand over the payload it has already parsed
+    Returns:
+        BitReader, or BitStreamReader for BitStream input when USE_NATIVE_READER is False
+    """
+    if isinstance(stream, (BitReader, BitStreamReader)):
+        return stream
+    if isinstance(stream, Bits):
+        if not USE_NATIVE_READER:
+            return BitStreamReader(BitStream(stream))
+        return BitReader(stream.tobytes(), 0, stream.len)
+    return BitReader(stream)
+
+def testBitReader():
+    """
+    Compare every descriptor with bitstring
+    """
+    import random
+    random.seed(0)
+    values = [random.randint(0, 300) for x in range(200)] + [0, 1, 2, 65534, 65535, 1 << 20]
+    stream = BitStream()
+    for x in values:
+        stream.append(Bits(ue=x))
+        stream.append(Bits(se=x - 150))
+        stream.append(Bits(uint=x & 0x1f, length=5))
+
+    reader = BitReader(stream.tobytes(), 0, stream.len)
+    for x in values:
+        assert reader.ue() == x
+        assert reader.se() == x - 150
+        assert reader.peek(5) == x & 0x1f
+        assert reader.u(5) == x & 0x1f
+    assert reader.pos == stream.len
+
+    tail = reader[3:20]
+    assert tail.bin == stream[3:20].bin
+    logging.debug("BitReader matches bitstring on %d values", len(values))
+
+def benchmarkBitReader(count=20000):
+    """
+    Micro-benchmark of the time per syntax element, BitStream against BitReader
+    """
+    stream = BitStream()
+    for x in range(count):
+        stream.append(Bits(ue=x % 64))
+        stream.append(Bits(se=(x % 32) - 16))
+        stream.append(Bits(uint=x % 256, length=8))
+        stream.append(Bits(uint=x % 2, length=1))
+    stream.append(Bits(32))   # room for the last peek
+    data = stream.tobytes()
+
+    def run_bitstring():
+        s = BitStream(bytes=data)
+        for x in range(count):
+            s.read('ue')
+            s.read('se')
+            s.read(8).uint
+            s.read(1).uint
+            s.peek(16)
+
+    def run_bitreader():
+        r = BitReader(data, 0, stream.len)
+        for x in range(count):
+            r.ue()
+            r.se()
+            r.u(8)
+            r.u(1)
+            r.peek(16)
+
+    elements = count * 5
+    t_bitstring = min(timeit.repeat(run_bitstring, number=1, repeat=3))
+    t_bitreader = min(timeit.repeat(run_bitreader, number=1, repeat=3))
+    print("BitStream: %.3f us per syntax element" % (t_bitstring / elements * 1e6))
+    print("BitReader: %.3f us per syntax element" % (t_bitreader / elements * 1e6))
+    print("speedup: %.1fx" % (t_bitstring / t_bitreader))
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[
+            logging.StreamHandler(),
+        ]
+    )
+
+    testBitReader()
+    benchmarkBitReader()
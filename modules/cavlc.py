@@ -20,263 +20,229 @@ from bitstring import BitStream, BitArray
 import ZigZag
 import vlc
 import logging
+import bitreader
+from bitwriter import BitWriter
+import tracing
 
-def getTotalCoeffs(block_1D):
-    '''
-    get non-zeros coefficients in a macroblock
-    : param block: 1D array, that's Reordered macroblock which is 4x4 matrix
-    '''
-    total = 0
-    for x in block_1D:
-        if x!=0:
-            total = total + 1
-
-    return total
-
-def getT1s(block_1D):
-    '''
-    get the number of trailing +/−1 values (T1) in a macroblock
-    : param block: 1D array, that's Reordered macroblock which is 4x4 matrix
-    '''
-    total = 0
-    for x in block_1D:
-        if x==1:
-            total = total + 1
-        elif x == -1:
-            total = total + 1
-
-    if total > 3:
-        total = 3
-    return total
-
-def encodeT1s(block_1D, total):
-    '''
-    For each trailing +/−1 T1 signalled by coeff token, 
-    the sign is encoded with a single bit, 0 = +, 1 = −, 
-    in reverse order, starting with the highest-frequency T1.
-    : param block: 1D array, that's Reordered macroblock which is 4x4 matrix
-    : param total: the max number of T1 needed to encode, never more than 3
+# luma4x4BlkIdx order of the 4x4 blocks of a macroblock, as (row, column) of 4x4 blocks, 6.4.3
+LUMA4x4_BLOCKS = [((blk8 >> 1) * 2 + (blk4 >> 1), (blk8 & 1) * 2 + (blk4 & 1))
+                  for blk8 in range(4) for blk4 in range(4)]
+
+def encodeBlock(stream, coeffs, nC=0, maxNumCoeff=16):
+    """
+    CAVLC of one block of coefficients in scan order, the reverse of decode()
+    TotalCoeff, TrailingOnes, the levels and the runs are collected in one pass
+    from the highest frequency down, and every element goes to the stream as (code, length).
+    Args:
+        stream: BitWriter, the block is written at its end
+        coeffs: maxNumCoeff ints in scan order, e.g. a row of ZigZag.scan(), without the DC for 15
+        nC: the nC calculating from nA & nB on page 158, -1 for chroma DC
+        maxNumCoeff: 16, 15 (AC) or 4 (chroma DC)
     Returns:
-        1. return encode str of T1s
-        2. return levels which needed to be encoded in next step
-    '''
-    enStr = ''
-    remains = np.array([], dtype=int)
-
-    sum = 0
-    for x in block_1D[::-1]:
-        if (sum<total):
-            if x==1:
-                enStr = enStr + '0'
-                sum = sum + 1
-            elif x==-1:
-                enStr = enStr + '1'
-                sum = sum + 1
-            elif (x!=0):
-                remains = np.append(remains, x)
+        the TotalCoeff of this block
+    """
+    # levels and run_before in reverse scan order, the last run holds the zeros below the lowest coefficient
+    levels = []
+    runs = []
+    for x in coeffs[::-1]:
+        if x:
+            levels.append(x)
+            runs.append(0)
+        elif runs:
+            runs[-1] += 1
+
+    TotalCoeff = len(levels)
+    TrailingOnes = 0
+    while TrailingOnes < TotalCoeff and TrailingOnes < 3 and (levels[TrailingOnes] == 1 or levels[TrailingOnes] == -1):
+        TrailingOnes += 1
+
+    # step1: coeff_token, 9.2.1
+    code, length = vlc.coeff_token_code[vlc.get_nC_table_index(nC)][TotalCoeff][TrailingOnes]
+    stream.put_bits(code, length)
+    if tracing.CAVLC:
+        logging.debug('TotalCoeff: %d , TrailingOnes: %d ', TotalCoeff, TrailingOnes)
+    if TotalCoeff == 0:
+        return 0
+
+    # step2: trailing_ones_sign_flag and the remaining levels, 9.2.2
+    signs = 0
+    for x in levels[:TrailingOnes]:
+        signs = (signs << 1) | (x < 0)
+    stream.put_bits(signs, TrailingOnes)
+
+    suffixLength = 1 if TotalCoeff > 10 and TrailingOnes < 3 else 0
+    for index in range(TrailingOnes, TotalCoeff):
+        level = int(levels[index])
+        levelCode = (level << 1) - 2 if level > 0 else -(level << 1) - 1
+        if index == TrailingOnes and TrailingOnes < 3:
+            levelCode -= 2
+
+        if suffixLength == 0 and levelCode < 14:
+            level_prefix, levelSuffixSize, level_suffix = levelCode, 0, 0
+        elif suffixLength == 0 and levelCode < 30:
+            level_prefix, levelSuffixSize, level_suffix = 14, 4, levelCode - 14
+        elif suffixLength > 0 and levelCode < (15 << suffixLength):
+            level_prefix = levelCode >> suffixLength
+            levelSuffixSize = suffixLength
+            level_suffix = levelCode & ((1 << suffixLength) - 1)
         else:
-            #get remain non-zeros
-            if (x!=0):
-                remains = np.append(remains, x)
-
-    #print(enStr)
-    #print(remains)
-    return enStr, remains
-
-def encodeLevels(remains_1D, totalCoeffs, t1s):
-    '''
-    Encode the levels of the remaining non-zero coefficients
-    The level, i.e. the sign and magnitude, of each remaining
-    non-zero coefficient in the block is encoded in reverse order,
-    Args:
-        remains_1D: remain no-zeros values after encode T1s in reverse order
-        totalCoeffs: the sum of non-zeros in original block matrix
-        t1s: the number of trailing +/−1 values (T1) in the macroblock
-    '''
-    enStr = ''
-    suffixLength = 0  #default value
-    if totalCoeffs>10 and t1s<=3:
-        suffixLength = 1
+            level_prefix, levelSuffixSize = 15, 12
+            level_suffix = levelCode - (30 if suffixLength == 0 else 15 << suffixLength)
+            if level_suffix >= 1 << 12:
+                raise ValueError("level %d is too large for level_prefix 15" % level)
+        # level_prefix zeros, a one, then level_suffix
+        stream.put_bits((1 << levelSuffixSize) | level_suffix, level_prefix + 1 + levelSuffixSize)
+
+        if suffixLength == 0:
+            suffixLength = 1
+        if abs(level) > (3 << (suffixLength - 1)) and suffixLength < 6:
+            suffixLength += 1
 
-    for x in remains_1D:
-        level = int(x)
-        levelCode = level
-        if (level>0):
-            levelCode = (level<<1) - 2
+    # step3: total_zeros and run_before, 9.2.3
+    zerosLeft = sum(runs)
+    if TotalCoeff < maxNumCoeff:
+        if maxNumCoeff == 4:
+            code, length = vlc.total_zeros_2x2_code[zerosLeft][TotalCoeff]
         else:
-            levelCode = 0 - (level<<1) - 1
-
-        level_prefix = int(levelCode / (1 << suffixLength))
-        level_suffix = int(levelCode % (1 << suffixLength))
-
-        print("level %d, levelCode %d, levelPrefix %d, suffixLength %d" % (level, levelCode, level_prefix, suffixLength))
- 
-        # TODO: when level_prefix larger than 15, what should I do?
-        if level_prefix>15:
-            level_prefix = 15
-
-        code = vlc.level_prefix[level_prefix]
-        if (suffixLength != 0):
-            temp = bin(level_suffix).replace('0b','')
-            while len(temp) < suffixLength:
-                temp = '0' + temp
-            code = code + temp
-
-        print("code: ", code)
-        enStr = enStr + code
-
-        #update suffixLength
-        if (suffixLength == 0):
-            suffixLength = suffixLength + 1
-        elif (levelCode > (3 << (suffixLength -1)) and suffixLength < 6):
-            suffixLength = suffixLength + 1
-            print("levelCode %d suffixLength %d" % (levelCode, suffixLength))
-
-    #print("encode Levels:", enStr)
-    return enStr
-
-def getTotalZeros(block_1D):
-    '''
-    get zero coefficients in a macroblock
-    TotalZeros is the sum of all zeros preceding the highest non-zero coefficient
-    in the re-ordered array and is coded with a VLC.
-
-    Args:
-        block_1D: 1D array, that's Reordered macroblock which is 4x4 matrix
-    '''
-    
-    [cols] = block_1D.shape
+            code, length = vlc.total_zeros_code[zerosLeft][TotalCoeff]
+        stream.put_bits(code, length)
 
-    pos = 0
-    for i in range(cols):
-        val = block_1D[i]
-        if val!=0:
-            pos = i
-
-    total = 0
-    for j in range(cols):
-        if j > pos:
+    for run_before in runs[:-1]:
+        if zerosLeft <= 0:
             break
-    
-        val = block_1D[j]
-        if val==0:
-            total = total + 1
+        code, length = vlc.run_before_code[run_before][zerosLeft if zerosLeft < 7 else 7]
+        stream.put_bits(code, length)
+        zerosLeft -= run_before
 
-    return total
+    if tracing.CAVLC:
+        logging.debug("levels: %s, runs: %s", levels, runs)
+    return TotalCoeff
 
-def encodeRunBefore(block_1D, totalCoeffs, totalZeros):
+class TotalCoeffGrid():
     """
-    Encode each run of zeros.
-    The number of zeros preceding each non-zero coefficient (run before) is
-    encoded in reverse order.
+    TotalCoeff of the coded 4x4 blocks of a picture, for the nC of the blocks coded next
+    The encoder side of NalParser.nAnB, nAnB_UV and __get_nC, 9.2.1 on page 158,
+    the nC of the blocks is worked out by code_macroblock()
+    """
+    def __init__(self, height, width):
+        """
+        Args:
+            height, width: the luma size of the picture
+        """
+        self.luma = np.zeros((height//4, width//4), np.int8)
+        self.chroma = np.zeros((2, height//8, width//8), np.int8)
+
+    @staticmethod
+    def code_macroblock(grid, row0, col0, size, blocks, dc=None):
+        """
+        Code the blocks of one macroblock, taking the nC of each block from the totals coded before
+        The left and upper neighbors outside the macroblock are read once, the totals are stored at the end.
+        Args:
+            grid: luma or one chroma plane of TotalCoeffGrid
+            row0, col0: the first 4x4 block of the macroblock
+            size: the macroblock is size x size 4x4 blocks
+            blocks: list of (row, column, code), code(nC) codes the block and returns its TotalCoeff
+            dc: code(nC) of the Intra16x16DCLevel, coded first with the nC of the block at 0, 0,
+                its TotalCoeff is not stored
+        Returns:
+            size x size list of the totals
+        """
+        left = grid[row0:row0+size, col0-1].tolist() if col0 else None
+        above = grid[row0-1, col0:col0+size].tolist() if row0 else None
+        totals = [[0] * size for x in range(size)]
+
+        def nC(row, col):
+            nA = totals[row][col-1] if col else (left[row] if left is not None else None)
+            nB = totals[row-1][col] if row else (above[col] if above is not None else None)
+            if nA is not None and nB is not None:
+                return (nA + nB + 1) >> 1
+            return nA if nA is not None else (nB or 0)
+
+        if dc is not None:
+            dc(nC(0, 0))
+        for row, col, code in blocks:
+            totals[row][col] = code(nC(row, col))
+        grid[row0:row0+size, col0:col0+size] = totals
+        return totals
+
+def encodeIntra16x16(stream, dc, ac, nC=0, grid=None, mb_row=0, mb_col=0):
+    """
+    CAVLC of the luma residual of an Intra16x16 macroblock, residual_luma() of 7.3.5.3
+    All the blocks are zigzag scanned with one gather, then coded in luma4x4BlkIdx order.
     Args:
-        block_1D: 1D array, that's Reordered macroblock which is 4x4 matrix
-        totalCoeffs: the sum of non-zero coefficients in the block
-        totalZeros: the sum of all zeros
+        stream: BitWriter, the blocks are written at its end
+        dc: 4x4 Intra16x16DCLevel
+        ac: 16x16 coefficients of the 4x4 blocks, or (4, 4, 4, 4) indexed [row, column] of the blocks,
+            the DC of each block is not coded
+        nC: the nC of the blocks when grid is None
+        grid: TotalCoeffGrid of the picture, the nC of every block is taken from its neighbors
+            and the TotalCoeff of the AC blocks is stored
+        mb_row, mb_col: the position of the macroblock in macroblocks
+    Returns:
+        (4, 4) int8 TotalCoeff of the AC blocks, indexed [row, column] of the blocks
     """
-    enStr = ''
-    [cols] = block_1D.shape
-
-    total_runBefore = 0
-    total_coeff = totalCoeffs
-
-    for i in range(cols-1, -1, -1):
-        val = block_1D[i]
-
-        if val!=0:
-            zeroLeft = 0
-            for x in range(i):
-                temp = block_1D[x]
-                if temp==0:
-                    zeroLeft = zeroLeft+1
-
-            runBefore = 0
-            for y in range(i-1, -1, -1):
-                if block_1D[y]==0:
-                    runBefore = runBefore+1
-                else:
-                    break
-
-            # stop condition 1: there are no more zeros left to encode
-            if total_runBefore==totalZeros:
-                print("ZerosLeft = %d; run before = %d; no code required: no more zeros" % (zeroLeft, runBefore))
-                break
-            total_runBefore = total_runBefore + runBefore
-
-            # stop condition 2: the final or lowest frequency non-zero coefficient.
-            if i==0 or total_coeff==1:
-                print("ZerosLeft = %d; run before = %d; No code required: last coefficient." % (zeroLeft, runBefore))
-                break
-
-            if zeroLeft>6:
-                zeroLeft = 7
-
-            code = vlc.run_before[runBefore][zeroLeft]
-            enStr = enStr + code
-            total_coeff = total_coeff - 1
-            print("ZerosLeft = %d; run before = %d; code: %s" % (zeroLeft, runBefore, code))
-
-    return enStr
+    ac = np.asarray(ac)
+    if ac.ndim == 2:
+        ac = ac.reshape(4, 4, 4, 4).swapaxes(1, 2)   # 16x16 layout to [row, column] of the blocks
+    scans = ZigZag.scan(ac).tolist()
+    total_coeff = np.zeros((4, 4), np.int8)
+
+    if grid is None:
+        encodeBlock(stream, ZigZag.scan(dc).tolist(), nC, 16)
+        for row, col in LUMA4x4_BLOCKS:
+            total_coeff[row, col] = encodeBlock(stream, scans[row][col][1:], nC, 15)
+        return total_coeff
+
+    blocks = [(row, col, lambda nC, levels=scans[row][col][1:]: encodeBlock(stream, levels, nC, 15))
+              for row, col in LUMA4x4_BLOCKS]
+    dc_levels = ZigZag.scan(dc).tolist()
+    total_coeff[:] = grid.code_macroblock(grid.luma, mb_row*4, mb_col*4, 4, blocks,
+                                          dc=lambda nC: encodeBlock(stream, dc_levels, nC, 16))
+    return total_coeff
+
+def encodeChroma(stream, dc, ac=None, nC=0, grid=None, mb_row=0, mb_col=0):
+    """
+    CAVLC of the chroma residual of a macroblock, residual() of 7.3.5.3
+    Args:
+        stream: BitWriter, the blocks are written at its end
+        dc: (2, 2, 2) chroma DC levels of Cb and Cr
+        ac: (2, 2, 2, 4, 4) coefficients of the 4x4 blocks of Cb and Cr indexed [iCbCr, row, column],
+            coded when coded_block_pattern has chroma AC, the DC of each block is not coded
+        nC: the nC of the AC blocks when grid is None, the DC blocks use -1
+        grid: TotalCoeffGrid of the picture, as for encodeIntra16x16()
+        mb_row, mb_col: the position of the macroblock in macroblocks
+    Returns:
+        (2, 2, 2) int8 TotalCoeff of the AC blocks
+    """
+    total_coeff = np.zeros((2, 2, 2), np.int8)
+    for levels in ZigZag.scan(np.asarray(dc)).tolist():
+        encodeBlock(stream, levels, -1, 4)
+    if ac is not None:
+        scans = ZigZag.scan(np.asarray(ac)).tolist()
+        for iCbCr in range(2):
+            blocks = [(row, col, lambda nC, levels=scans[iCbCr][row][col][1:]: encodeBlock(stream, levels, nC, 15))
+                      for row in range(2) for col in range(2)]
+            if grid is not None:
+                total_coeff[iCbCr] = grid.code_macroblock(grid.chroma[iCbCr], mb_row*2, mb_col*2, 2, blocks)
+            else:
+                for row, col, code in blocks:
+                    total_coeff[iCbCr, row, col] = code(nC)
+    return total_coeff
 
-def encode(block):
+def encode(block, nC=0):
     """
     Entropy of CAVLC
     Args:
-        block: input macroblock, should be 4x4 intger matrix
+        block: input macroblock, should be 4x4 (or 2x2 chroma DC) intger matrix
+        nC: the nC calculating from nA & nB on page 158
     returns:
-        A bitstream of CAVLC code
+        A BitWriter of CAVLC code
     """
-    #use Zigzag to scan
-    zig = ZigZag.ZigzagMatrix()
-    print("ZiaZag scan:")
-    res = zig.matrix2zig(block)
-    print(res)
-
-    #Step1: get TotalCoeffs& T1s
-    totalCoeffs = getTotalCoeffs(res)
-    print("TotalCoeffs: ", totalCoeffs)
-    if (totalCoeffs==0):
-        NoFurther = BitStream('0b0')
-        print("CAVLC: ", NoFurther.bin)
-        return NoFurther
-
-    t1s = getT1s(res)
-    print("T1s: ", t1s)
-    part1 = '0b' + vlc.coeff_token[0][totalCoeffs][t1s]
-    print("coeff token:", part1)
-
-    #step2: Encode the sign of each T1
-    part2, remains = encodeT1s(res, t1s)
-    print("T1 sign:", part2)
-
-    #step3: Encode the levels of the remaining non-zero coefficients
-    part3 = encodeLevels(remains, totalCoeffs, t1s)
-    print("encode Levels:", part3)
-
-    #Step4: Encode the total number of zeros before the last coefficient
-    totalZeros = getTotalZeros(res)
-    print("TotalZeros: ", totalZeros)
-    part4 = ''
-    if ( totalCoeffs<block.size ):
-        part4 = vlc.total_zeros[totalZeros][totalCoeffs]
-    print("encode TotalZeros: ", part4)
-
-    #step5: Encode each run of zeros
-    part5 = encodeRunBefore(res, totalCoeffs, totalZeros)
-    
-    stream = BitStream()
-    temp = part1 + part2 + part3 + part4 + part5
-    stream.append(temp)
-
-    logging.debug("CAVLC: %s", stream.bin)
-
-    # supplement zero at the end of stream, so we can print the hex code of the stream
-    output_str = stream
-    addon = 8 - len(stream.bin) % 8
-    for i in range(0, addon):
-        output_str.append('0b0')
-    logging.debug("CAVLC hex: %s", output_str.hex)
-
+    block = np.asarray(block)
+    stream = BitWriter()
+    encodeBlock(stream, ZigZag.scan(block).tolist(), nC, block.size)
+    if tracing.CAVLC:
+        logging.debug("CAVLC: %s", stream.bin)
     return stream
 
 def decode(stream, nC, maxNumCoeff=16):
@@ -285,50 +251,45 @@ def decode(stream, nC, maxNumCoeff=16):
     Args:
         nC: the nC calculating from nA & nB on page 158
         maxNumCoeff: passed in by residual_block()
-        stream: the binary data of current 4x4 macroblock
+        stream: the binary data of current 4x4 macroblock, BitStream, BitReader or bytes-like
+            a BitReader is read in place from its current position and advanced past the block
     
     Returns:
         4x4 block of coefficients after unzig-zag
-        the postion of the stream after parser
+        the bit position of the reader after the block; absolute in the whole RBSP when a
+            BitReader is passed in, otherwise counted from the start of the given stream
         the TotalCoeff of this block
     """
 
+    stream = bitreader.as_reader(stream)
+
     # step1: 9.2.1 Parsing process for total number of transform coefficient levels and trailing ones
     # on page 157 of [H.264 standard Book]
-    total = 1
-    TotalCoeff = -1
-    TrailingOnes = -1
-
     table_i = vlc.get_nC_table_index(nC)
-    while True:
-        temp = stream.peek(total)
-        result = np.where(vlc.coeff_token[table_i] == temp.bin)
-
-        if len(result[0])==0:
-            total = total + 1
-        else:
-            TotalCoeff = int(result[0])
-            TrailingOnes = int(result[1])
-            logging.debug('TotalCoeff: %d , TrailingOnes: %d ', TotalCoeff, TrailingOnes)
-            break
+    entry = vlc.coeff_token_lut[table_i][stream.peek(vlc.coeff_token_bits[table_i])]
+    if entry == 0:
+        raise ValueError("invalid coeff_token at bit %d" % stream.pos)
+    TotalCoeff = entry >> 7
+    TrailingOnes = (entry >> 5) & 0x03
+    if tracing.CAVLC:
+        logging.debug('TotalCoeff: %d , TrailingOnes: %d ', TotalCoeff, TrailingOnes)
 
-    temp = stream.read(total) #drop the data
-    #print(stream.pos)
-    #print(stream.peek(8).bin)
+    stream.skip(entry & 0x1f) #drop the data
 
     # step2: 9.2.2 Parsing process for level information
     # decode the trailing one transform coefficient levels
     level = np.zeros(maxNumCoeff)
     index = 0 # described as variable i on page 160
     for x in range(0, TrailingOnes):
-        trailing_ones_sign_flag = stream.read(1).int
+        trailing_ones_sign_flag = stream.u(1)
         if trailing_ones_sign_flag==0:
             level[x] = 1
         else:
             level[x] = -1
         index = index + 1
 
-    logging.debug("coefficient levels: %s", level) 
+    if tracing.CAVLC:
+        logging.debug("coefficient levels: %s", level) 
 
     #print(stream.pos)
     #print(stream.peek(8).bin)
@@ -341,7 +302,8 @@ def decode(stream, nC, maxNumCoeff=16):
         suffixLength = 1
     else:
         suffixLength = 0
-    logging.debug("init suffixLength: %d", suffixLength) 
+    if tracing.CAVLC:
+        logging.debug("init suffixLength: %d", suffixLength) 
 
     remaining_levels = TotalCoeff - TrailingOnes
 
@@ -355,8 +317,8 @@ def decode(stream, nC, maxNumCoeff=16):
         total = 1
         while True:
             #level_prefix is decoded using the VLC specified in Table 9-6
-            temp = stream.peek(total)
-            result = np.where(vlc.level_prefix == temp.bin)
+            temp = stream.peek_bin(total)
+            result = np.where(vlc.level_prefix == temp)
 
             if len(result[0])==0:
                 total = total + 1
@@ -364,7 +326,7 @@ def decode(stream, nC, maxNumCoeff=16):
                 level_prefix = int(result[0])
                 break
         
-        stream.read(total) #drop the level_prefix data
+        stream.skip(total) #drop the level_prefix data
         #logging.debug('level_prefix: %d ', level_prefix)
 
         if level_prefix==14 and suffixLength==0:
@@ -375,7 +337,7 @@ def decode(stream, nC, maxNumCoeff=16):
             levelSuffixSize = suffixLength
 
         if levelSuffixSize > 0:
-            level_suffix = stream.read(levelSuffixSize).uint
+            level_suffix = stream.u(levelSuffixSize)
         else:
             level_suffix = 0
 
@@ -401,14 +363,16 @@ def decode(stream, nC, maxNumCoeff=16):
         remaining_levels = remaining_levels - 1
         index = index + 1
 
-    logging.debug("coefficient levels: %s", level) 
+    if tracing.CAVLC:
+        logging.debug("coefficient levels: %s", level) 
 
     #step3: 9.2.3 Parsing process for run information
     index = 0
     zerosLeft = 0
     total_zeros = 0
     
-    logging.debug("decoding run information")
+    if tracing.CAVLC:
+        logging.debug("decoding run information")
     #print(stream.pos)
     #print(stream.peek(4).bin)
 
@@ -416,42 +380,23 @@ def decode(stream, nC, maxNumCoeff=16):
         zerosLeft = 0
     else:
         #decode total_zeros
-        if maxNumCoeff == 4:
-            #chroma parseing talbe
-            #get total zeros from table 9-9
-            if TotalCoeff>0:
-                #logging.debug('test: xxxxx')
-                total = 1
-                while True:
-                    temp = stream.peek(total)
-                    result = np.where(vlc.total_zeros_2x2[:, TotalCoeff] == temp.bin)
-
-                    if len(result[0])==0:
-                        total = total + 1
-                    else:
-                        total_zeros = int(result[0])
-                        logging.debug('total_zeros: %d', total_zeros)
-                        break
-
-                stream.read(total) #drop the level_prefix data
-                zerosLeft = total_zeros
-        else:
-            #get total zeros from table 9-7 & 9-8
-            if TotalCoeff>0:
-                total = 1
-                while True:
-                    temp = stream.peek(total)
-                    result = np.where(vlc.total_zeros[:, TotalCoeff] == temp.bin)
-
-                    if len(result[0])==0:
-                        total = total + 1
-                    else:
-                        total_zeros = int(result[0])
-                        logging.debug('total_zeros: %d', total_zeros)
-                        break
-
-                stream.read(total) #drop the level_prefix data
-                zerosLeft = total_zeros
+        if TotalCoeff>0:
+            if maxNumCoeff == 4:
+                #chroma parseing talbe, get total zeros from table 9-9
+                width = vlc.total_zeros_2x2_bits[TotalCoeff]
+                entry = vlc.total_zeros_2x2_lut[TotalCoeff][stream.peek(width)]
+            else:
+                #get total zeros from table 9-7 & 9-8
+                width = vlc.total_zeros_bits[TotalCoeff]
+                entry = vlc.total_zeros_lut[TotalCoeff][stream.peek(width)]
+            if entry == 0:
+                raise ValueError("invalid total_zeros at bit %d" % stream.pos)
+
+            total_zeros = entry >> 5
+            if tracing.CAVLC:
+                logging.debug('total_zeros: %d', total_zeros)
+            stream.skip(entry & 0x1f) #drop the total_zeros data
+            zerosLeft = total_zeros
 
     remaining_runs = TotalCoeff - 1
     run = np.zeros(maxNumCoeff, int)
@@ -463,25 +408,20 @@ def decode(stream, nC, maxNumCoeff=16):
             else:
                 zeros_index = zerosLeft
             
-            total = 1
-            while True:
-                temp = stream.peek(total)
-                result = np.where(vlc.run_before[:, zeros_index] == temp.bin)
-
-                if len(result[0])==0:
-                    total = total + 1
-                else:
-                    run_before = int(result[0])
-                    run[index] = run_before
-                
-                    logging.debug('run_before: %d', run_before)
-                    break
-
-            stream.read(total) #drop the level_prefix data
+            entry = vlc.run_before_lut[zeros_index][stream.peek(vlc.run_before_bits[zeros_index])]
+            if entry == 0:
+                raise ValueError("invalid run_before at bit %d" % stream.pos)
+
+            run_before = entry >> 5
+            run[index] = run_before
+            if tracing.CAVLC:
+                logging.debug('run_before: %d', run_before)
+            stream.skip(entry & 0x1f) #drop the run_before data
 
         else:
             run[index] = 0
-            logging.debug('run_before: %d', run[index])
+            if tracing.CAVLC:
+                logging.debug('run_before: %d', run[index])
 
         zerosLeft = zerosLeft - run[index]
         index = index + 1
@@ -491,7 +431,8 @@ def decode(stream, nC, maxNumCoeff=16):
 
         remaining_runs = remaining_runs - 1
 
-    logging.debug('run information: %s', run)
+    if tracing.CAVLC:
+        logging.debug('run information: %s', run)
 
     coeffLevel = np.zeros(maxNumCoeff, int)
     i = TotalCoeff - 1
@@ -504,57 +445,85 @@ def decode(stream, nC, maxNumCoeff=16):
 
     if maxNumCoeff==15:
         coeffLevel = np.insert(coeffLevel, 0, 0)
-    logging.debug('coeffLevel: %s', coeffLevel)
-
-    zig = ZigZag.ZigzagMatrix()
-    logging.debug("ZiaZag scan:")
+    if tracing.CAVLC:
+        logging.debug('coeffLevel: %s', coeffLevel)
+        logging.debug("ZiaZag scan:")
     matrix_x = 4
     if maxNumCoeff==15 or maxNumCoeff==16:
         matrix_x = 4
     else:
         matrix_x = 2
 
-    block = zig.zig2matrix(coeffLevel, matrix_x, matrix_x)
+    block = ZigZag.unscan(coeffLevel, matrix_x, matrix_x)
 
-    logging.debug('block: \n%s', block)
-    logging.debug('stream position: %d', stream.pos)
+    if tracing.CAVLC:
+        logging.debug('block: \n%s', block)
+        logging.debug('stream position: %d', stream.pos)
 
     return block, stream.pos, TotalCoeff
 
 def testEncode():
-    # test = np.array([[0, 3, -1, 0],
-    #                  [0, -1, 1, 0],
-    #                  [1, 0, 0, 0],
-    #                  [0, 0, 0, 0]])
-
-    test = np.array([[-2, 4, 0, -1],
-                     [3, 0, 0, 0],
-                     [-3, 0, 0, 0],
-                     [0, 0, 0, 0]])
-
-    # test = np.array([[0, 0, 1, 0],
-    #                  [0, 0, 0, 0],
-    #                  [1, 0, 0, 0],
-    #                  [-1, 0, 0, 0]])
-
-    # test = np.array([[-12, 1, -10, -3],
-    #                  [0, 0, 0, 0],
-    #                  [0, 0, 0, 0],
-    #                  [0, 0, 0, 0]])
-
-    # test = np.array([[-1, -8, 8, -4],
-    #                  [1, -1, 1, 1],
-    #                  [4, -7, 5, -3],
-    #                  [-1, 2, -1, 2]])
-
-    # test = np.array([[-78, 4, 9, 2],
-    #                  [3, -6, 1, -1],
-    #                  [2, 1, 0, -1],
-    #                  [2, 0, 0, 1]])
-
-    print("Test data:")
-    print(test)
-    encode(test)
+    """
+    Encode the examples of [the Richardson Book] on page 214-216, the streams of testDecode()
+    """
+    tests = [(np.array([[0, 3, -1, 0],
+                        [0, -1, 1, 0],
+                        [1, 0, 0, 0],
+                        [0, 0, 0, 0]]), '000010001110010111101101'),
+             (np.array([[-2, 4, 0, -1],
+                        [3, 0, 0, 0],
+                        [-3, 0, 0, 0],
+                        [0, 0, 0, 0]]), '000000011010001001000010111001100'),
+             (np.array([[0, 0, 1, 0],
+                        [0, 0, 0, 0],
+                        [1, 0, 0, 0],
+                        [-1, 0, 0, 0]]), '0001110001110010')]
+
+    for block, code in tests:
+        stream = encode(block)
+        logging.debug("CAVLC: %s", stream.bin)
+        assert stream.bin == code
+
+def testEncodeDecode(count=3000):
+    """
+    Encode random blocks for every nC table and maxNumCoeff, and decode them again
+    """
+    rng = np.random.default_rng(0)
+    for x in range(count):
+        maxNumCoeff = (16, 15, 4)[x % 3]
+        nC = -1 if maxNumCoeff == 4 else (0, 2, 4, 8)[x % 4]
+        scale = (1, 2, 5, 40, 2000)[x % 5]
+        coeffs = rng.integers(-scale, scale + 1, maxNumCoeff) * (rng.random(maxNumCoeff) < rng.random())
+
+        stream = BitWriter()
+        total = encodeBlock(stream, coeffs.tolist(), nC, maxNumCoeff)
+        block, pos, TotalCoeff = decode(stream.tobytes(), nC, maxNumCoeff)
+        levels = ZigZag.scan(block)
+        if maxNumCoeff == 15:
+            levels = levels[1:]
+        assert pos == stream.len and TotalCoeff == total == np.count_nonzero(coeffs)
+        assert (levels == coeffs).all()
+    logging.debug("CAVLC encode/decode matches on %d blocks", count)
+
+def benchmarkEncode(count=2000):
+    """
+    Time to code the luma residual of Intra16x16 macroblocks with quantized random coefficients
+    """
+    import timeit
+    rng = np.random.default_rng(0)
+    dc = rng.integers(-20, 21, (count, 4, 4))
+    ac = rng.integers(-3, 4, (count, 16, 16)) * (rng.random((count, 16, 16)) < 0.2)
+
+    def run():
+        stream = BitWriter()
+        for x in range(count):
+            encodeIntra16x16(stream, dc[x], ac[x])
+        return stream
+
+    bits = run().len
+    seconds = min(timeit.repeat(run, number=1, repeat=3))
+    print("encodeIntra16x16: %.1f us per macroblock, %.1f us per block, %.1f bits per macroblock"
+          % (seconds / count * 1e6, seconds / count / 17 * 1e6, bits / count))
 
 def testDecode():
     nC = 0
@@ -604,6 +573,36 @@ def testDecode_4():
     logging.debug('decoding CAVLC stream: %s', stream.bin)
     decode(stream, -1, 4)
 
+def benchmarkNeighborContext(mb_rows=32, mb_cols=32):
+    """
+    Bitrate and speed of Intra16x16 residual coding with the coeff_token table of nC = 0 for every block,
+    against nC from the neighbor TotalCoeff grid, on a picture with flat and busy regions
+    """
+    import timeit
+    rng = np.random.default_rng(0)
+    count = mb_rows * mb_cols
+    # the share of non-zero AC coefficients varies smoothly over the picture, up to 90 % in busy regions
+    y, x = np.mgrid[0:mb_rows*4, 0:mb_cols*4]
+    density = 0.45 + 0.45 * np.sin(x / 9.0) * np.cos(y / 13.0)
+    density = np.repeat(np.repeat(density, 4, 0), 4, 1).reshape(mb_rows, 16, mb_cols, 16).swapaxes(1, 2)
+    levels = rng.integers(1, 4, (mb_rows, mb_cols, 16, 16)) * rng.choice([-1, 1], (mb_rows, mb_cols, 16, 16))
+    ac = levels * (rng.random((mb_rows, mb_cols, 16, 16)) < density)
+    dc = rng.integers(-20, 21, (mb_rows, mb_cols, 4, 4))
+
+    def run(neighbors):
+        stream = BitWriter()
+        grid = TotalCoeffGrid(mb_rows*16, mb_cols*16) if neighbors else None
+        for row in range(mb_rows):
+            for col in range(mb_cols):
+                encodeIntra16x16(stream, dc[row, col], ac[row, col], grid=grid, mb_row=row, mb_col=col)
+        return stream
+
+    for name, neighbors in (("nC = 0", False), ("nC from nA/nB", True)):
+        bits = run(neighbors).len
+        seconds = min(timeit.repeat(lambda: run(neighbors), number=1, repeat=3))
+        print("%-14s %8d bits, %6.1f bits per macroblock, %6.1f us per macroblock"
+              % (name, bits, bits / count, seconds / count * 1e6))
+
 if __name__ == "__main__":
     logging.basicConfig(
         level=logging.DEBUG,
@@ -614,7 +613,10 @@ if __name__ == "__main__":
         ]
     )
 
-    #testEncode()
+    testEncode()
+    testEncodeDecode()
+    benchmarkEncode()
+    benchmarkNeighborContext()
     #testDecode()
 
     #testDecode_15()
@@ -1,19 +1,20 @@
 # use dct formula to do dct & idct calculation
 import numpy as np
-from scipy.fftpack import fft, dct
-import scipy
-import matplotlib.pyplot as plt
-import matplotlib
 import math
 from numpy import r_
 import tools
 import logging
 
+# scipy and matplotlib are imported inside the functions that need them,
+# so that importing this module stays cheap for the codec
+
 def block2dct(a):
-    return scipy.fftpack.dct( scipy.fftpack.dct( a, axis=0, norm='ortho' ), axis=1, norm='ortho' )
+    from scipy import fftpack
+    return fftpack.dct( fftpack.dct( a, axis=0, norm='ortho' ), axis=1, norm='ortho' )
 
 def dct2block(a):
-    return scipy.fftpack.idct( scipy.fftpack.idct( a, axis=0 , norm='ortho'), axis=1 , norm='ortho')
+    from scipy import fftpack
+    return fftpack.idct( fftpack.idct( a, axis=0 , norm='ortho'), axis=1 , norm='ortho')
 
 def normalization(data):
     _range = np.max(data) - np.min(data)
@@ -22,6 +23,7 @@ def normalization(data):
 #show all the block in big image, with two margin within two block
 # U is 4D array, which is N*N matrix's basis pattern
 def showBasisPatternTogether(U, N=4):
+    import matplotlib.pyplot as plt
     margin = 1 # margin pixel of the bigshow
     # key steps for normalization, must use mean as initialization
     mean = (np.max(U) - np.min(U))/2
@@ -172,6 +174,7 @@ def processCheck():
     print(S_scipy)
 
 def processWholeImage():
+    import matplotlib.pyplot as plt
     im = plt.imread("lena2.tif").astype(float)
     print(im.shape)
     
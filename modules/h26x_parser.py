@@ -25,8 +25,10 @@
 
 from bitstring import BitStream
 from itertools import islice
+import mmap
 import sys
 import os
+import numpy as np
 
 try:
     from future_builtins import zip
@@ -38,6 +40,177 @@ except ImportError:  # not 2.6+ or is 3.x
 
 import nalutypes
 
+START_CODE_SHORT = b'\x00\x00\x01'
+EMULATION_PREVENTION = b'\x00\x00\x03'
+
+def find_start_codes(data, start=0, end=None):
+    """
+    Locate every Annex B start code in a byte buffer with a single pass.
+
+    Both 0x000001 and 0x00000001 prefixes are found by searching for the
+    3-byte pattern only; a hit preceded by a zero byte is reported as a
+    4-byte start code.
+
+    data: bytes-like object supporting find(), e.g. bytes, bytearray or mmap
+    start, end: byte range to scan
+    Returns a list of byte offsets, one for the first byte of each start code.
+    """
+    if end is None:
+        end = len(data)
+
+    positions = []
+    pos = data.find(START_CODE_SHORT, start, end)
+    while pos != -1:
+        if pos > start and data[pos - 1] == 0:
+            positions.append(pos - 1)
+        else:
+            positions.append(pos)
+        pos = data.find(START_CODE_SHORT, pos + 3, end)
+
+    return positions
+
+def ebsp_to_rbsp(ebsp):
+    """
+    Remove all emulation prevention bytes (the 0x03 of every 0x000003) from a NAL payload.
+
+    The 0x03 bytes are located with one vectorized search, and the RBSP is assembled by
+    bulk copies into a single buffer. Matches never overlap and are not affected by
+    earlier removals, so this is the same as the byte-wise scan of 7.3.1.
+
+    ebsp: bytes-like payload without start code and NAL header
+    Returns the input object itself when there is nothing to remove, otherwise a bytearray.
+    """
+    find = getattr(ebsp, 'find', None)
+    if find is not None and find(EMULATION_PREVENTION) == -1:
+        return ebsp
+
+    buf = np.frombuffer(ebsp, dtype=np.uint8)
+    candidates = np.flatnonzero(buf[2:] == 3)
+    hits = candidates[(buf[candidates] == 0) & (buf[candidates + 1] == 0)] + 2
+    if hits.size == 0:
+        return ebsp
+
+    src = memoryview(ebsp).cast('B')
+    rbsp = bytearray(buf.size - hits.size)
+    src_pos = 0
+    dst_pos = 0
+    for hit in hits.tolist():
+        length = hit - src_pos
+        rbsp[dst_pos: dst_pos + length] = src[src_pos: hit]
+        dst_pos += length
+        src_pos = hit + 1
+    rbsp[dst_pos:] = src[src_pos:]
+
+    return rbsp
+
+class AnnexBSplitter:
+    """
+    Incremental splitter of an Annex B byte stream into NAL units.
+
+    Chunks of any size are pushed with feed(), and only the bytes of the NALU which is
+    not complete yet are kept. The trailing zero bytes in front of a start code
+    (zero_byte, trailing_zero_8bits) are dropped from the NALUs.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.nalu_start = None  # offset of the current NAL header in buffer
+        self.scan_pos = 0
+
+    @staticmethod
+    def _unpack(nalu):
+        """
+        Returns (nal_unit_type, nal_ref_idc, rbsp) of a NALU without start code,
+        or None for an empty NALU
+        """
+        end = len(nalu)
+        while end > 0 and nalu[end - 1] == 0:
+            end -= 1
+        if end == 0:
+            return None
+        nal_ref_idc = (nalu[0] >> 5) & 0x03
+        nal_unit_type = nalu[0] & 0x1f
+        return nal_unit_type, nal_ref_idc, ebsp_to_rbsp(nalu[1:end])
+
+    def feed(self, chunk):
+        """
+        Append a chunk of the byte stream
+        Returns a list of (nal_unit_type, nal_ref_idc, rbsp) for every NALU completed by it
+        """
+        buf = self.buffer
+        buf += chunk
+        result = []
+
+        pos = buf.find(START_CODE_SHORT, self.scan_pos)
+        while pos != -1:
+            if self.nalu_start is not None:
+                nalu = self._unpack(buf[self.nalu_start: pos])
+                if nalu is not None:
+                    result.append(nalu)
+            self.nalu_start = pos + 3
+            pos = buf.find(START_CODE_SHORT, self.nalu_start)
+
+        # drop everything before the current NALU, keep two bytes of a possibly split start code
+        if self.nalu_start is None:
+            keep = max(len(buf) - 2, 0)
+        else:
+            keep = self.nalu_start
+        del buf[:keep]
+        if self.nalu_start is not None:
+            self.nalu_start = 0
+        self.scan_pos = max(len(buf) - 2, 0)
+
+        return result
+
+    def flush(self):
+        """
+        Finish the stream
+        Returns a list with the (nal_unit_type, nal_ref_idc, rbsp) of the last NALU, if any
+        """
+        result = []
+        if self.nalu_start is not None:
+            nalu = self._unpack(self.buffer[self.nalu_start:])
+            if nalu is not None:
+                result.append(nalu)
+        self.buffer = bytearray()
+        self.nalu_start = None
+        self.scan_pos = 0
+        return result
+
+def iter_nalus(f, chunk_size=1 << 16):
+    """
+    Read an Annex B stream incrementally from a file-like object, e.g. an open file,
+    sys.stdin.buffer or socket.makefile('rb'), and yield every NALU as soon as it is complete.
+
+    f: object with a read(size) method returning bytes, b'' at the end of the stream
+    chunk_size: number of bytes requested per read
+    Yields (nal_unit_type, nal_ref_idc, rbsp) tuples, rbsp is bytes-like.
+    """
+    splitter = AnnexBSplitter()
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        for nalu in splitter.feed(chunk):
+            yield nalu
+    for nalu in splitter.flush():
+        yield nalu
+
+async def aiter_nalus(reader, chunk_size=1 << 16):
+    """
+    Asynchronous version of iter_nalus() for streams whose read(size) is a coroutine,
+    e.g. asyncio.StreamReader.
+    """
+    splitter = AnnexBSplitter()
+    while True:
+        chunk = await reader.read(chunk_size)
+        if not chunk:
+            break
+        for nalu in splitter.feed(chunk):
+            yield nalu
+    for nalu in splitter.flush():
+        yield nalu
+
 class H26xParser:
     """
     H.264 extractor for Annex B streams.
@@ -53,18 +226,24 @@ class H26xParser:
         "nalu"
     ]
 
-    def __init__(self, f, verbose=False, use_bitstream=None):
+    def __init__(self, f, verbose=False, use_bitstream=None, use_mmap=False):
         """
         Create a new extractor for a .264/h264 file in Annex B format.
 
         f: input file
         use_bitstream: blob to use as bitstream (for testing)
         verbose: whether to print out NAL structure and fields
+        use_mmap: memory-map the input file and hand every NALU to the callbacks as a
+                  memoryview into the mapping instead of a BitStream, see set_callback()
         """
+        self.use_mmap = use_mmap
+        self.data = None
         if use_bitstream:
             # testing the parser in a bitstream
             self.file = None
             self.stream = BitStream(use_bitstream)
+            if use_mmap:
+                self.data = bytes(self.stream.tobytes())
         else:
             fn, ext = os.path.splitext(os.path.basename(f))
             valid_input_ext = ['.264', '.h264']
@@ -74,7 +253,11 @@ class H26xParser:
                 raise RuntimeError("Valid input types: " + str(valid_input_ext))
             bitstream_file = f
             self.file = bitstream_file
-            self.stream = BitStream(filename=bitstream_file)
+            if use_mmap:
+                self.stream = None
+                self.data = self._map_file(bitstream_file)
+            else:
+                self.stream = BitStream(filename=bitstream_file)
         self.verbose = verbose
         self.callbacks = {}
 
@@ -91,6 +274,10 @@ class H26xParser:
 
         Raw data for all callbacks never includes the start code, but all the NAL headers, except
         for the "nalu" callback.
+
+        In use_mmap mode the "nalu" callback gets a memoryview into the file mapping, and the
+        other callbacks get the RBSP as a memoryview too when the NALU has no emulation
+        prevention bytes, otherwise as bytes. Views are only valid until close() is called.
         """
         if name not in self.VALID_CALLBACKS:
             raise RuntimeError(name + " is not a valid callback. Choose one of " + str(self.VALID_CALLBACKS) + ".")
@@ -114,29 +301,52 @@ class H26xParser:
         else:
             self.callbacks[name](*args)
 
+    @staticmethod
+    def _map_file(filename):
+        """
+        Returns a read-only mmap of the file, or empty bytes for an empty file
+        """
+        if os.path.getsize(filename) == 0:
+            return b''
+        with open(filename, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        """
+        Release the file mapping of use_mmap mode, the map stays until the last NALU view is gone
+        """
+        if isinstance(self.data, mmap.mmap):
+            try:
+                self.data.close()
+            except BufferError:
+                pass   # a parser still holds a NALU view
+        self.data = None
+
     def _get_nalu_positions(self):
         """
-        Saves all the NALU positions as bit positions in self.nal_unit_positions
+        Saves all the NALU positions as bit positions in self.nal_unit_positions,
+        and as byte positions in self.nal_unit_byte_positions
         """
-        self.nal_unit_positions = list(self.stream.findall(self.START_CODE_PREFIX, bytealigned=True))
-        self.short_nal_unit_positions = list(self.stream.findall(self.START_CODE_PREFIX_SHORT, bytealigned=True))
+        if self.data is not None:
+            byte_positions = find_start_codes(self.data)
+        elif self.file is not None and os.path.getsize(self.file) > 0:
+            with open(self.file, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    byte_positions = find_start_codes(data)
+        else:
+            byte_positions = find_start_codes(self.stream.tobytes())
 
-        if not self.nal_unit_positions and not self.short_nal_unit_positions:
+        if not byte_positions:
             print("No NALUs found in stream")
             sys.exit(1)
 
-        if not self.nal_unit_positions:
-            self.nal_unit_positions = self.short_nal_unit_positions
+        self.nal_unit_byte_positions = byte_positions
+        self.nal_unit_positions = [pos * 8 for pos in byte_positions]
+        if self.data is not None:
+            self.end_of_stream = len(self.data) * 8
         else:
-            # if there were extraneous 3-byte NAL unit start codes, use them too
-            extra_nal_unit_pos = set([max(s - 8, 0) for s in self.short_nal_unit_positions]) - set(self.nal_unit_positions)
-            if len(extra_nal_unit_pos) and self.nal_unit_positions:
-                if self.verbose:
-                    print("Warning: 3-byte extra NAL unit start code found")
-                self.nal_unit_positions.extend([s + 8 for s in extra_nal_unit_pos])
-                self.nal_unit_positions = sorted(self.nal_unit_positions)
-
-        self.end_of_stream = len(self.stream)
+            self.end_of_stream = len(self.stream)
+        self.nal_unit_byte_positions.append(self.end_of_stream // 8)
         self.nal_unit_positions.append(self.end_of_stream)
         return self.nal_unit_positions
 
@@ -153,20 +363,82 @@ class H26xParser:
         nal_unit_type = nalu_bytes.read('uint:5')
         nal_unit_payload = nalu_bytes[nalu_bytes.pos:]
 
-        rbsp_payload = BitStream()
-        for i in range(int(len(nal_unit_payload)/8)):
-            if len(nal_unit_payload) - nal_unit_payload.pos >= 24 and \
-               nal_unit_payload.peek('bits:24') == '0x000003':
-                rbsp_payload.append(nal_unit_payload.read('bits:8'))
-                rbsp_payload.append(nal_unit_payload.read('bits:8'))
-                nal_unit_payload.read('bits:8')
-            else:
-                if nal_unit_payload.pos == len(nal_unit_payload):
-                    continue
-                rbsp_payload.append(nal_unit_payload.read('bits:8'))
+        rbsp_payload = BitStream(bytes=ebsp_to_rbsp(nal_unit_payload.bytes))
 
         return nal_unit_type, rbsp_payload
 
+    def _decode_nalu_view(self, nalu_view, start, end):
+        """
+        Returns nal_unit_type, nal_ref_idc and RBSP payload of a NALU mapped at
+        data[start:end], without copying when there is no emulation prevention byte
+
+        nalu_view: memoryview of data[start:end], including the start code
+        """
+        if nalu_view[2] == 1:
+            header = 3
+        else:
+            header = 4
+        nal_ref_idc = (nalu_view[header] >> 5) & 0x03
+        nal_unit_type = nalu_view[header] & 0x1f
+
+        if self.data.find(EMULATION_PREVENTION, start + header + 1, end) == -1:
+            rbsp_payload = nalu_view[header + 1:]
+        else:
+            rbsp_payload = ebsp_to_rbsp(nalu_view[header + 1:])
+
+        return nal_unit_type, nal_ref_idc, rbsp_payload
+
+    def _parse_mmap(self):
+        """
+        Parse the mapped file, handing memoryviews of each NALU to the callbacks
+        """
+        view = memoryview(self.data)
+        nalu_sps = None
+        nalu_pps = None
+        positions = self.nal_unit_byte_positions
+        for current_nalu_bytepos, next_nalu_bytepos in zip(positions, islice(positions, 1, None)):
+            nalu_view = view[current_nalu_bytepos: next_nalu_bytepos]
+
+            self.__call('nalu', nalu_view)
+
+            if self.verbose:
+                print("")
+                print("========================================================================================================")
+                print("")
+                print("NALU bytepos:\t[" + str(current_nalu_bytepos) + ", " + str(next_nalu_bytepos - 1) + "]")
+                print("NALU offset:\t" + str(current_nalu_bytepos) + " Bytes")
+                print("NALU length:\t" + str(next_nalu_bytepos - current_nalu_bytepos) + " Bytes (including start code)")
+
+            nal_unit_type, nal_ref_idc, rbsp_payload = self._decode_nalu_view(nalu_view, current_nalu_bytepos, next_nalu_bytepos)
+
+            if self.verbose:
+                # the syntax tables are only built for printing, so the RBSP is copied just here
+                rbsp_stream = BitStream(bytes=rbsp_payload)
+                print("NALU type:\t" + str(nal_unit_type) + " (" + nalutypes.get_description(nal_unit_type) + ")")
+                print("NALU bytes:\t" + str(BitStream(bytes=nalu_view)))
+                print("NALU RBSP:\t" + str(rbsp_stream))
+                print("")
+                if nal_unit_type == nalutypes.NAL_UNIT_TYPE_SPS:
+                    nalu_sps = nalutypes.SPS(rbsp_stream, self.verbose)
+                elif nal_unit_type == nalutypes.NAL_UNIT_TYPE_PPS:
+                    nalu_pps = nalutypes.PPS(rbsp_stream, self.verbose)
+                elif nal_unit_type == nalutypes.NAL_UNIT_TYPE_AUD:
+                    nalutypes.AUD(rbsp_stream, self.verbose)
+                elif nal_unit_type == nalutypes.NAL_UNIT_TYPE_CODED_SLICE_NON_IDR:
+                    nalutypes.CodedSliceNonIDR(rbsp_stream, nalu_sps, nalu_pps, self.verbose)
+                elif nal_unit_type == nalutypes.NAL_UNIT_TYPE_CODED_SLICE_IDR:
+                    nalutypes.CodedSliceIDR(rbsp_stream, nalu_sps, nalu_pps, self.verbose)
+
+            if nal_unit_type == nalutypes.NAL_UNIT_TYPE_SPS:
+                self.__call('sps', rbsp_payload)
+            elif nal_unit_type == nalutypes.NAL_UNIT_TYPE_PPS:
+                self.__call('pps', rbsp_payload)
+            elif nal_unit_type == nalutypes.NAL_UNIT_TYPE_AUD:
+                self.__call('aud', rbsp_payload)
+            elif (nal_unit_type == nalutypes.NAL_UNIT_TYPE_CODED_SLICE_NON_IDR or
+                  nal_unit_type == nalutypes.NAL_UNIT_TYPE_CODED_SLICE_IDR):
+                self.__call('slice', rbsp_payload)
+
     def parse(self):
         """
         Parse the bitstream and extract each NALU.
@@ -174,6 +446,10 @@ class H26xParser:
         """
 
         self._get_nalu_positions()
+        if self.use_mmap:
+            self._parse_mmap()
+            return
+
         nalu_sps = None
         nalu_pps = None
         for current_nalu_pos, next_nalu_pos in zip(self.nal_unit_positions, islice(self.nal_unit_positions, 1, None)):
@@ -0,0 +1,235 @@
+# Persistent NALU index of Annex B files, for random access
+#
+# Copyright (C) <2020>  <cookwhy@qq.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Sidecar layout, all little endian:
+#   header: magic 'NIDX', u32 version, u64 source size, u64 source mtime (ns), u64 count
+#   records: count * INDEX_DTYPE
+
+import logging
+import os
+import struct
+import mmap
+import numpy as np
+from bitstring import BitStream, ReadError
+import h26x_parser
+import nalutypes
+
+INDEX_MAGIC = b'NIDX'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<4sIQQQ')
+INDEX_SUFFIX = '.idx'
+
+# flags of a record
+FLAG_IDR = 0x01
+FLAG_FIRST_SLICE = 0x02   # first_mb_in_slice == 0, i.e. the start of a new picture
+
+INDEX_DTYPE = np.dtype([
+    ('offset', '<u8'),         # byte offset of the start code
+    ('length', '<u4'),         # byte length, including the start code
+    ('frame_num', '<u4'),      # frame_num of slices, 0 for other NALUs
+    ('nal_unit_type', 'u1'),
+    ('nal_ref_idc', 'u1'),
+    ('flags', 'u1'),
+    ('reserved', 'u1'),
+])
+
+# enough RBSP to hold the slice header fields up to frame_num
+SLICE_HEADER_PEEK = 32
+
+def _parse_slice_prefix(rbsp, log2_max_frame_num_minus4):
+    """
+    Read first_mb_in_slice and frame_num from the beginning of a slice header
+    Returns:
+        first_mb_in_slice, frame_num
+    """
+    stream = BitStream(bytes=rbsp)
+    first_mb_in_slice = stream.read('ue')
+    stream.read('ue')   # slice_type
+    stream.read('ue')   # pic_parameter_set_id
+    frame_num = stream.read(log2_max_frame_num_minus4 + 4).uint
+    return first_mb_in_slice, frame_num
+
+def build_index(filename):
+    """
+    Scan an Annex B file and describe each NALU
+    Args:
+        filename: .264/.h264 file
+    Returns:
+        numpy array of INDEX_DTYPE, one record per NALU
+    """
+    if os.path.getsize(filename) == 0:
+        return np.zeros(0, INDEX_DTYPE)
+
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            positions = h26x_parser.find_start_codes(data)
+            positions.append(len(data))
+
+            index = np.zeros(len(positions) - 1, INDEX_DTYPE)
+            log2_max_frame_num_minus4 = None
+            for i in range(len(positions) - 1):
+                start = positions[i]
+                end = positions[i + 1]
+                header = start + (3 if data[start + 2] == 1 else 4)
+                if header >= end:
+                    continue
+
+                nal_ref_idc = (data[header] >> 5) & 0x03
+                nal_unit_type = data[header] & 0x1f
+                record = index[i]
+                record['offset'] = start
+                record['length'] = end - start
+                record['nal_unit_type'] = nal_unit_type
+                record['nal_ref_idc'] = nal_ref_idc
+
+                if nal_unit_type == nalutypes.NAL_UNIT_TYPE_SPS:
+                    rbsp = h26x_parser.ebsp_to_rbsp(data[header + 1: end])
+                    sps = nalutypes.SPS(BitStream(bytes=rbsp), False)
+                    log2_max_frame_num_minus4 = sps.log2_max_frame_num_minus4
+                elif (nal_unit_type == nalutypes.NAL_UNIT_TYPE_CODED_SLICE_NON_IDR or
+                      nal_unit_type == nalutypes.NAL_UNIT_TYPE_CODED_SLICE_IDR):
+                    flags = 0
+                    if nal_unit_type == nalutypes.NAL_UNIT_TYPE_CODED_SLICE_IDR:
+                        flags |= FLAG_IDR
+                    if log2_max_frame_num_minus4 is None:
+                        logging.warning("slice at byte %d before any SPS", start)
+                    else:
+                        peek_end = min(header + 1 + SLICE_HEADER_PEEK, end)
+                        rbsp = h26x_parser.ebsp_to_rbsp(data[header + 1: peek_end])
+                        try:
+                            first_mb_in_slice, frame_num = _parse_slice_prefix(rbsp, log2_max_frame_num_minus4)
+                        except ReadError:
+                            logging.warning("truncated slice header at byte %d", start)
+                        else:
+                            record['frame_num'] = frame_num
+                            if first_mb_in_slice == 0:
+                                flags |= FLAG_FIRST_SLICE
+                    record['flags'] = flags
+
+    return index
+
+def save_index(index, index_file, source_file):
+    """
+    Write the index to a sidecar file, stamped with the size and mtime of the source file
+    """
+    st = os.stat(source_file)
+    with open(index_file, 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, st.st_size, st.st_mtime_ns, len(index)))
+        f.write(np.ascontiguousarray(index, INDEX_DTYPE).tobytes())
+
+def load_index(index_file, source_file=None):
+    """
+    Read a sidecar index file
+    Args:
+        index_file: the sidecar file
+        source_file: if given, the index is only accepted when it matches this file's size and mtime
+    Returns:
+        numpy array of INDEX_DTYPE, or None if the sidecar is missing, corrupt or stale
+    """
+    try:
+        with open(index_file, 'rb') as f:
+            head = f.read(INDEX_HEADER.size)
+            if len(head) != INDEX_HEADER.size:
+                return None
+            magic, version, size, mtime_ns, count = INDEX_HEADER.unpack(head)
+            if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                return None
+            if source_file is not None:
+                st = os.stat(source_file)
+                if st.st_size != size or st.st_mtime_ns != mtime_ns:
+                    return None
+            index = np.fromfile(f, INDEX_DTYPE, count)
+    except OSError:
+        return None
+
+    if len(index) != count:
+        return None
+    return index
+
+def open_index(filename, rebuild=False):
+    """
+    Load the sidecar index of an Annex B file, building and saving it first when needed
+    Args:
+        filename: .264/.h264 file, the sidecar is filename + INDEX_SUFFIX
+        rebuild: ignore an existing sidecar
+    Returns:
+        numpy array of INDEX_DTYPE
+    """
+    index_file = filename + INDEX_SUFFIX
+    index = None
+    if not rebuild:
+        index = load_index(index_file, filename)
+
+    if index is None:
+        logging.info("building NALU index of %s", filename)
+        index = build_index(filename)
+        try:
+            save_index(index, index_file, filename)
+        except OSError as e:
+            logging.warning("can not write NALU index %s: %s", index_file, e)
+
+    return index
+
+def seek_frame(index, frame):
+    """
+    Find where decoding has to start to reach a picture
+    Args:
+        index: NALU index from open_index()
+        frame: number of the picture in decoding order, counting from 0
+    Returns:
+        row of the first slice of the nearest IDR picture at or before the frame
+    """
+    first_slices = np.flatnonzero(index['flags'] & FLAG_FIRST_SLICE)
+    if frame < 0 or frame >= len(first_slices):
+        raise IndexError("frame %d out of range, the stream has %d pictures" % (frame, len(first_slices)))
+
+    idr = first_slices[:frame + 1][(index['flags'][first_slices[:frame + 1]] & FLAG_IDR) != 0]
+    if len(idr) == 0:
+        raise ValueError("no IDR picture before frame %d" % frame)
+
+    return int(idr[-1])
+
+def iter_from_frame(filename, index, frame):
+    """
+    Yield the NALUs needed to decode from the IDR picture before a frame
+    The last SPS and PPS before that IDR come first, then every NALU from the IDR on.
+    Args:
+        filename: the indexed file
+        index: NALU index from open_index()
+        frame: number of the picture in decoding order
+    Yields:
+        (nal_unit_type, nal_ref_idc, rbsp) tuples, rbsp is bytes-like
+    """
+    row = seek_frame(index, frame)
+
+    rows = []
+    for nal_unit_type in [nalutypes.NAL_UNIT_TYPE_SPS, nalutypes.NAL_UNIT_TYPE_PPS]:
+        found = np.flatnonzero(index['nal_unit_type'][:row] == nal_unit_type)
+        if len(found):
+            rows.append(int(found[-1]))
+
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for i in rows + list(range(row, len(index))):
+                record = index[i]
+                start = int(record['offset'])
+                end = start + int(record['length'])
+                header = start + (3 if data[start + 2] == 1 else 4)
+                if header >= end:
+                    continue
+                rbsp = h26x_parser.ebsp_to_rbsp(data[header + 1: end])
+                yield int(record['nal_unit_type']), int(record['nal_ref_idc']), rbsp
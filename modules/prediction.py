@@ -15,17 +15,28 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import matplotlib.pyplot as plt
 import numpy as np
 from numpy import r_
 import sys
 import ZigZag
 import tools
+import transform
+import tracing
 import logging
 import copy
 import dct_formula_2D
 
 # the function mode0_16x16 to mode3_16x16 is according to Table 8-3 on page 106 of [H.264 standard Book]
+# H, V and P can be stacks of neighbors, e.g. H of shape (N, 16) and P of shape (N,),
+# then the prediction has shape (N,) + size, one block for each set of neighbors
+
+# (x-7) and (y-7) of the plane prediction, x is the column and y is the row
+PLANE_X = np.arange(16) - 7
+PLANE_Y = PLANE_X[:, None]
+
+# weights (x+1) of the plane gradients, x from 0 to 7
+PLANE_WEIGHTS = np.arange(1, 9)
+
 def mode0_16x16(size, H):
     """
     16x16 block's Mode 0 (Vertical) prediction mode
@@ -35,12 +46,12 @@ def mode0_16x16(size, H):
     Return:
         the prediction result
     """
-    logging.debug("H: %s", H)
-    temp = np.zeros(size, int)
-    for i in range(0, size[1]):
-        temp[i,:] = H
+    if tracing.PREDICTION:
+        logging.debug("H: %s", H)
+    H = np.asarray(H)
+    temp = np.empty(H.shape[:-1] + tuple(size), int)
+    temp[...] = H[..., None, :]
 
-    #print(temp)
     return temp
 
 def mode1_16x16(size, V):
@@ -52,10 +63,11 @@ def mode1_16x16(size, V):
     Return:
         the prediction result
     """
-    logging.debug("V: %s", V)
-    temp = np.zeros(size, int)
-    for j in range(0, size[1]):
-        temp[:,j] = V
+    if tracing.PREDICTION:
+        logging.debug("V: %s", V)
+    V = np.asarray(V)
+    temp = np.empty(V.shape[:-1] + tuple(size), int)
+    temp[...] = V[..., :, None]
 
     return temp
 
@@ -69,26 +81,22 @@ def mode2_16x16(size, H, V):
     Return:
         the prediction result
     """
-    H_Available = False if np.sum(H<0) > 0 else True
-    V_Available = False if np.sum(V<0) > 0 else True
-    logging.debug("H: %s", H)
-    logging.debug("V: %s", V)
-    mean = 0
-    if H_Available and V_Available:
-        logging.debug("H & V are available")
-        mean = ((np.sum(H) + np.sum(V)) + 16) >> 5
-    elif H_Available and (not V_Available):
-        logging.debug("H are available")
-        mean =  (np.sum(H)+8) >> 4
-    elif (not H_Available) and V_Available:
-        logging.debug("V are available")
-        mean =  (np.sum(V)+8) >> 4
-    else:
-        logging.debug("H & V are not available")
-        mean = 128
-
-    temp = np.zeros(size, int)
-    temp[:] = int(mean)
+    if tracing.PREDICTION:
+        logging.debug("H: %s", H)
+        logging.debug("V: %s", V)
+    H = np.asarray(H, int)
+    V = np.asarray(V, int)
+    H_Available = np.all(H >= 0, axis=-1)
+    V_Available = np.all(V >= 0, axis=-1)
+    H_sum = np.sum(H, axis=-1)
+    V_sum = np.sum(V, axis=-1)
+
+    mean = np.where(H_Available & V_Available, (H_sum + V_sum + 16) >> 5,
+           np.where(H_Available, (H_sum + 8) >> 4,
+           np.where(V_Available, (V_sum + 8) >> 4, 128)))
+
+    temp = np.empty(mean.shape + tuple(size), int)
+    temp[...] = mean[..., None, None]
 
     return temp
 
@@ -109,6 +117,13 @@ def Clip1(x):
     """
     return Clip3( int(0), int(255), x)
 
+def _plane_gradient(X, P):
+    """
+    sum of (x+1)*(X[8+x]-X[6-x]) for x from 0 to 7, with P in place of X[-1]
+    """
+    left = np.concatenate([X[..., 6::-1], np.broadcast_to(P, X.shape[:-1] + (1,))], axis=-1)
+    return np.sum(PLANE_WEIGHTS * (X[..., 8:16] - left), axis=-1)
+
 # TODO: this function should be verified by x264 related code
 def mode3_16x16(size, H, V, P):
     """
@@ -121,99 +136,129 @@ def mode3_16x16(size, H, V, P):
     Return:
         the prediction result
     """
-    logging.debug("H: %s", H)
-    logging.debug("V: %s", V)
-    logging.debug("p: %d", P)
-    h = 0
-    v = 0
-
-    for x in range(0,8):
-        if (x==7):
-            h = h + (x+1)*(H[8+x]-P)   # use P point value to replace p[-1, -1]
-        else:
-            h = h + (x+1)*(H[8+x]-H[6-x])
-
-    for y in range(0,8):
-        if (y==7):
-            v = v + (y+1)*(V[8+y]-P)   # use P point value to replace p[-1, -1]
-        else:
-            v = v + (y+1)*(V[8+y]-V[6-y])
-
-    a = 16*( H[15] + V[15] )
+    if tracing.PREDICTION:
+        logging.debug("H: %s", H)
+        logging.debug("V: %s", V)
+        logging.debug("p: %s", P)
+    H = np.asarray(H, int)
+    V = np.asarray(V, int)
+    P = np.asarray(P, int)[..., None]   # use P point value to replace p[-1, -1]
+
+    h = _plane_gradient(H, P)
+    v = _plane_gradient(V, P)
+
+    a = 16*( H[..., 15] + V[..., 15] )
     b = ( 5*h + 32 ) >> 6
     c = ( 5*v + 32 ) >> 6
 
-    temp = np.zeros(size, int)
+    pred = (a[..., None, None] + b[..., None, None]*PLANE_X[:size[1]] + c[..., None, None]*PLANE_Y[:size[0]] + 16) >> 5
 
-    for x in range(0,16):
-        for y in range(0,16):
-            pred = int( (a + b*(x-7) + c*(y-7) + 16) >> 5 )
-            temp[y,x] = Clip1( pred )   # Attention: here x, y is inverse of matrix [y,x]
+    return np.clip(pred, 0, 255)
 
-    return temp
+# cost functions of the intra mode decision
+COST_SAD = 'sad'
+COST_SATD = 'satd'
 
-def pickTheBestMode(block, H, V, P):
-    temp0 = mode0_16x16(block.shape, H)
-    diff0 = tools.SAE(block, temp0)
-    
-    temp1 = mode1_16x16(block.shape, V)
-    diff1 = tools.SAE(block, temp1)
+def predictIntra16x16Modes(size, H, V, P):
+    """
+    All the Intra16x16 prediction modes of one block or a stack of blocks
+    Args:
+        size: the prediction block's size, should be 16x16 here
+        H, V, P: the neighbors, as in mode0_16x16 to mode3_16x16
+    Return:
+        predictions of shape (..., 4) + size, indexed by the mode number
+    """
+    return np.stack([mode0_16x16(size, H),
+                     mode1_16x16(size, V),
+                     mode2_16x16(size, H, V),
+                     mode3_16x16(size, H, V, P)], axis=-3)
 
-    temp2 = mode2_16x16(block.shape, H, V)
-    diff2 = tools.SAE(block, temp2)
+def SATD(diff):
+    """
+    Sum of absolute 4x4 Hadamard transformed differences, halved as in the usual SATD
+    Args:
+        diff: differences of shape (..., m, n), m and n are multiples of 4
+    Return:
+        the SATD of each m x n block
+    """
+    m, n = diff.shape[-2:]
+    blocks = diff.reshape(diff.shape[:-2] + (m // 4, 4, n // 4, 4))
+    coeffs = np.einsum('ir,...arbc,cj->...aibj', transform.HWd, blocks, transform.HWd)
+    return np.sum(np.abs(coeffs), axis=(-4, -3, -2, -1)) >> 1
 
-    temp3 = mode3_16x16(block.shape, H, V, P)
-    diff3 = tools.SAE(block, temp3)
+def decideIntra16x16Mode(block, H, V, P, cost=COST_SAD):
+    """
+    Intra16x16 mode decision, all modes of all blocks are evaluated as one tensor
+    Args:
+        block: the block to predict, 16x16 or a stack of shape (N, 16, 16)
+        H, V, P: the neighbors, as in mode0_16x16 to mode3_16x16
+        cost: COST_SAD or COST_SATD
+    Return:
+        mode: the best mode of each block, the first one on ties
+        cost: the cost of the best mode
+        prediction: the prediction of the best mode, the shape of block
+    """
+    block = np.asarray(block, int)
+    predictions = predictIntra16x16Modes(block.shape[-2:], H, V, P)
+    diff = block[..., None, :, :] - predictions
+
+    if cost == COST_SAD:
+        costs = np.sum(np.abs(diff), axis=(-2, -1))
+    elif cost == COST_SATD:
+        costs = SATD(diff)
+    else:
+        raise ValueError("unknown intra mode decision cost: %s" % cost)
+
+    mode = np.argmin(costs, axis=-1)
+    best_cost = np.take_along_axis(costs, mode[..., None], axis=-1)[..., 0]
+    prediction = np.take_along_axis(predictions, mode[..., None, None, None], axis=-3)[..., 0, :, :]
 
-    list1, list2 = [temp0, temp1, temp2, temp3], [diff0, diff1, diff2, diff3]
-    mode = list2.index(min(list2))
+    return mode, best_cost, prediction
 
-    return list1[mode], mode
+def pickTheBestMode(block, H, V, P, cost=COST_SAD):
+    mode, best_cost, prediction = decideIntra16x16Mode(block, H, V, P, cost)
 
-def IntraPrediction(im, step):
+    return prediction, int(mode)
+
+def IntraPrediction(im, step, cost=COST_SAD):
     '''
     image intra predict
     : param im: input image
     : param step: macroblock's width
+    : param cost: the cost function of the mode decision, COST_SAD or COST_SATD
     : return: dct coefficient after quantization, zigzag, zlib compression
     '''
     imsize = im.shape
+    samples = np.asarray(im, int)
 
     predict = np.zeros(imsize, int)    # intra prediction result, motion compensation
     mode_map = np.zeros(imsize, int)    # save block mode information
 
-    # init value
-    H = im[0, 0:(0+step)].copy()
-    V = im[0:(0+step), 0].copy()
-
-    P = 128
+    blocks_per_row = imsize[1] // step
+    # the column left of each block, the first block uses its own first column
+    left = np.maximum(r_[:imsize[1]:step] - 1, 0)
 
     for i in r_[:imsize[0]:step]:
-        for j in r_[:imsize[1]:step]:
-
-            if (i==0) and (j==0):  # for left-top block, just copy the data
-                H[:] = 128
-                V[:] = 128
-                P = 128
-
-            elif i==0 and j!=0:
-                H = im[i,j:(j+step)]
-                V = im[i:(i+step),j-1]
-                P = im[i, j-1]
-                
-            elif j==0 and i!=0:
-                H = im[i-1,j:(j+step)]
-                V = im[i:(i+step),j]
-                P = im[i-1, j]
-
-            else:
-                H = im[i-1,j:(j+step)]
-                V = im[i:(i+step),j-1]
-                P = im[i-1, j-1]
-
-            block = im[i:(i+step),j:(j+step)].copy()
-            predict[i:(i+step),j:(j+step)], mode = pickTheBestMode(block, H, V, P)
-            mode_map[i:(i+step),j:(j+step)].fill(mode)
+        # the row above, the first block row uses its own first row
+        top = samples[i-1] if i else samples[0]
+
+        # predict the whole block row at once
+        H = top[:blocks_per_row*step].reshape(blocks_per_row, step)
+        V = samples[i:(i+step), left].T
+        P = top[left]
+        if i == 0:  # for left-top block, just copy the data
+            H = H.copy()
+            V = V.copy()
+            P = P.copy()
+            H[0] = 128
+            V[0] = 128
+            P[0] = 128
+
+        blocks = samples[i:(i+step), :blocks_per_row*step].reshape(step, blocks_per_row, step).swapaxes(0, 1)
+        modes, costs, predictions = decideIntra16x16Mode(blocks, H, V, P, cost)
+
+        predict[i:(i+step), :blocks_per_row*step] = predictions.swapaxes(0, 1).reshape(step, blocks_per_row*step)
+        mode_map[i:(i+step), :blocks_per_row*step] = np.repeat(modes, step)
 
     diff = tools.SAE(im, predict)
     print(diff)
@@ -230,6 +275,7 @@ def predictImage(im, qp, block_step):
     : param block_step: the predict block size, the block should be step*step
     : return: dct coefficient after quantization, zigzag, zlib compression
     '''
+    import matplotlib.pyplot as plt
     
     step = block_step # 16x16 as block
     predict, residual, mode_map = IntraPrediction(im, block_step)
@@ -297,26 +343,30 @@ def inverseIntraPrediction(residual, mode_map, mb_step):
 
     Args:
         residual: residual image after coefficient inverse operation
-        mode_map: the prediction mode map of residual image
+        mode_map: the prediction mode map of residual image, one mode per macroblock or per pixel
         mb_step: macroblock's width
     
     Returns:
-        the recovered original image
+        the recovered original image, uint8 samples
     """
     imsize = residual.shape
-    reconstruted = np.zeros(imsize, int)    # intra prediction result, motion compensation
+    reconstruted = np.zeros(imsize, np.uint8)    # intra prediction result, motion compensation
     step = mb_step
     size = (step, step)
 
-    # init value
-    H = reconstruted[0, 0:(0+step)].copy()
-    V = reconstruted[0:(0+step), 0].copy()
+    if mode_map.shape == imsize:
+        mode_map = mode_map[::step, ::step]   # the mode is the same in the whole macroblock
+
+    # init value, neighbors are int so that -1 can mark them not available
+    H = reconstruted[0, 0:(0+step)].astype(int)
+    V = reconstruted[0:(0+step), 0].astype(int)
     P = 128
 
     for i in r_[:imsize[0]:step]:
         for j in r_[:imsize[1]:step]:
-            logging.debug("----------------------------------------")
-            logging.debug("blk16x16Idx x: %d, y: %d", i/16, j/16)
+            if tracing.PREDICTION:
+                logging.debug("----------------------------------------")
+                logging.debug("blk16x16Idx x: %d, y: %d", i/16, j/16)
             if (i==0) and (j==0):  # for left-top block, just copy the data
                 H[:] = int(128)
                 V[:] = int(128)
@@ -324,40 +374,47 @@ def inverseIntraPrediction(residual, mode_map, mb_step):
 
             elif i==0 and j!=0:
                 H[:] = -1   # -1 means not available
-                V = reconstruted[i:(i+step),j-1].copy()
-                P = reconstruted[i, j-1]
+                V = reconstruted[i:(i+step),j-1].astype(int)
+                P = int(reconstruted[i, j-1])
                 
             elif j==0 and i!=0:
-                H = reconstruted[i-1,j:(j+step)].copy()
+                H = reconstruted[i-1,j:(j+step)].astype(int)
                 V[:] = -1   # -1 means not available
-                P = reconstruted[i-1, j]
+                P = int(reconstruted[i-1, j])
 
             else:
-                H = reconstruted[i-1,j:(j+step)].copy()
-                V = reconstruted[i:(i+step),j-1].copy()
-                P = reconstruted[i-1, j-1]
+                H = reconstruted[i-1,j:(j+step)].astype(int)
+                V = reconstruted[i:(i+step),j-1].astype(int)
+                P = int(reconstruted[i-1, j-1])
 
             #get mode and generate predction image
             predicted = np.zeros((step, step), int)
-            if mode_map[i+1, j+1] == 0:
-                logging.debug("Prediction Mode Vertical")
+            mode = mode_map[i//step, j//step]
+            if mode == 0:
+                if tracing.PREDICTION:
+                    logging.debug("Prediction Mode Vertical")
                 predicted = mode0_16x16(size, H)
-            elif mode_map[i+1, j+1] == 1:
-                logging.debug("Prediction Mode Horizontal")
+            elif mode == 1:
+                if tracing.PREDICTION:
+                    logging.debug("Prediction Mode Horizontal")
                 predicted = mode1_16x16(size, V)
-            elif mode_map[i+1, j+1] == 2:
-                logging.debug("Prediction Mode DC")
+            elif mode == 2:
+                if tracing.PREDICTION:
+                    logging.debug("Prediction Mode DC")
                 predicted = mode2_16x16(size, H, V)
-            elif mode_map[i+1, j+1] == 3:
-                logging.debug("Prediction Mode Plane")
+            elif mode == 3:
+                if tracing.PREDICTION:
+                    logging.debug("Prediction Mode Plane")
                 predicted = mode3_16x16(size, H, V, P)
             else:
                 logging.error("Predict Mode Error!")
 
-            reconstruted[i:(i+step),j:(j+step)] = (residual[i:(i+step),j:(j+step)] + predicted).copy()
-            logging.debug("residual Values:\n%s", residual[i:(i+step),j:(j+step)])
-            logging.debug("Predicted Values:\n%s", predicted)
-            logging.debug("Decoded Y Values:\n%s", reconstruted[i:(i+step),j:(j+step)])
+            # Clip1 of the constructed samples, according to 8.5.14
+            reconstruted[i:(i+step),j:(j+step)] = np.clip(residual[i:(i+step),j:(j+step)] + predicted, 0, 255)
+            if tracing.PREDICTION:
+                logging.debug("residual Values:\n%s", residual[i:(i+step),j:(j+step)])
+                logging.debug("Predicted Values:\n%s", predicted)
+                logging.debug("Decoded Y Values:\n%s", reconstruted[i:(i+step),j:(j+step)])
 
     return reconstruted
 
@@ -381,6 +438,7 @@ def inversePredictImage(binary, mode_1D, qp, m, n, block_step):
     return original
 
 def testCase1():
+    import matplotlib.pyplot as plt
     qp = 15
     step = 16
     im = plt.imread("E:/liumangxuxu/code/PyCodec/modules/lena2.tif").astype(int)
@@ -399,6 +457,7 @@ def testCase1():
     plt.show()
 
 def testCase2():
+    import matplotlib.pyplot as plt
     mbWidth = 16
 
     residual = np.load("../test/residual.npy")
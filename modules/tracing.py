@@ -0,0 +1,67 @@
+# Switches of the debug traces in the per-macroblock loops
+#
+# Copyright (C) <2020>  <cookwhy@qq.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# The hot loops guard their logging.debug calls with one of the flags below:
+#
+#     if tracing.CAVLC:
+#         logging.debug("processed data: %s", stream.peek_bin(position))
+#
+# A disabled subsystem costs one attribute lookup per guard, the arguments are never built.
+# An enabled subsystem still needs the logging level at DEBUG to print anything.
+# The flags are set from the PYCODEC_TRACE environment variable, e.g. PYCODEC_TRACE=nalu,cavlc,
+# or with enable() / disable() at run time.
+
+import os
+import logging
+
+SUBSYSTEMS = ('NALU', 'CAVLC', 'PREDICTION', 'ENCODER')
+
+NALU = False         # NalParser slice data, macroblock layer and residual parsing
+CAVLC = False        # cavlc.decode
+PREDICTION = False   # prediction.inverseIntraPrediction
+ENCODER = False      # H264Encoder macroblock loops
+
+def enable(*subsystems):
+    """
+    Switch on the traces of some subsystems
+    Args:
+        subsystems: names in SUBSYSTEMS, case insensitive, 'all' for all of them
+    """
+    _set(subsystems, True)
+
+def disable(*subsystems):
+    """
+    Switch off the traces of some subsystems
+    Args:
+        subsystems: names in SUBSYSTEMS, case insensitive, 'all' for all of them
+    """
+    _set(subsystems, False)
+
+def _set(subsystems, value):
+    for name in subsystems:
+        name = name.strip().upper()
+        if not name:
+            continue
+        if name == 'ALL':
+            for x in SUBSYSTEMS:
+                globals()[x] = value
+        elif name in SUBSYSTEMS:
+            globals()[name] = value
+        else:
+            logging.warning("unknown trace subsystem: %s", name)
+
+enable(*os.environ.get('PYCODEC_TRACE', '').split(','))
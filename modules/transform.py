@@ -53,63 +53,62 @@ HWd = np.array([[1, 1, 1, 1],
                 [1, -1, -1, 1],
                 [1, -1, 1, -1]])
 
+# 2x2 Hadamard transform matrix of the chroma DC
+HWc = np.array([[1, 1],
+                [1, -1]])
+
+QP_MAX = 51
+
+# QPc of qPI 30 to 51, from Table 8-15 on page 137, QPc is qPI below 30
+_QPC_OVER_29 = [29, 30, 31, 32, 32, 33, 34, 34, 35, 35, 36, 36, 37, 37, 37, 38, 38, 38, 39, 39, 39, 39]
+
+# which entry of a Mtb/Vtb row each coefficient position uses, according to formula 7.22 on page 194
+_POSITION_CLASS = np.array([[0, 2, 0, 2],
+                            [2, 1, 2, 1],
+                            [0, 2, 0, 2],
+                            [2, 1, 2, 1]])
+
+def _build_qp_table():
+    """
+    Build the scaling tables of every QP, indexed as table[field][QP, row, col]
+        LevelScale: Vi4 of the inverse scaling, Vtb of QP%6
+        MF: Mf4 of the forward quantization, Mtb of QP%6
+        shift: qbits of the forward quantization, 15 + floor(QP/6)
+        offset: rounding offset of the forward quantization, half of 2^shift
+    """
+    qp = np.arange(QP_MAX + 1)
+    table = np.zeros((QP_MAX + 1, 4, 4), np.dtype([('LevelScale', '<i4'), ('MF', '<i4'), ('shift', '<i4'), ('offset', '<i8')]))
+    table['LevelScale'] = Vtb[qp % 6][:, _POSITION_CLASS]
+    table['MF'] = Mtb[qp % 6][:, _POSITION_CLASS]
+    table['shift'] = (15 + qp // 6)[:, None, None]
+    table['offset'] = 1 << (table['shift'] - 1)
+    table.flags.writeable = False
+    return table
+
+# the scaling tables of QP 0 to 51, read only
+QP_TABLE = _build_qp_table()
+
 def getMf4ByQP(qp):
     '''
-    get Mf4 matrix by QP value
+    get Mf4 matrix by QP value, a read only view of QP_TABLE
     : param qp: the QP enum value in H.264
     '''
-    row = qp
-    if (qp<=5):
-        row = qp
-    else:
-        row = qp%6
-
-    # accroding to formula 7.22 on page 194
-    Mf4 = np.array([[Mtb[row, 0], Mtb[row, 2], Mtb[row, 0], Mtb[row, 2]],
-                    [Mtb[row, 2], Mtb[row, 1], Mtb[row, 2], Mtb[row, 1]],
-                    [Mtb[row, 0], Mtb[row, 2], Mtb[row, 0], Mtb[row, 2]],
-                    [Mtb[row, 2], Mtb[row, 1], Mtb[row, 2], Mtb[row, 1]]])
-
-    return Mf4
+    return QP_TABLE['MF'][qp]
 
 def getVi4ByQP(qp):
     '''
-    get Ci4 matrix by QP value
+    get Ci4 matrix by QP value, a read only view of QP_TABLE
     : param qp: the QP enum value in H.264
     '''
-    row = qp
-    if (qp<=5):
-        row = qp
-    else:
-        row = qp%6
-
-    # according to formula 7.22 on page 194
-    Vi4 = np.array([[Vtb[row, 0], Vtb[row, 2], Vtb[row, 0], Vtb[row, 2]],
-                    [Vtb[row, 2], Vtb[row, 1], Vtb[row, 2], Vtb[row, 1]],
-                    [Vtb[row, 0], Vtb[row, 2], Vtb[row, 0], Vtb[row, 2]],
-                    [Vtb[row, 2], Vtb[row, 1], Vtb[row, 2], Vtb[row, 1]]])
-
-    return Vi4
+    return QP_TABLE['LevelScale'][qp]
 
 def getLevelScaleOfLumaDC(qp):
     '''
-    get LevelScale matrix by QP value
+    get LevelScale matrix by QP value, a read only view of QP_TABLE
     accroding to 8-252 formula on page 136 of [H.264 standard Book]
     : param qp: the QP enum value in H.264
     '''
-    row = qp
-    if (qp<=5):
-        row = qp
-    else:
-        row = qp%6
-
-    # according to formula 8-252 on page 136
-    ls4 = np.array([[Vtb[row, 0], Vtb[row, 2], Vtb[row, 0], Vtb[row, 2]],
-                    [Vtb[row, 2], Vtb[row, 1], Vtb[row, 2], Vtb[row, 1]],
-                    [Vtb[row, 0], Vtb[row, 2], Vtb[row, 0], Vtb[row, 2]],
-                    [Vtb[row, 2], Vtb[row, 1], Vtb[row, 2], Vtb[row, 1]]])
-
-    return ls4
+    return QP_TABLE['LevelScale'][qp]
 
 def forwardTransformAndScaling4x4(X, QP):
     '''
@@ -124,11 +123,10 @@ def forwardTransformAndScaling4x4(X, QP):
     #print(temp)
 
     # step2: Scaling and quantization
-    Mf4 = getMf4ByQP(QP)
-    #print(Mf4)
+    scaling = QP_TABLE[QP]
+    #print(scaling['MF'])
 
-    scaler = math.pow(2, 15+math.floor(QP/6))
-    Y = np.round(temp * Mf4 / scaler, 0)
+    Y = np.round(np.ldexp(temp * scaling['MF'], -scaling['shift']), 0)
     #print("result:")
     #print(Y)
 
@@ -174,11 +172,37 @@ def forwardHadamardAndScaling4x4(X, QP):
     temp = np.dot(temp, HWd) / 2
 
     # step2: Scaling and quantization
-    Mf4 = getMf4ByQP(QP)
-    #print(Mf4)
+    scaling = QP_TABLE[QP]
+    #print(scaling['MF'])
 
-    scaler = math.pow(2, 15+math.floor(QP/6))
-    Y = np.round(temp * Mf4 / scaler, 0)
+    Y = np.round(np.ldexp(temp * scaling['MF'], -scaling['shift']), 0)
+
+    return Y
+
+def getChromaQP(qp, chroma_qp_index_offset=0):
+    '''
+    get QPc of the chroma blocks, according to Table 8-15 on page 137
+    : param qp: the QP of the luma blocks
+    : param chroma_qp_index_offset: chroma_qp_index_offset of the PPS
+    '''
+    qpi = min(max(qp + chroma_qp_index_offset, 0), QP_MAX)
+    return qpi if qpi < 30 else _QPC_OVER_29[qpi - 30]
+
+def forwardHadamardAndScaling2x2(X, QP):
+    """
+    Integer Hadamard transform and quantization : 2 × 2 chroma DC blocks
+    The 4 × 4 luma DC process on 2 × 2 blocks, the quantization shift is qbits + 1
+    Args:
+        X: the DC coefficients of the four 4x4 blocks of a 8x8 chroma block, 2x2 square
+        QP: the qp step of the chroma, QPc of getChromaQP()
+    """
+    #step1: Calculate 2 × 2 Hadamard transform
+    temp = np.dot(np.dot(HWc, X), HWc)
+
+    # step2: Scaling and quantization with the MF of position (0, 0)
+    scaling = QP_TABLE[QP][0, 0]
+
+    Y = np.round(np.ldexp(temp * scaling['MF'], -(scaling['shift'] + 1)), 0)
 
     return Y
 
@@ -286,6 +310,40 @@ def inverseReidual4x4ScalingAndTransform(C, QP):
     #logging.debug("r\n%s", r)
     return r
 
+def _butterfly4(x):
+    """
+    Inverse transform butterfly of 8-338 to 8-345 along the last axis of x
+    """
+    e0 = x[..., 0] + x[..., 2]
+    e1 = x[..., 0] - x[..., 2]
+    e2 = (x[..., 1] >> 1) - x[..., 3]
+    e3 = x[..., 1] + (x[..., 3] >> 1)
+    return np.stack([e0 + e3, e1 + e2, e1 - e2, e0 - e3], axis=-1)
+
+def inverseResidual4x4ScalingAndTransformBatch(C, QP, dc_scaled=True):
+    """
+    Scaling and transformation process for a batch of residual 4x4 blocks
+    The batched form of inverseReidual4x4ScalingAndTransform, according to 8.5.8 on page 137 of [H.264 standard Book]
+    Args:
+        C: (N, 4, 4) coefficients of residual 4x4 blocks
+        QP: the qp step, one value for all blocks or N values
+        dc_scaled: C[:, 0, 0] are DC values already scaled by the DC transform, like Intra16x16 and chroma blocks
+    Return:
+        r: (N, 4, 4) int array, the reconstruction of residual 4x4 blocks
+    """
+    c = np.asarray(C).astype(np.int64)
+    qp = np.broadcast_to(np.asarray(QP, dtype=np.int64), c.shape[:1])
+
+    # 8-336, with flat weighting LevelScale4x4 << (qP/6 - 4) is Vi4 << qP/6
+    d = (c * QP_TABLE['LevelScale'][qp]) << (qp // 6)[:, None, None]
+    if dc_scaled:
+        d[:, 0, 0] = c[:, 0, 0]
+
+    # rows first, then columns
+    h = _butterfly4(_butterfly4(d).swapaxes(1, 2)).swapaxes(1, 2)
+
+    return (h + 32) >> 6
+
 def inverse_P_Reidual4x4ScalingAndTransform(P, C, QP):
     """
     Scaling and transformation process for residual 4x4 P macroblocks
@@ -322,9 +380,9 @@ def inverse_P_Reidual4x4ScalingAndTransform(P, C, QP):
 
     Cs = f + (((C * ls4 * A) << int(QP/6)) >> 6)
 
-    levelScale2 = getMf4ByQP(QP)
+    scaling = QP_TABLE[QP]
 
-    r = (np.sign(Cs) * (abs(Cs) * levelScale2 + (1<<(14+int(QP/6))))) >> (15+int(QP/6))
+    r = (np.sign(Cs) * (abs(Cs) * scaling['MF'] + scaling['offset'])) >> scaling['shift']
 
     return inverseReidual4x4ScalingAndTransform(r, QP)
 
@@ -404,6 +462,61 @@ def testResidual4x4():
     residual = inverseReidual4x4ScalingAndTransform(c, 20)
     logging.debug("Inverse:\n %s", residual)
 
+def testResidual4x4Batch():
+    np.random.seed(0)
+    c = np.random.randint(-64, 64, (32, 4, 4))
+    c[:, 0, 0] = np.random.randint(-3000, 3000, 32)
+
+    residual = inverseResidual4x4ScalingAndTransformBatch(c, 20)
+    for i in range(len(c)):
+        assert (residual[i] == inverseReidual4x4ScalingAndTransform(c[i], 20)).all()
+    logging.debug("batched inverse transform matches on %d blocks", len(c))
+
+    # one QP per block, against 8-336 with flat LevelScale4x4 and the transform of 8-338 to 8-354
+    def reference(c, qp, dc_scaled):
+        d = np.zeros((4, 4), int)
+        for i in range(4):
+            for j in range(4):
+                ls = 16 * int(Vtb[qp % 6][_POSITION_CLASS[i, j]])
+                if i == 0 and j == 0 and dc_scaled:
+                    d[i, j] = c[i, j]
+                elif qp >= 24:
+                    d[i, j] = (int(c[i, j]) * ls) << (qp // 6 - 4)
+                else:
+                    d[i, j] = (int(c[i, j]) * ls + (1 << (3 - qp // 6))) >> (4 - qp // 6)
+        f = np.zeros((4, 4), int)
+        for i in range(4):
+            e = [d[i, 0] + d[i, 2], d[i, 0] - d[i, 2], (d[i, 1] >> 1) - d[i, 3], d[i, 1] + (d[i, 3] >> 1)]
+            f[i] = [e[0] + e[3], e[1] + e[2], e[1] - e[2], e[0] - e[3]]
+        h = np.zeros((4, 4), int)
+        for j in range(4):
+            g = [f[0, j] + f[2, j], f[0, j] - f[2, j], (f[1, j] >> 1) - f[3, j], f[1, j] + (f[3, j] >> 1)]
+            h[:, j] = [g[0] + g[3], g[1] + g[2], g[1] - g[2], g[0] - g[3]]
+        return (h + 32) >> 6
+
+    qp = np.random.randint(0, QP_MAX + 1, len(c))
+    for dc_scaled in (True, False):
+        residual = inverseResidual4x4ScalingAndTransformBatch(c, qp, dc_scaled)
+        for i in range(len(c)):
+            assert (residual[i] == reference(c[i], qp[i], dc_scaled)).all(), (i, qp[i], dc_scaled)
+    logging.debug("batched inverse transform matches 8-336 at QP %d to %d", qp.min(), qp.max())
+
+def testChromaDC():
+    # a flat 8x8 chroma residual, the DC of each 4x4 core transform is 16 times the level
+    for QP in range(0, 30):
+        for level in (-40, -7, 0, 3, 25):
+            c = forwardHadamardAndScaling2x2(np.full((2, 2), 16 * level), QP).astype(int)
+
+            # 8-326 to 8-330 of the decoder, flat LevelScale4x4 is 16 * Vi4, then the 4x4 blocks with the DC only
+            f = np.dot(np.dot(HWc, c), HWc)
+            dcC = ((f * 16 * int(QP_TABLE['LevelScale'][QP, 0, 0])) << (QP // 6)) >> 5
+            C = np.zeros((4, 4, 4), int)
+            C[:, 0, 0] = dcC.flatten()
+            r = inverseResidual4x4ScalingAndTransformBatch(C, QP)
+            assert (abs(r - level) <= max(1, QP // 6)).all(), (QP, level, r[0, 0, 0])
+    assert [getChromaQP(qp) for qp in (0, 29, 30, 39, 51)] == [0, 29, 29, 35, 39]
+    logging.debug("chroma DC round trip checked")
+
 if __name__ == "__main__":
     logging.basicConfig(
         level=logging.DEBUG,
@@ -420,4 +533,8 @@ if __name__ == "__main__":
 
     testLumaDC()
 
-    testResidual4x4()
\ No newline at end of file
+    testResidual4x4()
+
+    testResidual4x4Batch()
+
+    testChromaDC()
\ No newline at end of file
@@ -210,6 +210,40 @@ coeff_token = np.array([
 
                         ])
 
+def compile_prefix_table(codes):
+    """
+    Compile a prefix-free VLC into a lookup table indexed by the next bits of the stream
+    Args:
+        codes: list of (code, value), code is a '0'/'1' string, value is a non-negative int
+    returns:
+        width: the number of bits to peek, the length of the longest code
+        table: list of 2**width entries, (value << 5) | code length, 0 for invalid prefixes
+    """
+    width = max(len(code) for code, value in codes)
+    table = np.zeros(1 << width, dtype=np.int64)
+    for code, value in codes:
+        length = len(code)
+        first = int(code, 2) << (width - length)
+        table[first: first + (1 << (width - length))] = (value << 5) | length
+
+    return width, table.tolist()
+
+def _compile_coeff_token(table_i):
+    """
+    Compile coeff_token[table_i], the value of an entry is (TotalCoeff << 2) | TrailingOnes
+    """
+    codes = []
+    for TotalCoeff in range(coeff_token.shape[1]):
+        for TrailingOnes in range(coeff_token.shape[2]):
+            code = coeff_token[table_i][TotalCoeff][TrailingOnes]
+            if code != '-':
+                codes.append((code, (TotalCoeff << 2) | TrailingOnes))
+    return compile_prefix_table(codes)
+
+# lookup tables of coeff_token for each nC table index of get_nC_table_index()
+# coeff_token_bits[i] bits are peeked to index coeff_token_lut[i]
+coeff_token_bits, coeff_token_lut = zip(*[_compile_coeff_token(i) for i in range(coeff_token.shape[0])])
+
 #table 9-6
 level_prefix = np.array(['1',
                          '01',
@@ -281,6 +315,49 @@ run_before = np.array([['-', '1', '1', '11', '11', '11', '11', '111'],
                        ['-', '-', '-', '-', '-', '-', '-', '00000000001']
                        ])
 
+def _compile_columns(table):
+    """
+    Compile each column of a [value][column] code table, the value of an entry is the row
+    Returns:
+        bits: the peek width of each column, 0 for a column without codes
+        lut: the lookup table of each column, None for a column without codes
+    """
+    bits = []
+    lut = []
+    for col in range(table.shape[1]):
+        codes = [(code, row) for row, code in enumerate(table[:, col]) if code != '-']
+        if codes:
+            width, column_lut = compile_prefix_table(codes)
+        else:
+            width, column_lut = 0, None
+        bits.append(width)
+        lut.append(column_lut)
+    return bits, lut
+
+# lookup tables of total_zeros indexed by TotalCoeff, and of run_before indexed by zerosLeft (7 for > 6)
+total_zeros_bits, total_zeros_lut = _compile_columns(total_zeros)
+total_zeros_2x2_bits, total_zeros_2x2_lut = _compile_columns(total_zeros_2x2)
+run_before_bits, run_before_lut = _compile_columns(run_before)
+
+def _compile_codes(table):
+    """
+    Compile a code table for the encoder, keeping its indices
+    Returns:
+        nested lists of (code, length) int pairs, None for '-'
+    """
+    if table.ndim > 1:
+        return [_compile_codes(row) for row in table]
+    return [(int(code, 2), len(code)) if code != '-' else None for code in table]
+
+# (code, length) tables of the encoder
+# coeff_token_code[nC table index][TotalCoeff][TrailingOnes]
+# total_zeros_code[total_zeros][TotalCoeff], total_zeros_2x2_code alike
+# run_before_code[run_before][zerosLeft], 7 for zerosLeft > 6
+coeff_token_code = _compile_codes(coeff_token)
+total_zeros_code = _compile_codes(total_zeros)
+total_zeros_2x2_code = _compile_codes(total_zeros_2x2)
+run_before_code = _compile_codes(run_before)
+
 if __name__ == "__main__":
     print(coeff_token.shape)
     print(coeff_token)
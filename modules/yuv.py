@@ -2,47 +2,367 @@
 
 from numpy import *
 import logging
-import matplotlib.pyplot as plt
+import mmap
+import os
+import queue
+import threading
 
 screenLevels = 255.0
 
-def yuv_import(filename, dims, numfrm, startfrm):  
-    fp = open(filename,'rb')  
-    blk_size = int(prod(dims) * 3 / 2)  
-    fp.seek( blk_size*startfrm, 0)  
+def plane_dims(dims):
+    """
+    Get the plane sizes of a YUV 4:2:0 frame
+    Args:
+        dims: (height, width) of the Y plane
+    Returns:
+        (height, width) of the Y plane, (height, width) of the U and V planes
+    """
+    height, width = int(dims[0]), int(dims[1])
+    return (height, width), ((height + 1) // 2, (width + 1) // 2)
+
+def frame_size(dims):
+    """
+    Bytes of one YUV 4:2:0 planar frame
+    """
+    (h, w), (ch, cw) = plane_dims(dims)
+    return h*w + 2*ch*cw
+
+def split_planes(buf, dims, offset=0):
+    """
+    Get the Y, U, V planes of one frame in a buffer, without copying
+    Args:
+        buf: bytes-like object holding the frame
+        dims: (height, width) of the Y plane
+        offset: byte offset of the frame in buf
+    Returns:
+        (Y, U, V) uint8 arrays sharing memory with buf
+    """
+    (h, w), (ch, cw) = plane_dims(dims)
+    Y = frombuffer(buf, uint8, h*w, offset).reshape(h, w)
+    U = frombuffer(buf, uint8, ch*cw, offset + h*w).reshape(ch, cw)
+    V = frombuffer(buf, uint8, ch*cw, offset + h*w + ch*cw).reshape(ch, cw)
+    return Y, U, V
+
+class YuvFile():
+    """
+    Random access to the frames of a raw YUV 4:2:0 planar file through mmap
+    The planes are read-only views of the mapped file, nothing is read before it is used.
+    """
+    def __init__(self, filename, dims):
+        """
+        Args:
+            filename: the .yuv file
+            dims: (height, width) of the Y plane
+        """
+        self.dims = dims
+        self.frame_size = frame_size(dims)
+        self.__file = open(filename, 'rb')
+        size = os.fstat(self.__file.fileno()).st_size
+        if size:
+            self.__data = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.__data = b''   # an empty file can not be mapped
+        self.frames = size // self.frame_size
+        if size % self.frame_size:
+            logging.warning("%s: %d trailing bytes are not a whole frame", filename, size % self.frame_size)
+
+    def __len__(self):
+        return self.frames
+
+    def __getitem__(self, n):
+        return self.frame(n)
+
+    def frame(self, n):
+        """
+        Get the planes of frame n
+        Returns:
+            (Y, U, V) read-only uint8 views of the file
+        """
+        if n < 0:
+            n = n + self.frames
+        if n < 0 or n >= self.frames:
+            raise IndexError("frame %d out of range, the file has %d frames" % (n, self.frames))
+        return split_planes(self.__data, self.dims, n * self.frame_size)
+
+    def range(self, startfrm=0, numfrm=None):
+        """
+        Yield the planes of numfrm frames from startfrm, to the end of file by default
+        """
+        end = self.frames if numfrm is None else min(self.frames, startfrm + numfrm)
+        for n in range(startfrm, end):
+            yield self.frame(n)
+
+    def close(self):
+        """
+        Release the file, the map stays until the last view returned before is gone
+        """
+        if isinstance(self.__data, mmap.mmap):
+            try:
+                self.__data.close()
+            except BufferError:
+                pass   # views are alive, they hold the map
+        self.__data = b''
+        self.frames = 0
+        self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def yuv_import(filename, dims, numfrm, startfrm):
+    """
+    Read frames of a raw YUV 4:2:0 planar file
+    Args:
+        filename: the .yuv file
+        dims: (height, width) of the Y plane
+        numfrm: number of frames to read
+        startfrm: the first frame to read
+    Returns:
+        lists of the Y, U and V planes, every frame has its own arrays
+    """
+    logging.debug("Y width: %d", dims[1])
+    logging.debug("Y height: %d", dims[0])
 
     Y = []
     U = []
     V = []
-    logging.debug("Y width: %d", dims[0])
-    logging.debug("Y height: %d", dims[1])
-
-    d00 = dims[0]//2
-    d01 = dims[1]//2
-    logging.debug("UV width: %d", d00)
-    logging.debug("VV width: %d", d01)
-
-    Yt = zeros((dims[0],dims[1]),uint8,'C')
-    Ut = zeros((d00,d01),uint8,'C')
-    Vt = zeros((d00,d01),uint8,'C')
-    
-    for i in range(numfrm):
-        for m in range(dims[0]):
-            for n in range(dims[1]):
-                #print m,n
-                Yt[m,n]=ord(fp.read(1))
-        for m in range(d00):
-            for n in range(d01):
-                Ut[m,n]=ord(fp.read(1))
-        for m in range(d00):
-            for n in range(d01):
-                Vt[m,n]=ord(fp.read(1))
-        Y=Y+[Yt]
-        U=U+[Ut]
-        V=V+[Vt]
-    fp.close()
+    with YuvFile(filename, dims) as f:
+        for Yt, Ut, Vt in f.range(startfrm, numfrm):
+            Y.append(Yt.copy())
+            U.append(Ut.copy())
+            V.append(Vt.copy())
     return (Y,U,V)
 
+def _read_full(f, view):
+    """
+    Read into view until it is full or the input ends
+    Returns:
+        number of bytes read
+    """
+    total = 0
+    while total < len(view):
+        n = f.readinto(view[total:])
+        if not n:
+            break
+        total += n
+    return total
+
+def _read_ahead(source, dims, startfrm, numfrm, free, filled, stop):
+    """
+    Body of the read-ahead thread of read_frames()
+    Takes empty buffers from free, fills each with one frame and hands it over through filled.
+    None in filled marks the end of input, an exception object is raised again by the reader.
+    """
+    size = frame_size(dims)
+    opened = isinstance(source, (str, bytes, os.PathLike))
+    f = None
+    try:
+        f = open(source, 'rb', buffering=0) if opened else source
+        if startfrm:
+            if f.seekable():
+                f.seek(startfrm * size, os.SEEK_CUR)
+            else:
+                skip = bytearray(size)
+                for n in range(startfrm):
+                    if _read_full(f, memoryview(skip)) < size:
+                        return
+
+        n = 0
+        while numfrm is None or n < numfrm:
+            buf = free.get()
+            if stop.is_set():
+                return
+            got = _read_full(f, memoryview(buf))
+            if got < size:
+                if got:
+                    logging.warning("%d trailing bytes are not a whole frame", got)
+                return
+            filled.put(buf)
+            n += 1
+    except Exception as e:
+        filled.put(e)
+    finally:
+        filled.put(None)
+        if opened and f is not None:
+            f.close()
+
+def read_frames(source, dims, startfrm=0, numfrm=None, readahead=2):
+    """
+    Yield the frames of a raw YUV 4:2:0 planar input in order
+    A background thread reads up to readahead frames ahead into a fixed pool of buffers,
+    so reading overlaps with the work on the current frame and memory stays at readahead+1 frames.
+    Args:
+        source: file name, or binary file-like object such as a pipe (sys.stdin.buffer)
+        dims: (height, width) of the Y plane
+        startfrm: number of frames to skip
+        numfrm: number of frames to yield, to the end of input by default
+        readahead: number of frames read ahead
+    Yields:
+        (Y, U, V) uint8 arrays, they are reused for a later frame once the next frame is requested,
+        copy them to keep a frame
+    """
+    free = queue.Queue()
+    filled = queue.Queue()
+    stop = threading.Event()
+    for x in range(readahead + 1):
+        free.put(bytearray(frame_size(dims)))
+
+    reader = threading.Thread(target=_read_ahead, args=(source, dims, startfrm, numfrm, free, filled, stop),
+                              name="yuv-read-ahead", daemon=True)
+    reader.start()
+    try:
+        while True:
+            buf = filled.get()
+            if buf is None:
+                break
+            if isinstance(buf, Exception):
+                raise buf
+            yield split_planes(buf, dims)
+            free.put(buf)
+    finally:
+        stop.set()
+        free.put(None)   # wake the reader up if it waits for a buffer
+
+# default size of the output buffer of YuvWriter
+WRITE_BUFFER_SIZE = 1 << 22
+
+class YuvWriter():
+    """
+    Write frames as raw YUV 4:2:0 planar (yuv420p) or YUV4MPEG2 (.y4m)
+    Frames are gathered in a large buffer and written with few write() calls,
+    frames larger than the buffer go out plane by plane with os.writev when the output has a file descriptor.
+    """
+    def __init__(self, output, dims=None, y4m=None, fps=(25, 1), buffer_size=WRITE_BUFFER_SIZE):
+        """
+        Args:
+            output: file name, or binary file-like object such as a pipe (sys.stdout.buffer)
+            dims: (height, width) of the Y plane, taken from the first frame by default
+            y4m: write Y4M, by default when the file name ends with .y4m
+            fps: frame rate of the Y4M header, (numerator, denominator)
+            buffer_size: bytes gathered before a write
+        """
+        self.opened = isinstance(output, (str, bytes, os.PathLike))
+        if y4m is None:
+            y4m = self.opened and os.fsdecode(output).lower().endswith('.y4m')
+        self.f = open(output, 'wb', buffering=0) if self.opened else output
+        self.dims = dims
+        self.y4m = y4m
+        self.fps = fps
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.frames = 0
+        self.bytes = 0
+
+        self.fd = None
+        if self.opened:
+            self.fd = self.f.fileno()
+
+    def __header(self):
+        (h, w), (ch, cw) = plane_dims(self.dims)
+        return b'YUV4MPEG2 W%d H%d F%d:%d Ip A1:1 C420jpeg\n' % (w, h, self.fps[0], self.fps[1])
+
+    def write(self, Y, U=None, V=None):
+        """
+        Write one frame
+        Args:
+            Y: the luma plane, uint8, other types are clipped to 0..255
+            U, V: the chroma planes, neutral gray (128) by default as the decoder only reconstructs luma
+        """
+        if self.dims is None:
+            self.dims = Y.shape
+        (h, w), (ch, cw) = plane_dims(self.dims)
+        if Y.shape != (h, w):
+            raise ValueError("frame of %s, the output is %s" % (Y.shape, (h, w)))
+
+        planes = [_as_samples(Y)]
+        for plane in (U, V):
+            if plane is None:
+                planes.append(_gray_plane(ch, cw))
+            else:
+                planes.append(_as_samples(plane))
+
+        if self.frames == 0 and self.y4m:
+            self.buffer += self.__header()
+        if self.y4m:
+            self.buffer += b'FRAME\n'
+
+        size = sum(p.nbytes for p in planes)
+        if len(self.buffer) + size > self.buffer_size:
+            self.flush()
+        if size >= self.buffer_size:
+            self.__write_planes(planes)
+        else:
+            for p in planes:
+                self.buffer += p.data
+        self.frames += 1
+
+    def __write_planes(self, planes):
+        """
+        Write plane buffers without gathering them
+        """
+        views = [memoryview(p).cast('B') for p in planes]
+        if self.fd is not None and hasattr(os, 'writev'):
+            while views:
+                n = os.writev(self.fd, views)
+                self.bytes += n
+                while views and n >= len(views[0]):
+                    n -= len(views[0])
+                    views.pop(0)
+                if views:
+                    views[0] = views[0][n:]
+        else:
+            for v in views:
+                self.f.write(v)
+                self.bytes += len(v)
+
+    def flush(self):
+        """
+        Write the gathered frames
+        """
+        if self.buffer:
+            self.__write_planes([self.buffer])
+            self.buffer = bytearray()
+        if hasattr(self.f, 'flush'):
+            self.f.flush()
+
+    def close(self):
+        """
+        Flush and close the output, file-like objects passed in stay open
+        """
+        self.flush()
+        if self.opened:
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _as_samples(plane):
+    """
+    Get a plane as contiguous uint8 samples
+    """
+    plane = asarray(plane)
+    if plane.dtype != uint8:
+        plane = clip(plane, 0, 255).astype(uint8)
+    return ascontiguousarray(plane)
+
+_gray_planes = {}
+
+def _gray_plane(height, width):
+    """
+    A shared neutral chroma plane
+    """
+    plane = _gray_planes.get((height, width))
+    if plane is None:
+        plane = full((height, width), 128, uint8)
+        plane.flags.writeable = False
+        _gray_planes[(height, width)] = plane
+    return plane
+
 if __name__ == '__main__':
     logging.basicConfig(
         level=logging.DEBUG,
@@ -62,6 +382,7 @@ if __name__ == '__main__':
     logging.debug(YY)
     logging.debug(YY.size)
 
+    import matplotlib.pyplot as plt
     plt.figure()
     plt.imshow(YY, cmap='gray')
     plt.show()